@@ -0,0 +1,272 @@
+""":mod:`common` --- Common utilities for benchmarks
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+"""
+import os
+import sys
+import random
+import hashlib
+import datetime
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import langdev.orm
+import langdev.web
+
+
+#: Modules that define model classes.
+model_modules = ['langdev.user', 'langdev.forum', 'langdev.thirdparty',
+                 'langdev.mail', 'langdev.job']
+
+
+def temporary_database_url():
+    """Makes a new SQLite database file in the temporary directory, and
+    returns its URL.
+
+    """
+    fd, path = tempfile.mkstemp(prefix='langdev-bench-', suffix='.sqlite')
+    os.close(fd)
+    return 'sqlite:///' + path
+
+
+def make_app(database_url, **config):
+    """Creates a LangDev application for benchmarks. Tables are created
+    if they don't exist.
+
+    :param database_url: a database url
+    :type database_url: :class:`basestring`
+    :param \*\*config: extra configurations
+    :returns: a WSGI application
+    :rtype: :class:`flask.Flask`
+
+    """
+    def modify(app):
+        app.config['DATABASE_URL'] = database_url
+        app.config['SECRET_KEY'] = 'benchmark'
+        app.config['CSRF_ENABLED'] = False
+        app.config['MAIL_SUPPRESS_SEND'] = True
+        app.config.update(config)
+    app = langdev.web.create_app(modify)
+    for module in model_modules:
+        __import__(module)
+    engine = langdev.web.get_database_engine(app.config)
+    langdev.orm.Base.metadata.create_all(engine)
+    return app
+
+
+def seed(session, users=20, posts=200, comments=1000, commented_posts=10,
+         random_seed=0):
+    """Fills the database with the same content every time. Users are
+    named ``user0``, ``user1``, ... and their passwords are ``password``.
+    Comments are randomly nested on the first ``commented_posts`` posts.
+    ``user0`` also owns a third-party application.
+
+    :returns: the :class:`dict` of ids of created objects; ``'users'``,
+              ``'posts'``, ``'comments'`` and ``'app'``
+    :rtype: :class:`dict`
+
+    """
+    from langdev.user import User
+    from langdev.forum import Post, Comment
+    from langdev.thirdparty import Application
+    rand = random.Random(random_seed)
+    with session.begin():
+        user_objects = [User(login=u'user{0}'.format(i),
+                             name=u'User {0}'.format(i),
+                             email=u'user{0}@example.com'.format(i),
+                             url=u'', password=u'password')
+                        for i in xrange(users)]
+        session.add_all(user_objects)
+        app = Application(owner=user_objects[0], title=u'Application',
+                          description=u'Third-party application',
+                          url=u'http://example.com/')
+        session.add(app)
+    with session.begin():
+        post_objects = [Post(author=rand.choice(user_objects),
+                             title=u'Post {0}'.format(i),
+                             body=u'*Body* of post {0}'.format(i),
+                             sticky=i % 50 == 0)
+                        for i in xrange(posts)]
+        session.add_all(post_objects)
+    comment_objects = []
+    targets = post_objects[:commented_posts]
+    for i, post in enumerate(targets):
+        thread = []
+        count = comments // len(targets)
+        if i < comments % len(targets):
+            count += 1
+        with session.begin():
+            for j in xrange(count):
+                comment = Comment(author=rand.choice(user_objects),
+                                  body=u'Comment {0}'.format(j), post=post)
+                if thread and rand.random() < 0.7:
+                    comment.parent = rand.choice(thread)
+                session.add(comment)
+                session.flush()
+                thread.append(comment)
+        comment_objects.extend(thread)
+    return {'users': [user.id for user in user_objects],
+            'posts': [post.id for post in post_objects],
+            'comments': [comment.id for comment in comment_objects],
+            'app': app.key}
+
+
+#: Words that :func:`bulk_seed()` makes text of. Hangul words are mixed,
+#: since most of LangDev content is in Korean.
+words = (u'\ud30c\uc774\uc36c \uc5b8\uc5b4 \ud504\ub85c\uadf8\ub798\ubc0d '
+         u'\ud568\uc218 \ud0c0\uc785 \ucef4\ud30c\uc77c\ub7ec \ubb38\ubc95 '
+         u'\uad6c\ud604 \uc9c8\ubb38 \ub2f5\ubcc0 \uc131\ub2a5 '
+         u'\ub7ad\ub514\ube0c '
+         u'lambda closure monad parser macro type inference garbage '
+         u'collector compiler interpreter').split()
+
+
+def sentence(rand, length):
+    return u' '.join(rand.choice(words) for i in xrange(length)) + u'.'
+
+
+def markdown_body(rand):
+    """Makes a Markdown text with paragraphs, a list, a link and a code
+    block.
+
+    """
+    blocks = [u'## ' + sentence(rand, 3)]
+    for i in xrange(rand.randint(1, 4)):
+        blocks.append(u' '.join(sentence(rand, rand.randint(5, 15))
+                                for j in xrange(rand.randint(1, 4))))
+    blocks.append(u'\n'.join(u'- *{0}* [{1}](http://example.com/{2})'.format(
+        rand.choice(words), rand.choice(words), j
+    ) for j in xrange(rand.randint(2, 5))))
+    if rand.random() < 0.5:
+        blocks.append(u'    def f(x):\n        return x * 2')
+    return u'\n\n'.join(blocks)
+
+
+def bulk_seed(engine, posts=1000, users=None, comments_per_post=2,
+              deep_threads=5, deep_thread_size=300, apps=10,
+              random_seed=0, batch_size=5000):
+    """Fills the empty database with a realistic dataset of any size
+    through bulk inserts, much faster than :func:`seed()`. Users are
+    named ``user0``, ``user1``, ... and their passwords are ``password``.
+
+    Posts have Markdown bodies, and the numbers of their comments follow
+    an exponential distribution of ``comments_per_post`` mean. The
+    latest ``deep_threads`` posts get ``deep_thread_size`` comments each,
+    most of them nested deeply. ``user0`` owns ``apps`` third-party
+    applications.
+
+    :param engine: a database engine
+    :type engine: :class:`sqlalchemy.engine.base.Engine`
+    :param users: the number of users. ``posts // 100`` (at least 20) by
+                  default
+    :type users: :class:`int`
+    :returns: the :class:`dict` of ``'users'``, ``'posts'`` and
+              ``'comments'`` counts, the id of the most commented post as
+              ``'deep_post'``, and the key of the first application as
+              ``'app'``
+    :rtype: :class:`dict`
+
+    """
+    from langdev.user import User, Password
+    from langdev.forum import Post, Comment, path_segment
+    from langdev.thirdparty import Application
+    rand = random.Random(random_seed)
+    if users is None:
+        users = max(20, posts // 100)
+    # hashing is slow, and every user has the same password anyway
+    password_hash = Password.hash(u'password').hash_string
+    now = datetime.datetime.utcnow().replace(microsecond=0)
+    started_at = now - datetime.timedelta(minutes=10 * posts)
+    connection = engine.connect()
+    if engine.dialect.name == 'sqlite':
+        connection.execute('PRAGMA synchronous = OFF')
+    def insert(table, rows):
+        if rows:
+            with connection.begin():
+                connection.execute(table.insert(), rows)
+            del rows[:]
+    rows = []
+    for i in xrange(users):
+        rows.append({'id': i + 1, 'login': u'user{0}'.format(i),
+                     'name': u'\uc0ac\uc6a9\uc790 {0}'.format(i),
+                     'email': u'user{0}@example.com'.format(i),
+                     'url': u'', 'password_hash': password_hash,
+                     'created_at': started_at, 'hidden': False})
+        if len(rows) >= batch_size:
+            insert(User.__table__, rows)
+    insert(User.__table__, rows)
+    for i in xrange(apps):
+        rows.append({
+            'key': hashlib.md5('app{0}'.format(i)).hexdigest(),
+            'secret_key': hashlib.sha256('app{0}'.format(i)).hexdigest(),
+            'owner_id': 1, 'title': u'Application {0}'.format(i),
+            'description': sentence(rand, 10),
+            'url': u'http://example.com/', 'created_at': started_at
+        })
+    insert(Application.__table__, rows)
+    comment_rows = []
+    comment_id = 0
+    for i in xrange(posts):
+        post_id = i + 1
+        created_at = started_at + datetime.timedelta(minutes=10 * i)
+        rows.append({'id': post_id, 'author_id': rand.randint(1, users),
+                     'title': sentence(rand, rand.randint(2, 8)),
+                     'body': markdown_body(rand), 'sticky': i % 1000 == 0,
+                     'hidden': False, 'created_at': created_at,
+                     'modified_at': created_at})
+        deep = i >= posts - deep_threads
+        if deep:
+            count, nesting = deep_thread_size, 0.8
+        else:
+            count = int(rand.expovariate(1.0 / comments_per_post)) \
+                    if comments_per_post else 0
+            nesting = 0.3
+        thread = []
+        for j in xrange(count):
+            comment_id += 1
+            parent = None
+            if thread and rand.random() < nesting:
+                # deep threads mostly reply to recent comments
+                parent = thread[-1] if deep and rand.random() < 0.9 \
+                         else rand.choice(thread)
+            segment = path_segment(comment_id)
+            comment = {
+                'id': comment_id, 'post_id': post_id,
+                'parent_id': parent and parent['id'],
+                'author_id': rand.randint(1, users),
+                'body': sentence(rand, rand.randint(3, 30)), 'hidden': False,
+                'path': parent['path'] + segment if parent else segment,
+                'depth': parent['depth'] + 1 if parent else 0,
+                'created_at': created_at + datetime.timedelta(seconds=j + 1)
+            }
+            thread.append(comment)
+            comment_rows.append(comment)
+        if len(rows) >= batch_size:
+            insert(Post.__table__, rows)
+        if len(comment_rows) >= batch_size:
+            insert(Post.__table__, rows)
+            insert(Comment.__table__, comment_rows)
+    insert(Post.__table__, rows)
+    insert(Comment.__table__, comment_rows)
+    connection.close()
+    return {'users': users, 'posts': posts, 'comments': comment_id,
+            'deep_post': posts if deep_threads else 1,
+            'app': hashlib.md5('app0').hexdigest()}
+
+
+def percentile(sorted_values, p):
+    """Gets the ``p``-th percentile of ``sorted_values``.
+
+    .. sourcecode:: pycon
+
+       >>> percentile(range(1, 101), 50)
+       50
+       >>> percentile(range(1, 101), 99)
+       99
+
+    """
+    if not sorted_values:
+        return 0
+    index = int(round(p / 100.0 * len(sorted_values))) - 1
+    return sorted_values[max(0, min(index, len(sorted_values) - 1))]
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+""":mod:`compression` --- Database size and latency of compressed bodies
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Makes a dataset in which some posts and comments have very long bodies
+(pasted logs and code), stored as they are, and a copy of it migrated by
+:func:`langdev.forum.compress_bodies()`. Then it reports the database
+size and the latency of listing pages of both:
+
+.. sourcecode:: bash
+
+   $ python benchmarks/compression.py --posts 10000 --long-ratio 2
+
+``scan`` is building the post timeline, which reads every row of posts
+like other full scans do. SQLite stores long bodies in overflow pages
+that have to be read through to get columns after them.
+
+"""
+import os
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import contextlib
+from sqlalchemy.sql import bindparam
+import common
+import langdev.orm
+import langdev.web
+import langdev.timeline
+from langdev.forum import Post, Comment, compress_bodies
+
+HTML = 'text/html'
+JSON = 'application/json'
+
+#: Pages to request. Each is a tuple of the name, the path and the
+#: accepted type.
+pages = [
+    ('posts', '/posts/', HTML),
+    ('posts.summary', '/posts/?view=summary', HTML),
+    ('posts.json', '/posts/', JSON),
+    ('atom', '/posts/atom.xml', HTML),
+]
+
+LEVELS = u'DEBUG INFO INFO INFO WARNING ERROR'.split()
+MODULES = u'langdev.web langdev.forum sqlalchemy.engine werkzeug'.split()
+
+
+def long_body(rand, size):
+    """Makes a Markdown text of about ``size`` characters that mostly
+    consists of a pasted log and code.
+
+    """
+    lines = [common.sentence(rand, 10), u'']
+    length = 0
+    while length < size:
+        if rand.random() < 0.9:
+            line = u'    2011-10-{0:02} {1:02}:{2:02}:{3:02},{4:03} {5} ' \
+                   u'[{6}] GET /posts/{7} took {8}ms'.format(
+                rand.randint(1, 31), rand.randint(0, 23),
+                rand.randint(0, 59), rand.randint(0, 59),
+                rand.randint(0, 999), rand.choice(LEVELS),
+                rand.choice(MODULES), rand.randint(1, 100000),
+                rand.randint(1, 3000)
+            )
+        else:
+            line = u'    def f{0}(x):\n        return x * {1}'.format(
+                rand.randint(0, 100), rand.randint(0, 100)
+            )
+        lines.append(line)
+        length += len(line) + 1
+    lines.extend([u'', common.sentence(rand, 10)])
+    return u'\n'.join(lines)
+
+
+@contextlib.contextmanager
+def uncompressed():
+    """Stores bodies as they are in the context, as if they had been
+    written before compression.
+
+    """
+    types = [table.c.body.type for table in Post.__table__, Comment.__table__]
+    thresholds = [type_.threshold for type_ in types]
+    for type_ in types:
+        type_.threshold = float('inf')
+    try:
+        yield
+    finally:
+        for type_, threshold in zip(types, thresholds):
+            type_.threshold = threshold
+
+
+def make_dataset(path, posts, long_ratio, long_size, random_seed=0):
+    """Makes a dataset whose ``long_ratio`` percent of posts and comments
+    have long bodies stored as they are.
+
+    :returns: the numbers of long posts and long comments
+    :rtype: :class:`tuple`
+
+    """
+    url = 'sqlite:///' + path
+    app = common.make_app(url)
+    engine = langdev.web.get_database_engine(app.config)
+    rand = random.Random(random_seed)
+    result = []
+    with uncompressed():
+        counts = common.bulk_seed(engine, posts=posts,
+                                  random_seed=random_seed)
+        for table, count in (Post.__table__, counts['posts']), \
+                            (Comment.__table__, counts['comments']):
+            ids = rand.sample(xrange(1, count + 1),
+                              int(count * long_ratio / 100.0))
+            update = table.update() \
+                          .where(table.c.id == bindparam('row_id')) \
+                          .values(body=bindparam('row_body',
+                                                 type_=table.c.body.type))
+            with engine.begin() as connection:
+                for id in ids:
+                    body = long_body(rand, rand.randint(*long_size))
+                    connection.execute(update, row_id=id, row_body=body)
+            result.append(len(ids))
+    engine.execute('VACUUM')
+    engine.dispose()
+    return tuple(result)
+
+
+def compress(path):
+    """Compresses bodies of the dataset, and returns the number of
+    compressed rows and the elapsed seconds.
+
+    """
+    app = common.make_app('sqlite:///' + path)
+    engine = langdev.web.get_database_engine(app.config)
+    session = langdev.orm.Session(bind=engine)
+    started = time.time()
+    migrated = compress_bodies(session)
+    elapsed = time.time() - started
+    engine.execute('VACUUM')
+    engine.dispose()
+    return migrated, elapsed
+
+
+def measure(path, requests):
+    """Requests :data:`pages` of the dataset, and returns the :class:`dict`
+    of sorted latencies by page names, including ``'scan'``.
+
+    """
+    app = common.make_app('sqlite:///' + path)
+    engine = langdev.web.get_database_engine(app.config)
+    client = app.test_client()
+    results = {}
+    for name, path, accept in pages:
+        latencies = []
+        for i in xrange(requests + 5):
+            started = time.time()
+            response = client.get(path, headers={'Accept': accept})
+            latencies.append(time.time() - started)
+            assert response.status_code == 200, response.status_code
+        # the first requests warm up caches
+        results[name] = sorted(latencies[5:])
+    latencies = []
+    for i in xrange(max(requests // 10, 3)):
+        started = time.time()
+        langdev.timeline.Timeline().build(engine)
+        latencies.append(time.time() - started)
+    results['scan'] = sorted(latencies)
+    engine.dispose()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--posts', type=int, default=10000,
+                        help='the number of posts')
+    parser.add_argument('--long-ratio', type=float, default=2,
+                        help='the percentage of posts and comments that '
+                             'have long bodies')
+    parser.add_argument('--long-size', default='20000,200000',
+                        help='the minimum and the maximum characters of '
+                             'long bodies, separated by a comma')
+    parser.add_argument('--requests', type=int, default=50,
+                        help='the number of requests per page')
+    parser.add_argument('--data-dir', default=tempfile.gettempdir(),
+                        help='the directory to make datasets in')
+    args = parser.parse_args()
+    long_size = map(int, args.long_size.split(','))
+    before = os.path.join(args.data_dir, 'langdev-compression-before.sqlite')
+    after = os.path.join(args.data_dir, 'langdev-compression-after.sqlite')
+    for path in before, after:
+        if os.path.exists(path):
+            os.unlink(path)
+    print 'Making a dataset of {0} posts...'.format(args.posts)
+    long_posts, long_comments = make_dataset(before, args.posts,
+                                             args.long_ratio, long_size)
+    print '{0} posts and {1} comments have long bodies'.format(
+        long_posts, long_comments
+    )
+    shutil.copy(before, after)
+    migrated, elapsed = compress(after)
+    print '{0} bodies compressed in {1:.1f}s'.format(migrated, elapsed)
+    print
+    sizes = [os.path.getsize(path) for path in (before, after)]
+    print '{0:<22} {1:>12} {2:>12} {3:>8}'.format('', 'before', 'after',
+                                                  'change')
+    print '{0:<22} {1:>12} {2:>12} {3:>+7.1f}%'.format(
+        'size(KiB)', sizes[0] // 1024, sizes[1] // 1024,
+        (sizes[1] - sizes[0]) * 100.0 / sizes[0]
+    )
+    results = [measure(path, args.requests) for path in (before, after)]
+    for name in [name for name, path, accept in pages] + ['scan']:
+        p50s = [common.percentile(result[name], 50) * 1000
+                for result in results]
+        print '{0:<22} {1:>12.2f} {2:>12.2f} {3:>+7.1f}%'.format(
+            name + ' p50(ms)', p50s[0], p50s[1],
+            (p50s[1] - p50s[0]) * 100.0 / p50s[0]
+        )
+
+
+if __name__ == '__main__':
+    main()
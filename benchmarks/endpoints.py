@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+""":mod:`endpoints` --- Throughput and latency of key pages
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Requests key pages of datasets of each size, and reports requests per
+second, 50th/95th/99th percentile latency, and SQL queries per request.
+Datasets are made by :func:`common.bulk_seed()` at the first run, and
+reused from ``--data-dir`` after that, because a large one takes minutes
+to make:
+
+.. sourcecode:: bash
+
+   $ python benchmarks/endpoints.py --sizes 1000,100000,1000000 \\
+                                    --modes in-process,server
+
+Pages are requested in two modes. ``in-process`` goes through the Flask
+test client, so it measures the application only. ``server`` serves the
+application on a threaded WSGI server in the same process, and requests
+it through HTTP. ``--url`` requests an external server (e.g. one served
+by Meinheld on a dataset this script has made) instead; queries per
+request aren't counted then.
+
+"""
+import os
+import time
+import hmac
+import urllib
+import httplib
+import hashlib
+import argparse
+import tempfile
+import threading
+import itertools
+import urlparse
+import werkzeug.serving
+from sqlalchemy import event
+import common
+import langdev.web
+
+HTML = 'text/html'
+JSON = 'application/json'
+
+#: Pages to request. Each is a tuple of the name, the method, the path,
+#: the form data, the accepted type and the expected status code. Paths
+#: and data are formatted with ``{deep_post}``, the post having the most
+#: comments, ``{app}``, the key of a third-party application, and
+#: ``{sso_digest}`` and ``{sso_password}``, the digest of the password of
+#: ``user1`` and its signature by the application.
+endpoints = [
+    ('posts', 'GET', '/posts/', None, HTML, 200),
+    ('posts.summary', 'GET', '/posts/?view=summary', None, HTML, 200),
+    ('posts.json', 'GET', '/posts/', None, JSON, 200),
+    ('atom', 'GET', '/posts/atom.xml', None, HTML, 200),
+    ('post', 'GET', '/posts/{deep_post}', None, HTML, 200),
+    ('signin', 'POST', '/users/f/signin',
+     {'login': 'user1', 'password': 'password'}, HTML, 302),
+    ('sso', 'POST', '/apps/{app}/sso/user1',
+     {'password': '{sso_password}', 'digest': '{sso_digest}'}, JSON, 200),
+]
+
+
+class QuietRequestHandler(werkzeug.serving.WSGIRequestHandler):
+    """Doesn't log every request."""
+
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+class QueryCounter(object):
+    """Counts SQL statements executed through the ``engine``."""
+
+    def __init__(self, engine):
+        self.counter = itertools.count()
+        event.listen(engine, 'after_cursor_execute', self.count)
+
+    def count(self, *args):
+        next(self.counter)
+
+    @property
+    def value(self):
+        # itertools.count is atomic, so it is safe among threads
+        return next(self.counter)
+
+
+def dataset(data_dir, posts):
+    """Gets the database URL of the dataset of ``posts`` posts, and the
+    :func:`common.bulk_seed()` result. It's made if it doesn't exist yet.
+
+    """
+    path = os.path.join(data_dir, 'langdev-bench-{0}.sqlite'.format(posts))
+    url = 'sqlite:///' + path
+    if not os.path.exists(path):
+        print 'Making a dataset of {0} posts...'.format(posts)
+        app = common.make_app(url)
+        engine = langdev.web.get_database_engine(app.config)
+        common.bulk_seed(engine, posts=posts)
+        engine.dispose()
+    # bulk_seed() is deterministic, so the result is the same
+    secret_key = hashlib.sha256('app0').hexdigest()
+    sso_digest = hashlib.md5('password').hexdigest()
+    sso_password = hmac.new(secret_key, sso_digest, hashlib.sha1).hexdigest()
+    return url, {'deep_post': posts,
+                 'app': hashlib.md5('app0').hexdigest(),
+                 'sso_digest': sso_digest, 'sso_password': sso_password}
+
+
+def in_process_client(app):
+    client = app.test_client()
+    def request(method, path, data, accept):
+        response = client.open(path, method=method, data=data,
+                               headers={'Accept': accept})
+        return response.status_code
+    return request
+
+
+def http_client(base_url):
+    url = urlparse.urlparse(base_url)
+    def request(method, path, data, accept):
+        connection = httplib.HTTPConnection(url.hostname, url.port or 80)
+        headers = {'Accept': accept}
+        body = None
+        if data:
+            body = urllib.urlencode(data)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        connection.request(method, url.path.rstrip('/') + path, body,
+                           headers)
+        response = connection.getresponse()
+        response.read()
+        connection.close()
+        return response.status
+    return request
+
+
+def bench(make_client, endpoint, values, requests, concurrency):
+    """Requests the ``endpoint`` ``requests`` times through
+    ``concurrency`` clients, and returns the elapsed seconds and the
+    sorted latencies.
+
+    """
+    name, method, path, data, accept, status = endpoint
+    path = path.format(**values)
+    if data:
+        data = dict((k, v.format(**values)) for k, v in data.iteritems())
+    latencies = []
+    errors = []
+    def run(count):
+        request = make_client()
+        for i in xrange(count):
+            started = time.time()
+            code = request(method, path, data, accept)
+            latencies.append(time.time() - started)
+            if code != status:
+                errors.append(code)
+    # warm up caches and connection pools
+    run(min(5, requests))
+    del latencies[:]
+    threads = [threading.Thread(target=run, args=(requests // concurrency,))
+               for i in xrange(concurrency)]
+    started = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - started
+    if errors:
+        raise AssertionError('{0}: status {1}, not {2}'.format(
+            name, errors[0], status
+        ))
+    return elapsed, sorted(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', default='1000',
+                        help='comma-separated numbers of posts of datasets')
+    parser.add_argument('--modes', default='in-process,server',
+                        help='comma-separated modes: in-process, server')
+    parser.add_argument('--url',
+                        help='the URL of an external server to request '
+                             'instead. only one size can be given')
+    parser.add_argument('--endpoints',
+                        help='comma-separated names of pages. all by '
+                             'default')
+    parser.add_argument('--requests', type=int, default=200,
+                        help='the number of requests per page')
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help='the number of concurrent clients')
+    parser.add_argument('--data-dir', default=tempfile.gettempdir(),
+                        help='the directory to keep datasets in')
+    args = parser.parse_args()
+    sizes = map(int, args.sizes.split(','))
+    if args.url and len(sizes) > 1:
+        parser.error('--url takes only one size')
+    names = args.endpoints and args.endpoints.split(',')
+    selected = [e for e in endpoints if not names or e[0] in names]
+    print '{0:>8} {1:<10} {2:<14} {3:>8} {4:>8} {5:>8} {6:>8} {7:>7}'.format(
+        'posts', 'mode', 'page', 'req/s', 'p50(ms)', 'p95(ms)', 'p99(ms)',
+        'q/req'
+    )
+    for size in sizes:
+        url, values = dataset(args.data_dir, size)
+        if args.url:
+            modes = [('external', lambda: http_client(args.url))]
+            counter = None
+        else:
+            app = common.make_app(url)
+            engine = langdev.web.get_database_engine(app.config)
+            counter = QueryCounter(engine)
+            modes = []
+            for mode in args.modes.split(','):
+                if mode == 'in-process':
+                    modes.append((mode, lambda: in_process_client(app)))
+                elif mode == 'server':
+                    server = werkzeug.serving.make_server(
+                        '127.0.0.1', 0, app, threaded=True,
+                        request_handler=QuietRequestHandler
+                    )
+                    thread = threading.Thread(target=server.serve_forever)
+                    thread.daemon = True
+                    thread.start()
+                    base_url = 'http://127.0.0.1:{0}'.format(
+                        server.server_port
+                    )
+                    modes.append((mode, lambda: http_client(base_url)))
+                else:
+                    parser.error('unknown mode: ' + mode)
+        for mode, make_client in modes:
+            for endpoint in selected:
+                queries = counter and counter.value
+                elapsed, latencies = bench(make_client, endpoint, values,
+                                           args.requests, args.concurrency)
+                if counter:
+                    # the warming up requests are counted as well
+                    count = len(latencies) + min(5, args.requests)
+                    queries = '{0:.1f}'.format(
+                        (counter.value - queries - 1) / float(count)
+                    )
+                ms = lambda p: common.percentile(latencies, p) * 1000
+                print ('{0:>8} {1:<10} {2:<14} {3:>8.1f} {4:>8.1f} {5:>8.1f} '
+                       '{6:>8.1f} {7:>7}').format(
+                    size, mode, endpoint[0], len(latencies) / elapsed,
+                    ms(50), ms(95), ms(99), queries or '-'
+                )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+""":mod:`micro` --- Micro-benchmarks of pure-Python hot paths
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Times small functions that run on every request, and saves the results
+as a JSON file named after the current commit, so that they can be
+compared between commits:
+
+.. sourcecode:: bash
+
+   $ python benchmarks/micro.py run
+   $ git checkout feature-branch
+   $ python benchmarks/micro.py run
+   $ python benchmarks/micro.py compare benchmarks/results/1a2b3c4.json \\
+                                        benchmarks/results/5d6e7f8.json
+
+Each case is called in a loop long enough (``--min-time``) to be timed
+reliably, and the loop is repeated (``--repeat``) to report the fastest
+and the median time per call. The fastest is compared, since it is the
+least disturbed by other processes.
+
+Memory is measured per call as well. The number of objects left tracked
+by the garbage collector after a call is always counted, and the peak
+of allocated bytes is measured if :mod:`tracemalloc` is available.
+
+``compare`` flags cases that have become slower than ``--threshold``
+percent, or that retain more objects, and exits with 1 if any.
+
+"""
+import gc
+import os
+import sys
+import json
+import time
+import timeit
+import datetime
+import argparse
+import subprocess
+import common
+import langdev.objsimplify
+import langdev.util.visitor
+import langdev.web.pager
+import langdev.web.wsgi
+from langdev.user import User, Password
+from langdev.forum import Post
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+#: The directory that results are saved in by default.
+results_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'results')
+
+#: Registered cases in order. Each is a pair of the name and the function
+#: that sets up the case and returns the function to time.
+cases = []
+
+
+def case(name):
+    """Registers a set up function as a case named ``name``."""
+    def decorate(function):
+        cases.append((name, function))
+        return function
+    return decorate
+
+
+@case('visitor dispatch')
+def visitor_dispatch():
+    visitor = langdev.util.visitor.Visitor('visitor')
+    @visitor.visit(int)
+    def visitor(value):
+        return value
+    @visitor.visit(basestring)
+    def visitor(value):
+        return value
+    # unicode is found through the MRO, as most visited values are
+    return lambda: visitor(u'value')
+
+
+def simplify_payload():
+    now = datetime.datetime(2011, 10, 1, 12, 30)
+    author = langdev.objsimplify.Result({
+        'ID': 1, 'login': u'dahlia', 'name': u'\ud64d\ubbfc\ud76c',
+        'url': u'http://dahlia.kr/', 'created at': now,
+        'posts count': 100, 'comments count': 1000
+    })
+    return [langdev.objsimplify.Result({
+        'ID': i, 'author': author, 'title': u'Post {0}'.format(i),
+        'sticky': False, 'created at': now, 'modified at': now,
+        'comments count': 10, 'replies count': 5
+    }) for i in xrange(20)]
+
+
+def simplify_case(identifier_map):
+    payload = simplify_payload()
+    type_map = {datetime.datetime: datetime.datetime.isoformat}
+    return lambda: langdev.objsimplify.simplify(
+        payload, identifier_map=identifier_map, type_map=type_map
+    )
+
+
+@case('simplify camelCase')
+def simplify_camel_case():
+    return simplify_case(langdev.objsimplify.camelCase)
+
+
+@case('simplify PascalCase')
+def simplify_pascal_case():
+    return simplify_case(langdev.objsimplify.PascalCase)
+
+
+@case('Pager.__iter__')
+def pager_iter():
+    pager = langdev.web.pager.Pager(100, 50)
+    return lambda: list(pager)
+
+
+@case('Post.body_html')
+def post_body_html():
+    import random
+    post = Post(body=common.markdown_body(random.Random(0)))
+    return lambda: post.body_html
+
+
+@case('Password.__eq__')
+def password_eq():
+    password = Password.hash(u'password', cost=1000)
+    return lambda: password == u'password'
+
+
+@case('Password.__eq__ legacy')
+def password_eq_legacy():
+    password = Password(Password.digest(u'password'))
+    return lambda: password == u'password'
+
+
+@case('User.LOGIN_PATTERN')
+def login_pattern():
+    match = User.LOGIN_PATTERN.match
+    return lambda: match(u'\ud64d\ubbfc\ud76c-dahlia_2011')
+
+
+@case('User.EMAIL_PATTERN')
+def email_pattern():
+    match = User.EMAIL_PATTERN.match
+    return lambda: match(u'hong.minhee+langdev@gmail.example.com')
+
+
+@case('MethodRewriteMiddleware')
+def method_rewrite_middleware():
+    application = lambda environ, start_response: environ
+    middleware = langdev.web.wsgi.MethodRewriteMiddleware(application)
+    environ = {'REQUEST_METHOD': 'POST', 'QUERY_STRING': '__method__=PUT'}
+    return lambda: middleware(dict(environ), None)
+
+
+def measure(function, repeat, min_time):
+    """Times the ``function``.
+
+    :returns: the :class:`dict` of the fastest and the median seconds per
+              call, the number of calls per loop, objects retained per
+              call and peak allocated bytes per call (``None`` if
+              :mod:`tracemalloc` is unavailable)
+    :rtype: :class:`dict`
+
+    """
+    timer = timeit.Timer(function)
+    number = 1
+    while timer.timeit(number) < min_time:
+        number *= 2
+    times = sorted(t / number for t in timer.repeat(repeat, number))
+    calls = 1000
+    gc.collect()
+    objects = len(gc.get_objects())
+    for i in xrange(calls):
+        function()
+    gc.collect()
+    # the list made by the first get_objects() call is counted as well
+    retained = (len(gc.get_objects()) - objects - 1) / float(calls)
+    peak = None
+    if tracemalloc is not None:
+        tracing = tracemalloc.is_tracing()
+        if not tracing:
+            tracemalloc.start()
+        peaks = []
+        for i in xrange(min(calls, 100)):
+            tracemalloc.clear_traces()
+            function()
+            peaks.append(tracemalloc.get_traced_memory()[1])
+        if not tracing:
+            tracemalloc.stop()
+        peak = sorted(peaks)[len(peaks) // 2]
+    return {'best': times[0], 'median': times[len(times) // 2],
+            'number': number, 'retained_objects': max(retained, 0),
+            'peak_bytes': peak}
+
+
+def current_commit():
+    """Gets the abbreviated hash of the current commit. It is suffixed by
+    ``-dirty`` if there are uncommitted changes.
+
+    """
+    directory = os.path.dirname(os.path.abspath(__file__))
+    def git(*args):
+        return subprocess.Popen(('git',) + args, cwd=directory,
+                                stdout=subprocess.PIPE).communicate()[0]
+    commit = git('rev-parse', '--short', 'HEAD').strip() or 'unknown'
+    if git('status', '--porcelain', '--untracked-files=no').strip():
+        commit += '-dirty'
+    return commit
+
+
+def run(args):
+    commit = current_commit()
+    results = {}
+    print '{0:<26} {1:>12} {2:>12} {3:>9} {4:>10}'.format(
+        'case', 'best(us)', 'median(us)', 'objects', 'peak(B)'
+    )
+    for name, setup in cases:
+        if args.cases and name not in args.cases:
+            continue
+        result = measure(setup(), args.repeat, args.min_time)
+        results[name] = result
+        print '{0:<26} {1:>12.3f} {2:>12.3f} {3:>9.2f} {4:>10}'.format(
+            name, result['best'] * 1e6, result['median'] * 1e6,
+            result['retained_objects'],
+            '-' if result['peak_bytes'] is None else result['peak_bytes']
+        )
+    output = args.output or os.path.join(results_dir, commit + '.json')
+    directory = os.path.dirname(os.path.abspath(output))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(output, 'w') as f:
+        json.dump({'commit': commit, 'python': sys.version.split()[0],
+                   'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                   'results': results}, f, indent=2, sort_keys=True)
+    print 'Saved into', output
+
+
+def compare(args):
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    print '{0} ({1}) -> {2} ({3})'.format(old['commit'], old['python'],
+                                          new['commit'], new['python'])
+    print '{0:<26} {1:>12} {2:>12} {3:>8}'.format('case', 'old(us)',
+                                                  'new(us)', 'change')
+    regressions = 0
+    for name in sorted(set(old['results']) & set(new['results'])):
+        before = old['results'][name]
+        after = new['results'][name]
+        change = (after['best'] - before['best']) / before['best'] * 100
+        flags = []
+        if change > args.threshold:
+            flags.append('SLOWER')
+        if after['retained_objects'] > before['retained_objects'] + 0.01:
+            flags.append('RETAINS MORE')
+        if flags:
+            regressions += 1
+        print '{0:<26} {1:>12.3f} {2:>12.3f} {3:>+7.1f}%  {4}'.format(
+            name, before['best'] * 1e6, after['best'] * 1e6, change,
+            ', '.join(flags)
+        )
+    if regressions:
+        print '{0} regressions'.format(regressions)
+        raise SystemExit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    subparsers = parser.add_subparsers()
+    run_parser = subparsers.add_parser('run', help='run benchmarks')
+    run_parser.add_argument('cases', nargs='*',
+                            help='names of cases to run. all by default')
+    run_parser.add_argument('--repeat', type=int, default=7,
+                            help='the number of timing loops')
+    run_parser.add_argument('--min-time', type=float, default=0.2,
+                            help='the minimum seconds of a timing loop')
+    run_parser.add_argument('-o', '--output',
+                            help='the file to save results into. '
+                                 'results/<commit>.json by default')
+    run_parser.set_defaults(function=run)
+    compare_parser = subparsers.add_parser('compare',
+                                           help='compare two results')
+    compare_parser.add_argument('old', help='the older results file')
+    compare_parser.add_argument('new', help='the newer results file')
+    compare_parser.add_argument('--threshold', type=float, default=10,
+                                help='the percentage of slowdown to flag')
+    compare_parser.set_defaults(function=compare)
+    args = parser.parse_args()
+    args.function(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+""":mod:`password_hashing` --- Sign-in throughput by password hash cost
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Measures sign-in requests per second and latency at each
+``PASSWORD_HASH_COST``, so that we can pick the cost that keeps sign-in
+latency acceptable:
+
+.. sourcecode:: bash
+
+   $ python benchmarks/password_hashing.py --costs 1000,10000,100000 \\
+                                           --clients 8 --workers 4
+
+"""
+import time
+import argparse
+import threading
+import common
+import langdev.orm
+import langdev.web
+from langdev.user import User, Password
+
+
+def bench(cost, clients, workers, requests):
+    """Runs ``requests`` sign-in requests through ``clients`` concurrent
+    clients, and returns the elapsed seconds and the sorted latencies.
+
+    """
+    app = common.make_app(common.temporary_database_url(),
+                          PASSWORD_HASH_COST=cost,
+                          PASSWORD_HASH_WORKERS=workers)
+    engine = langdev.web.get_database_engine(app.config)
+    session = langdev.orm.Session(bind=engine)
+    with session.begin():
+        session.add(User(login=u'bench', name=u'Bench', password=u'secret'))
+    data = {'login': 'bench', 'password': 'secret'}
+    latencies = []
+    per_client = requests // clients
+    def run():
+        client = app.test_client()
+        for i in xrange(per_client):
+            started = time.time()
+            response = client.post('/users/f/signin', data=data,
+                                   headers={'Accept': 'text/html'})
+            latencies.append(time.time() - started)
+            assert response.status_code == 302, response.status_code
+    threads = [threading.Thread(target=run) for i in xrange(clients)]
+    started = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - started
+    engine.dispose()
+    return elapsed, sorted(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--costs', default='1000,10000,50000,100000',
+                        help='comma-separated PBKDF2 iteration counts')
+    parser.add_argument('--clients', type=int, default=8,
+                        help='the number of concurrent clients')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='the number of hashing threads')
+    parser.add_argument('--requests', type=int, default=200,
+                        help='the number of sign-in requests per cost')
+    args = parser.parse_args()
+    print '{0:>8} {1:>10} {2:>8} {3:>8} {4:>8} {5:>8}'.format(
+        'cost', 'hash(ms)', 'req/s', 'p50(ms)', 'p95(ms)', 'p99(ms)'
+    )
+    for cost in map(int, args.costs.split(',')):
+        started = time.time()
+        Password.hash('secret', cost)
+        hash_time = time.time() - started
+        elapsed, latencies = bench(cost, args.clients, args.workers,
+                                   args.requests)
+        ms = lambda p: common.percentile(latencies, p) * 1000
+        row = '{0:>8} {1:>10.2f} {2:>8.1f} {3:>8.1f} {4:>8.1f} {5:>8.1f}'
+        print row.format(cost, hash_time * 1000, len(latencies) / elapsed,
+                         ms(50), ms(95), ms(99))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+""":mod:`query_plans` --- Query plan regression checks
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Seeds a SQLite database, requests every page through the Flask test
+client, and captures each SQL statement with its ``EXPLAIN QUERY PLAN``.
+It fails when a page runs more queries than its limit, or when
+``posts``, ``comments`` or ``users`` table is fully scanned.
+
+Captured statements and plans are compared with golden files in
+:file:`benchmarks/query_plans/`, so that changes of queries are reviewed
+with the code that causes them. Plans depend on the SQLite version, so
+golden files should be updated with the version CI uses. Rewrite golden
+files with ``--update`` after checking the differences:
+
+.. sourcecode:: bash
+
+   $ python benchmarks/query_plans.py
+   $ python benchmarks/query_plans.py --update forum.post
+
+The query limit of a page is the ``max queries:`` line of its golden file.
+``--update`` sets it to the current number of queries; lower it by hand
+to make the check stricter.
+
+"""
+import os
+import re
+import hmac
+import hashlib
+import difflib
+import argparse
+from sqlalchemy import event
+from sqlalchemy.sql import functions
+import common
+import langdev.orm
+import langdev.web
+from langdev.forum import Post, Comment
+from langdev.thirdparty import Application
+
+
+#: The directory of golden files.
+golden_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'query_plans')
+
+#: Tables that must not be fully scanned.
+guarded_tables = 'posts', 'comments', 'users'
+
+HTML = 'text/html'
+JSON = 'application/json'
+
+#: Pages to check, in order. Each is a tuple of the name, the method, the
+#: path, the form data and the accepted type. Paths and data are formatted
+#: with ids of seeded objects; ``{post}`` and ``{comment}`` are of the most
+#: commented post, and ``{own_post}`` is of the signed in user's.
+#: ``{sso_digest}`` is the digest of the password of users, and
+#: ``{sso_password}`` is its signature by ``{app}``. Pages that write come
+#: last.
+endpoints = [
+    ('home.main', 'GET', '/', None, HTML),
+    ('forum.posts', 'GET', '/posts/', None, HTML),
+    ('forum.posts.summary', 'GET', '/posts/?view=summary', None, HTML),
+    ('forum.posts.json', 'GET', '/posts/', None, JSON),
+    ('forum.atom', 'GET', '/posts/atom.xml', None, HTML),
+    ('forum.post', 'GET', '/posts/{post}', None, HTML),
+    ('forum.post.json', 'GET', '/posts/{post}', None, JSON),
+    ('forum.replies', 'GET', '/posts/{post}/replies?after={comment}', None,
+     HTML),
+    ('forum.replies.comment', 'GET', '/posts/{post}/{comment}/replies', None,
+     HTML),
+    ('forum.replies.json', 'GET', '/posts/{post}/{comment}/replies', None,
+     JSON),
+    ('forum.comment.json', 'GET', '/posts/{post}/{comment}', None, JSON),
+    ('forum.changes.json', 'GET', '/posts/changes?since=100', None, JSON),
+    ('forum.write_form', 'GET', '/posts/write', None, HTML),
+    ('forum.edit_form', 'GET', '/posts/{own_post}/edit', None, HTML),
+    ('user.profile', 'GET', '/users/user1', None, HTML),
+    ('user.profile.json', 'GET', '/users/user1', None, JSON),
+    ('user.posts', 'GET', '/users/user1/posts', None, HTML),
+    ('user.signin_form', 'GET', '/users/f/signin', None, HTML),
+    ('thirdparty.app', 'GET', '/apps/{app}', None, HTML),
+    ('thirdparty.sso', 'POST', '/apps/{app}/sso/user1',
+     {'password': '{sso_password}', 'digest': '{sso_digest}'}, JSON),
+    ('thirdparty.sso_batch', 'POST', '/apps/{app}/sso',
+     {'login': ['user1', 'user2@example.com', 'nobody'],
+      'password': ['{sso_password}'] * 3,
+      'digest': ['{sso_digest}'] * 3}, JSON),
+    ('forum.write', 'POST', '/posts/',
+     {'title': 'New post', 'body': 'Body', 'sticky': ''}, HTML),
+    ('forum.write_comment', 'POST', '/posts/{post}',
+     {'body': 'Reply', 'parent_id': '{comment}'}, HTML),
+    ('forum.edit', 'PUT', '/posts/{own_post}',
+     {'title': 'Edited', 'body': 'Edited body', 'sticky': ''}, HTML),
+]
+
+
+class Recorder(object):
+    """Captures SQL statements executed through the ``engine`` and their
+    query plans while :attr:`recording` is ``True``.
+
+    """
+
+    def __init__(self, engine):
+        self.recording = False
+        self.statements = []
+        event.listen(engine, 'after_cursor_execute', self.capture)
+
+    def capture(self, conn, cursor, statement, parameters, context,
+                executemany):
+        if not self.recording:
+            return
+        plan = []
+        if not executemany and re.match(r'^\s*(SELECT|INSERT|UPDATE|DELETE)',
+                                        statement, re.IGNORECASE):
+            explain = conn.connection.cursor()
+            explain.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+            plan = [tuple(row)[-1] for row in explain.fetchall()]
+        self.statements.append((normalize_sql(statement),
+                                map(normalize_plan, plan)))
+
+
+def normalize_sql(statement):
+    """Makes the ``statement`` comparable between runs.
+
+    .. sourcecode:: pycon
+
+       >>> normalize_sql('SELECT a\\nFROM t WHERE id IN (?, ?, ?)')
+       'SELECT a FROM t WHERE id IN (?...)'
+
+    """
+    statement = ' '.join(statement.split())
+    return re.sub(r'\?(, \?)+', '?...', statement)
+
+
+def normalize_plan(line):
+    """Makes the plan ``line`` comparable between SQLite versions.
+
+    .. sourcecode:: pycon
+
+       >>> normalize_plan('SCAN TABLE posts USING INDEX ix_posts_sticky')
+       'SCAN posts USING INDEX ix_posts_sticky'
+
+    """
+    return re.sub(r'^(SCAN|SEARCH) TABLE ', r'\1 ', line)
+
+
+def full_scans(statements):
+    """Finds full scans on :data:`guarded_tables`."""
+    scans = []
+    for statement, plan in statements:
+        for warning in langdev.orm.plan_warnings(plan):
+            match = re.match(r'^full scan: SCAN (\w+)', warning)
+            if match and match.group(1) in guarded_tables:
+                scans.append((statement, warning))
+    return scans
+
+
+def format_golden(method, path, accept, statements, max_queries):
+    """Formats a golden file. The same statements are listed once in
+    the order of their first execution, with the number of executions.
+
+    """
+    lines = ['# {0} {1} ({2})'.format(method, path, accept),
+             'max queries: {0}'.format(max_queries)]
+    counts = {}
+    unique = []
+    for statement, plan in statements:
+        key = statement, tuple(plan)
+        if key not in counts:
+            counts[key] = 0
+            unique.append(key)
+        counts[key] += 1
+    for key in unique:
+        statement, plan = key
+        lines.append('')
+        lines.append('[{0}x] {1}'.format(counts[key], statement))
+        lines.extend('    ' + line for line in plan)
+    return '\n'.join(lines) + '\n'
+
+
+def read_max_queries(golden):
+    match = re.search(r'^max queries: (\d+)$', golden, re.MULTILINE)
+    return int(match.group(1)) if match else None
+
+
+def run(names=None, update=False):
+    """Requests pages and checks their queries. Returns the number of
+    failed pages.
+
+    """
+    # listings check the post timeline for changes on every request, so
+    # that they record the same queries however fast pages are requested
+    app = common.make_app(common.temporary_database_url(),
+                          TIMELINE_REFRESH_INTERVAL=0)
+    engine = langdev.web.get_database_engine(app.config)
+    session = langdev.orm.Session(bind=engine)
+    ids = common.seed(session)
+    post_id, = session.query(Comment.post_id) \
+                      .group_by(Comment.post_id) \
+                      .order_by(functions.count(Comment.id).desc(),
+                                Comment.post_id) \
+                      .first()
+    comment_id, = session.query(Comment.id) \
+                         .filter_by(post_id=post_id, parent_id=None) \
+                         .order_by(Comment.id) \
+                         .first()
+    own_post_id, = session.query(Post.id) \
+                          .filter_by(author_id=ids['users'][0]) \
+                          .first()
+    app_secret_key, = session.query(Application.secret_key) \
+                             .filter_by(key=ids['app']) \
+                             .one()
+    sso_digest = hashlib.md5('password').hexdigest()
+    sso_password = hmac.new(str(app_secret_key), sso_digest,
+                            hashlib.sha1).hexdigest()
+    values = {'post': post_id, 'comment': comment_id,
+              'own_post': own_post_id, 'app': ids['app'],
+              'sso_digest': sso_digest, 'sso_password': sso_password}
+    client = app.test_client()
+    response = client.post('/users/f/signin',
+                           data={'login': 'user0', 'password': 'password'},
+                           headers={'Accept': HTML})
+    assert response.status_code == 302, response.status_code
+    recorder = Recorder(engine)
+    failures = 0
+    for name, method, path, data, accept in endpoints:
+        if names and name not in names:
+            continue
+        if data:
+            data = dict((key, [v.format(**values) for v in value]
+                              if isinstance(value, list)
+                              else value.format(**values))
+                        for key, value in data.iteritems())
+        recorder.statements = []
+        recorder.recording = True
+        try:
+            response = client.open(path.format(**values), method=method,
+                                   data=data, headers={'Accept': accept})
+        finally:
+            recorder.recording = False
+        statements = recorder.statements
+        problems = []
+        if response.status_code >= 400:
+            problems.append('status {0}'.format(response.status_code))
+        for statement, warning in full_scans(statements):
+            problems.append('{0}\n        {1}'.format(warning, statement))
+        golden_path = os.path.join(golden_dir, name + '.txt')
+        try:
+            with open(golden_path) as f:
+                golden = f.read()
+        except IOError:
+            golden = None
+        if update or golden is None:
+            max_queries = len(statements)
+        else:
+            max_queries = read_max_queries(golden)
+        current = format_golden(method, path, accept, statements,
+                                max_queries)
+        if update:
+            with open(golden_path, 'w') as f:
+                f.write(current)
+        elif golden is None:
+            problems.append('no golden file; run with --update')
+        else:
+            if len(statements) > max_queries:
+                problems.append('{0} queries; the limit is {1}'.format(
+                    len(statements), max_queries
+                ))
+            if current != golden:
+                diff = difflib.unified_diff(golden.splitlines(),
+                                            current.splitlines(),
+                                            'golden', 'current', lineterm='')
+                problems.append('differs from the golden file\n' +
+                                '\n'.join('        ' + l for l in diff))
+        status = 'FAIL' if problems else 'ok'
+        print '{0:<28} {1:>3} queries  {2}'.format(name, len(statements),
+                                                   status)
+        for problem in problems:
+            print '    ' + problem
+        if problems:
+            failures += 1
+    engine.dispose()
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('names', nargs='*',
+                        help='names of pages to check. all by default')
+    parser.add_argument('--update', action='store_true',
+                        help='rewrite golden files')
+    args = parser.parse_args()
+    if not os.path.isdir(golden_dir):
+        os.makedirs(golden_dir)
+    failures = run(args.names, args.update)
+    if failures:
+        print '{0} pages failed'.format(failures)
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+""":mod:`seed` --- Synthetic dataset generator
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Makes a SQLite database filled with a realistic dataset of the given
+size, for benchmarks and for trying pages with a lot of content:
+
+.. sourcecode:: bash
+
+   $ python benchmarks/seed.py --posts 100000 /tmp/langdev-100k.sqlite
+
+"""
+import os
+import time
+import argparse
+import common
+import langdev.web
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('path', help='the SQLite database file to make')
+    parser.add_argument('--posts', type=int, default=1000,
+                        help='the number of posts')
+    parser.add_argument('--users', type=int,
+                        help='the number of users. 1% of posts by default')
+    parser.add_argument('--comments-per-post', type=float, default=2,
+                        help='the mean number of comments per post')
+    parser.add_argument('--deep-threads', type=int, default=5,
+                        help='the number of posts with deep comment trees')
+    parser.add_argument('--deep-thread-size', type=int, default=300,
+                        help='the number of comments of each deep tree')
+    parser.add_argument('--apps', type=int, default=10,
+                        help='the number of third-party applications')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='the random seed')
+    args = parser.parse_args()
+    if os.path.exists(args.path):
+        parser.error(args.path + ' already exists')
+    app = common.make_app('sqlite:///' + os.path.abspath(args.path))
+    engine = langdev.web.get_database_engine(app.config)
+    started = time.time()
+    counts = common.bulk_seed(engine, posts=args.posts, users=args.users,
+                              comments_per_post=args.comments_per_post,
+                              deep_threads=args.deep_threads,
+                              deep_thread_size=args.deep_thread_size,
+                              apps=args.apps, random_seed=args.seed)
+    print '{0} users, {1} posts, {2} comments in {3:.1f}s'.format(
+        counts['users'], counts['posts'], counts['comments'],
+        time.time() - started
+    )
+
+
+if __name__ == '__main__':
+    main()
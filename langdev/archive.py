@@ -0,0 +1,355 @@
+""":mod:`langdev.archive` --- Archive of old posts
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+The ``posts`` and ``comments`` tables grow forever, while nearly all reads
+hit recent posts. :class:`Archive` moves posts that nobody has touched for
+a while out of them with their whole comment threads, so that the tables
+and their indexes stay small enough to be cached.
+
+Archived posts are kept in tables of the same schema: in a separate
+database file on SQLite, or in a separate schema on PostgreSQL.
+:attr:`Archive.engine` reads ``posts`` and ``comments`` from the archive
+and other tables e.g. ``users`` from the database, so the same mapped
+classes and queries work for archived posts through a session bound to
+it::
+
+    archive = Archive(engine, '/var/lib/langdev/archive.sqlite')
+    archive.upgrade()
+    archive.move(datetime.datetime.utcnow() - datetime.timedelta(days=365))
+    session = langdev.orm.Session(bind=archive.engine)
+    post = session.query(Post).get(post_id)
+
+Archived posts are read-only. :meth:`Archive.restore()` moves posts back
+to change them.
+
+.. seealso:: :program:`manage_langdev.py archive`
+
+"""
+import contextlib
+import sqlalchemy
+from sqlalchemy import event
+from sqlalchemy.sql import select, exists, text
+import langdev.orm
+from langdev.forum import Post, Comment, load_post_entries, count_authored
+
+__all__ = 'BATCH_SIZE', 'TABLES', 'Archive', 'add_author_counts'
+
+
+#: The number of posts to move per transaction, with their comments.
+BATCH_SIZE = 100
+
+#: The archived tables, parents first.
+TABLES = Post.__table__, Comment.__table__
+
+
+class Archive(object):
+    """Posts moved out of the database.
+
+    :param bind: the database engine
+    :type bind: :class:`sqlalchemy.engine.base.Engine`
+    :param location: the path of the archive database file on SQLite, or
+                     the name of the archive schema on PostgreSQL
+    :type location: :class:`basestring`
+
+    """
+
+    #: The name that the archive database file is attached as on SQLite.
+    ATTACHED_NAME = 'archive'
+
+    def __init__(self, bind, location):
+        dialect = bind.dialect.name
+        if dialect == 'sqlite':
+            database = bind.url.database
+            if not database or database == ':memory:':
+                raise ValueError('in-memory databases cannot be archived')
+            schema = self.ATTACHED_NAME
+            engine = sqlalchemy.create_engine('sqlite:///' + location)
+            @event.listens_for(engine, 'connect')
+            def attach(dbapi_connection, connection_record):
+                dbapi_connection.execute('ATTACH DATABASE ? AS hot',
+                                         (database,))
+        elif dialect == 'postgresql':
+            schema = location
+            options = '-c search_path={0},public'.format(location)
+            engine = sqlalchemy.create_engine(
+                bind.url, connect_args={'options': options}
+            )
+        else:
+            raise ValueError(dialect + ' databases cannot be archived')
+        #: (:class:`sqlalchemy.engine.base.Engine`) The database engine.
+        self.bind = bind
+        self.location = location
+        #: The name of the schema that :meth:`connect()` has the archive
+        #: tables in.
+        self.schema = schema
+        #: (:class:`sqlalchemy.engine.base.Engine`) The engine whose
+        #: ``posts`` and ``comments`` are archived ones. Other tables are
+        #: of :attr:`bind`.
+        self.engine = engine
+
+    @contextlib.contextmanager
+    def connect(self):
+        """Connects to :attr:`bind` with the archive tables in
+        :attr:`schema`, e.g. ``archive.posts``.
+
+        """
+        sqlite = self.bind.dialect.name == 'sqlite'
+        connection = self.bind.connect()
+        try:
+            if sqlite:
+                connection.execute('ATTACH DATABASE ? AS ' + self.schema,
+                                   self.location)
+            try:
+                yield connection
+            finally:
+                if sqlite:
+                    connection.execute('DETACH DATABASE ' + self.schema)
+        finally:
+            connection.close()
+
+    def upgrade(self):
+        """Creates the archive tables, or adds columns and indexes that
+        the database has got since.
+
+        :returns: the list of applied changes in strings
+        :rtype: :class:`list`
+
+        .. seealso:: Function :func:`langdev.orm.upgrade_schema()`
+
+        """
+        changes = []
+        if self.bind.dialect.name == 'postgresql':
+            found = self.bind.scalar(
+                text('SELECT count(*) FROM information_schema.schemata '
+                     'WHERE schema_name = :schema'),
+                schema=self.schema
+            )
+            if not found:
+                preparer = self.bind.dialect.identifier_preparer
+                self.bind.execute('CREATE SCHEMA ' +
+                                  preparer.quote_schema(self.schema, None))
+                changes.append('create schema ' + self.schema)
+        changes.extend(langdev.orm.upgrade_schema(self.engine, tables=TABLES))
+        filled = langdev.orm.fill_modified_at(
+            langdev.orm.Session(bind=self.engine), TABLES
+        )
+        if filled:
+            changes.append('fill modified_at of {0} rows'.format(filled))
+        return changes
+
+    def transfer(self, connection, post_ids, source, target):
+        """Moves posts and their comments between the database and the
+        archive in the transaction of the ``connection``. Rows already in
+        the ``target`` are replaced, so that it can be retried.
+
+        :param connection: a connection made by :meth:`connect()`
+        :param post_ids: ids of posts to move
+        :type post_ids: :class:`collections.Iterable`
+        :param source: the schema to move from. ``None`` for the database
+        :type source: :class:`basestring`
+        :param target: the schema to move to. ``None`` for the database
+        :type target: :class:`basestring`
+
+        """
+        ids = ', '.join(str(int(id)) for id in post_ids)
+        columns = [(table, 'id' if table is Post.__table__ else 'post_id')
+                   for table in TABLES]
+        def qualify(schema, table):
+            return table.name if schema is None else schema + '.' + table.name
+        for table, column in reversed(columns):
+            connection.execute('DELETE FROM {0} WHERE {1} IN ({2})'.format(
+                qualify(target, table), column, ids
+            ))
+        for table, column in columns:
+            names = ', '.join(c.name for c in table.columns)
+            connection.execute(
+                'INSERT INTO {0} ({1}) SELECT {1} FROM {2} '
+                'WHERE {3} IN ({4})'.format(qualify(target, table), names,
+                                            qualify(source, table),
+                                            column, ids)
+            )
+        for table, column in reversed(columns):
+            connection.execute('DELETE FROM {0} WHERE {1} IN ({2})'.format(
+                qualify(source, table), column, ids
+            ))
+
+    def move(self, before, batch_size=BATCH_SIZE):
+        """Moves posts that have been neither modified nor commented on
+        since ``before`` to the archive with their comments, ``batch_size``
+        posts per transaction. Hidden posts and posts that have hidden
+        comments are left until they are purged.
+
+        :param before: the time since which moved posts are inactive
+        :type before: :class:`datetime.datetime`
+        :param batch_size: the number of posts to move per transaction
+        :type batch_size: :class:`int`
+        :returns: the number of moved posts
+        :rtype: :class:`int`
+
+        """
+        posts, comments = TABLES
+        active = exists([comments.c.id],
+                        (comments.c.post_id == posts.c.id) &
+                        ((comments.c.created_at >= before) |
+                         (comments.c.hidden == True)))
+        query = select([posts.c.id],
+                       (posts.c.hidden == False) &
+                       (posts.c.created_at < before) &
+                       (posts.c.modified_at < before) & ~active) \
+                .order_by(posts.c.created_at) \
+                .limit(batch_size)
+        moved = 0
+        with self.connect() as connection:
+            while True:
+                with connection.begin():
+                    ids = [id for id, in connection.execute(query)]
+                    if ids:
+                        self.transfer(connection, ids, None, self.schema)
+                if not ids:
+                    return moved
+                moved += len(ids)
+
+    def restore(self, post_ids):
+        """Moves archived posts back to the database with their comments,
+        e.g. to change them.
+
+        :param post_ids: ids of posts to restore. ids that aren't archived
+                         are ignored
+        :type post_ids: :class:`collections.Iterable`
+        :returns: the number of restored posts
+        :rtype: :class:`int`
+
+        """
+        post_ids = list(post_ids)
+        restored = 0
+        with self.connect() as connection:
+            for i in xrange(0, len(post_ids), BATCH_SIZE):
+                batch = ', '.join(str(int(id))
+                                  for id in post_ids[i:i + BATCH_SIZE])
+                with connection.begin():
+                    ids = [id for id, in connection.execute(
+                        'SELECT id FROM {0}.posts WHERE id IN ({1})'.format(
+                            self.schema, batch
+                        )
+                    )]
+                    if ids:
+                        self.transfer(connection, ids, self.schema, None)
+                restored += len(ids)
+        return restored
+
+    def restore_user(self, user_id):
+        """Moves archived posts that the user has written or commented on
+        back to the database, e.g. to purge the user.
+
+        :param user_id: the :attr:`~langdev.user.User.id` of the user
+        :type user_id: :class:`int`
+        :returns: the number of restored posts
+        :rtype: :class:`int`
+
+        """
+        posts, comments = TABLES
+        query = select([posts.c.id], posts.c.author_id == user_id).union(
+            select([comments.c.post_id], comments.c.author_id == user_id)
+        )
+        return self.restore([id for id, in self.engine.execute(query)])
+
+    def count_authored(self, user_ids):
+        """Counts posts and comments that users have written in both the
+        database and the archive, as
+        :func:`~langdev.forum.count_authored()` does.
+
+        :param user_ids: :attr:`~langdev.user.User.id` of users to count
+        :type user_ids: :class:`collections.Iterable`
+        :returns: the dictionary of user ids to pairs of the numbers of
+                  posts and comments
+        :rtype: :class:`dict`
+
+        """
+        user_ids = list(user_ids)
+        counts = count_authored(self.bind, user_ids)
+        for user_id, (posts, comments) in \
+                count_authored(self.engine, user_ids).iteritems():
+            hot_posts, hot_comments = counts.get(user_id, (0, 0))
+            counts[user_id] = hot_posts + posts, hot_comments + comments
+        return counts
+
+    def load_post_entries(self, session, criterion=None, order_by=None,
+                          key=None, offset=None, limit=None, **options):
+        """Loads :class:`~langdev.forum.PostEntry` objects from both the
+        database and the archive, as
+        :func:`~langdev.forum.load_post_entries()` does. Each is loaded in
+        ``order_by``, and then they are merged in descending order of
+        ``key``. Counts of authors are of both as well.
+
+        :param session: a session of the database
+        :type session: :class:`langdev.orm.Session`
+        :param key: a function that takes an entry and returns the value
+                    to sort by in descending order, which has to agree with
+                    ``order_by``
+        :type key: callable object
+        :returns: a list of :class:`~langdev.forum.PostEntry`
+        :rtype: :class:`list`
+
+        """
+        end = None if limit is None else (offset or 0) + limit
+        hot = load_post_entries(session, criterion, order_by=order_by,
+                                limit=end, **options)
+        archived = load_post_entries(self.engine, criterion,
+                                     order_by=order_by, limit=end, **options)
+        if options.get('counts'):
+            add_author_counts(self.engine, hot)
+            add_author_counts(session, archived)
+        entries = hot + archived
+        if key is not None:
+            entries.sort(key=key, reverse=True)
+        return entries[offset or 0:end]
+
+    def complete_post_entries(self, session, entries, ids, **options):
+        """Adds entries of archived posts to ``entries`` loaded from the
+        database by ids, e.g. a page of the listing.
+
+        :param session: a session of the database
+        :type session: :class:`langdev.orm.Session`
+        :param entries: :class:`~langdev.forum.PostEntry` objects loaded
+                        by :func:`~langdev.forum.load_post_entries()` with
+                        the same ``options``
+        :type entries: :class:`list`
+        :param ids: ids of posts to load
+        :type ids: :class:`collections.Iterable`
+        :returns: the list of entries of both
+        :rtype: :class:`list`
+
+        """
+        loaded = set(entry.id for entry in entries)
+        missing = [id for id in ids if id not in loaded]
+        archived = []
+        if missing:
+            archived = load_post_entries(self.engine, Post.id.in_(missing),
+                                         **options)
+        if options.get('counts'):
+            add_author_counts(self.engine, entries)
+            add_author_counts(session, archived)
+        return entries + archived
+
+
+def add_author_counts(connectable, entries):
+    """Adds the numbers of posts and comments in the tables of the
+    ``connectable`` to :attr:`~langdev.user.UserEntry.posts_count` and
+    :attr:`~langdev.user.UserEntry.comments_count` of authors of
+    ``entries``, which have been loaded with counts.
+
+    :param connectable: an engine, a connection or a session
+    :param entries: :class:`~langdev.forum.PostEntry` objects
+    :type entries: :class:`collections.Iterable`
+
+    """
+    authors = {}
+    for entry in entries:
+        authors.setdefault(entry.author.id, []).append(entry.author)
+    if not authors:
+        return
+    counts = count_authored(connectable, authors.keys())
+    for author_id, (posts, comments) in counts.iteritems():
+        for author in authors[author_id]:
+            author.posts_count += posts
+            author.comments_count += comments
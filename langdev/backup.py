@@ -0,0 +1,423 @@
+""":mod:`langdev.backup` --- Bulk import and export in JSON Lines
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Records are `JSON Lines`_: each line is an object of a row with its
+``"type"``, one of ``"user"``, ``"application"``, ``"post"`` and
+``"comment"``. Keys are column names, and times are ISO 8601 strings in
+UTC::
+
+    {"type": "user", "id": 1, "login": "dahlia", "name": "Hong Minhee",
+     "email": "dahlia@example.com", "url": null,
+     "password_hash": "pbkdf2_sha256$10000$...$...",
+     "created_at": "2011-10-10T04:55:36"}
+    {"type": "post", "id": 1, "author_id": 1, "title": "Hello",
+     "body": "*world*", "created_at": "2011-10-10T05:00:00"}
+    {"type": "comment", "id": 1, "post_id": 1, "parent_id": null,
+     "author_id": 1, "body": "First!", "created_at": "2011-10-10T05:01:00"}
+
+Ids and times are preserved; ``"modified_at"`` is ``"created_at"`` if
+omitted. Users may have ``"password"`` in plain text
+instead of ``"password_hash"``. :attr:`~langdev.forum.Comment.path` and
+:attr:`~langdev.forum.Comment.depth` are computed, so they can be
+omitted.
+
+:class:`Importer` doesn't go through the ORM. Rows are validated and
+inserted :data:`BATCH_SIZE` rows per ``executemany()`` in a transaction,
+and replies are linked to their parents after all comments are inserted,
+so records can be in any order.
+
+:func:`export()` streams rows in the same format, so its output can be
+imported as it is. It reads a consistent :func:`snapshot()` through
+server-side cursors where the database supports them, so it takes
+constant memory no matter how large the database is. Give it the
+watermark of the previous export to get only rows created or modified
+since then, including hidden ones; importing them with ``replace=True``
+brings a restored database up to date. Rows changed shortly before the
+watermark are exported again, so that ones committed late aren't
+missed. Deleted rows are not exported, so take a full export from time
+to time. Give it the :class:`~langdev.archive.Archive`
+too if one is configured, or archived posts are left out.
+
+.. _JSON Lines: http://jsonlines.org/
+
+"""
+import json
+import datetime
+import contextlib
+from sqlalchemy import DateTime, MetaData, bindparam, select
+from sqlalchemy.sql import functions
+from langdev.user import User, Password
+from langdev.forum import MAX_DEPTH, Comment, Post, path_segment
+from langdev.thirdparty import Application
+import langdev.archive
+
+__all__ = ('BATCH_SIZE', 'TYPES', 'WATERMARK_MARGIN', 'Importer',
+           'dump_record', 'export', 'parse_datetime', 'snapshot')
+
+
+#: The number of rows to insert per transaction.
+BATCH_SIZE = 5000
+
+#: The number of ids to put in an ``IN`` clause at once. SQLite doesn't
+#: allow more than 999 parameters.
+IN_CLAUSE_SIZE = 500
+
+#: How long before the start of a snapshot its watermark is. Rows are
+#: stamped with the start time of the transaction that writes them, so
+#: ones committed after the snapshot began may be older than it.
+#: Transactions that take longer than this can still be missed by the next
+#: incremental export.
+WATERMARK_MARGIN = datetime.timedelta(minutes=5)
+
+#: The ordered pairs of record types and their model classes. Rows
+#: referenced by other rows come first.
+TYPES = (('user', User), ('application', Application),
+         ('post', Post), ('comment', Comment))
+
+
+def parse_datetime(string):
+    """Parses an ISO 8601 time string in UTC.
+
+    .. sourcecode:: pycon
+
+       >>> parse_datetime('2011-10-10T04:55:36')
+       datetime.datetime(2011, 10, 10, 4, 55, 36)
+       >>> parse_datetime('2011-10-10T04:55:36.250000Z')
+       datetime.datetime(2011, 10, 10, 4, 55, 36, 250000)
+       >>> parse_datetime('2011-10-10 04:55:36+00:00')
+       datetime.datetime(2011, 10, 10, 4, 55, 36)
+
+    :param string: an ISO 8601 time string
+    :type string: :class:`basestring`
+    :rtype: :class:`datetime.datetime`
+
+    """
+    string = string.replace(' ', 'T')
+    if string.endswith('Z'):
+        string = string[:-1]
+    elif string.endswith('+00:00'):
+        string = string[:-6]
+    format = '%Y-%m-%dT%H:%M:%S'
+    if '.' in string:
+        format += '.%f'
+    return datetime.datetime.strptime(string, format)
+
+
+class Importer(object):
+    """Inserts records into the database in bulk. Feed records with
+    :meth:`feed()`, and then call :meth:`finish()`::
+
+        importer = Importer(engine)
+        for line in lines:
+            importer.feed(json.loads(line))
+        importer.finish()
+
+    :param engine: a database engine
+    :type engine: :class:`sqlalchemy.engine.base.Engine`
+    :param batch_size: the number of rows to insert per transaction
+    :type batch_size: :class:`int`
+    :param replace: whether to update rows that already exist instead of
+                    failing. it's needed to apply incremental exports
+    :type replace: :class:`bool`
+
+    """
+
+    def __init__(self, engine, batch_size=BATCH_SIZE, replace=False):
+        self.engine = engine
+        self.connection = engine.connect()
+        self.batch_size = batch_size
+        self.replace = replace
+        #: (:class:`dict`) The numbers of imported rows by record type.
+        self.counts = dict((type_, 0) for type_, cls in TYPES)
+        self.pending = dict((type_, []) for type_, cls in TYPES)
+        self.tables = dict((type_, cls.__table__) for type_, cls in TYPES)
+        # ids of replies to ids of their parents, linked by finish()
+        self.parents = {}
+        # the default time of rows that don't have theirs
+        self.now = datetime.datetime.utcnow()
+
+    def feed(self, record):
+        """Validates a record, and queues it to be inserted.
+
+        :param record: a record object
+        :type record: :class:`dict`
+        :raises: :exc:`~exceptions.ValueError` when the record is invalid
+
+        """
+        type_ = record.get('type')
+        if type_ not in self.tables:
+            raise ValueError('{0!r} is an unknown record type'.format(type_))
+        row = self.make_row(self.tables[type_], record)
+        if 'modified_at' in row and record.get('modified_at') is None:
+            row['modified_at'] = row['created_at']
+        getattr(self, 'prepare_' + type_)(row, record)
+        pending = self.pending[type_]
+        pending.append(row)
+        if len(pending) >= self.batch_size:
+            self.flush(type_)
+
+    def make_row(self, table, record):
+        row = {}
+        # executemany() needs every row to have the same keys
+        for column in table.columns:
+            value = record.get(column.name)
+            if value is None:
+                if isinstance(column.type, DateTime):
+                    value = self.now
+                elif column.default is not None and \
+                     column.default.is_scalar:
+                    value = column.default.arg
+                elif not column.nullable and column.name != 'password_hash':
+                    raise ValueError('{0}.{1} is missing'.format(table.name,
+                                                                 column.name))
+            elif isinstance(column.type, DateTime):
+                value = parse_datetime(value)
+            row[column.name] = value
+        return row
+
+    def prepare_user(self, row, record):
+        # the validators use nothing but class attributes
+        row['login'] = User.validate_login.im_func(User, 'login',
+                                                   row['login'])
+        row['email'] = User.validate_email.im_func(User, 'email',
+                                                   row['email'])
+        if row['password_hash'] is None:
+            password = record.get('password')
+            if password is None:
+                raise ValueError('user {0} has neither password nor '
+                                 'password_hash'.format(row['id']))
+            row['password_hash'] = Password.hash(password).hash_string
+
+    def prepare_application(self, row, record):
+        pass
+
+    def prepare_post(self, row, record):
+        pass
+
+    def prepare_comment(self, row, record):
+        if row['parent_id'] is not None:
+            self.parents[row['id']] = row['parent_id']
+            row['parent_id'] = None
+        row['path'] = path_segment(row['id'])
+        row['depth'] = 0
+
+    def flush(self, type_=None):
+        """Inserts queued rows of the ``type_`` and the types it depends
+        on. All queued rows are inserted if ``type_`` is omitted.
+
+        """
+        for current, cls in TYPES:
+            rows = self.pending[current]
+            if rows:
+                with self.connection.begin():
+                    if self.replace:
+                        rows = self.update_existing(self.tables[current],
+                                                    rows)
+                    if rows:
+                        self.connection.execute(
+                            self.tables[current].insert(), rows
+                        )
+                self.counts[current] += len(self.pending[current])
+                del self.pending[current][:]
+            if current == type_:
+                break
+
+    def update_existing(self, table, rows):
+        """Updates rows that already exist, and returns the rest."""
+        key = list(table.primary_key.columns)[0]
+        ids = [row[key.name] for row in rows]
+        existing = set()
+        for i in xrange(0, len(ids), IN_CLAUSE_SIZE):
+            query = select([key], key.in_(ids[i:i + IN_CLAUSE_SIZE]))
+            existing.update(id for id, in self.connection.execute(query))
+        if not existing:
+            return rows
+        update = table.update().where(key == bindparam('existing_key'))
+        self.connection.execute(update, [
+            dict(row, existing_key=row[key.name])
+            for row in rows if row[key.name] in existing
+        ])
+        return [row for row in rows if row[key.name] not in existing]
+
+    def finish(self):
+        """Inserts all queued rows, links replies to their parents, and
+        closes the connection.
+
+        :returns: the numbers of imported rows by record type
+        :rtype: :class:`dict`
+        :raises: :exc:`~exceptions.ValueError` when a reply's parent
+                 doesn't exist, or replies are nested more than
+                 :const:`~langdev.forum.MAX_DEPTH` levels deep
+
+        """
+        self.flush()
+        self.link_replies()
+        if self.engine.dialect.name == 'postgresql':
+            # inserted ids don't advance sequences
+            for type_, cls in TYPES:
+                table = self.tables[type_]
+                if 'id' in table.c:
+                    self.connection.execute(
+                        "SELECT setval(pg_get_serial_sequence('{0}', 'id'), "
+                        "(SELECT max(id) FROM {0}))".format(table.name)
+                    )
+        self.connection.close()
+        return self.counts
+
+    def link_replies(self):
+        parents = self.parents
+        table = self.tables['comment']
+        # (path, depth) of comments; the second pass fills it from
+        # comments that aren't replies of this import
+        located = {}
+        roots = sorted(set(parent for parent in parents.itervalues()
+                           if parent not in parents))
+        for i in xrange(0, len(roots), IN_CLAUSE_SIZE):
+            query = select([table.c.id, table.c.path, table.c.depth],
+                           table.c.id.in_(roots[i:i + IN_CLAUSE_SIZE]))
+            for id, path, depth in self.connection.execute(query):
+                located[id] = path, depth
+        for root in roots:
+            if root not in located:
+                raise ValueError('comment {0} does not exist'.format(root))
+        def locate(id):
+            replies = []
+            while id not in located:
+                replies.append(id)
+                id = parents[id]
+                if len(replies) > len(parents):
+                    raise ValueError('comment {0} is its own ancestor'
+                                     .format(id))
+            path, depth = located[id]
+            for id in reversed(replies):
+                path += path_segment(id)
+                depth += 1
+                if depth > MAX_DEPTH:
+                    raise ValueError('comment {0} is nested more than {1} '
+                                     'levels deep'.format(id, MAX_DEPTH))
+                located[id] = path, depth
+            return path, depth
+        update = table.update() \
+                      .where(table.c.id == bindparam('comment_id')) \
+                      .values(parent_id=bindparam('parent_comment_id'),
+                              path=bindparam('comment_path'),
+                              depth=bindparam('comment_depth'))
+        rows = []
+        for id, parent_id in sorted(parents.iteritems()):
+            path, depth = locate(id)
+            rows.append({'comment_id': id, 'parent_comment_id': parent_id,
+                         'comment_path': path, 'comment_depth': depth})
+            if len(rows) >= self.batch_size:
+                with self.connection.begin():
+                    self.connection.execute(update, rows)
+                del rows[:]
+        if rows:
+            with self.connection.begin():
+                self.connection.execute(update, rows)
+
+
+@contextlib.contextmanager
+def snapshot(engine, archive=None):
+    """Opens a connection that reads a consistent snapshot of the
+    database until the block ends::
+
+        with snapshot(engine) as (connection, watermark):
+            for record in export(connection):
+                print dump_record(record)
+
+    On SQLite, commits of other connections wait until the block ends
+    unless the database is in the WAL journal mode.
+
+    :param engine: a database engine
+    :type engine: :class:`sqlalchemy.engine.base.Engine`
+    :param archive: the archive of the database, if any. its tables are
+                    in the same snapshot
+    :type archive: :class:`langdev.archive.Archive`
+    :returns: a pair of the connection and the watermark of the next
+              export: the current time of the database in UTC less
+              :data:`WATERMARK_MARGIN`
+
+    """
+    if archive is None:
+        connect = contextlib.closing(engine.connect())
+    else:
+        connect = archive.connect()
+    with connect as connection:
+        with begin_snapshot(connection) as watermark:
+            yield connection, watermark
+
+
+@contextlib.contextmanager
+def begin_snapshot(connection):
+    dialect = connection.dialect.name
+    try:
+        if dialect == 'sqlite':
+            # pysqlite doesn't begin transactions for SELECT statements
+            connection.execute('BEGIN')
+        else:
+            transaction = connection.begin()
+            if dialect == 'postgresql':
+                connection.execute('SET TRANSACTION ISOLATION LEVEL '
+                                   'REPEATABLE READ, READ ONLY')
+                # times are read in UTC, and naive ones e.g. the watermark
+                # are compared as UTC
+                connection.execute("SET LOCAL TIME ZONE 'UTC'")
+        now = connection.execute(select([functions.now()])).scalar()
+        if now.tzinfo is not None:
+            now = (now - now.utcoffset()).replace(tzinfo=None)
+        yield now - WATERMARK_MARGIN
+    finally:
+        if dialect == 'sqlite':
+            # pysqlite commits before other statements including ROLLBACK
+            connection.connection.rollback()
+        else:
+            transaction.rollback()
+
+
+def export(connection, since=None, archive=None):
+    """Reads all rows in the order of :data:`TYPES` as records. Archived
+    posts and comments are read after the others of the same type, and
+    they are records of the same type, so that they are imported into the
+    database as they were never archived.
+
+    :param connection: a connection opened by :func:`snapshot()`
+    :type connection: :class:`sqlalchemy.engine.base.Connection`
+    :param since: the watermark of the previous export. only rows
+                  modified since then are read if it's given
+    :type since: :class:`datetime.datetime`
+    :param archive: the archive that the :func:`snapshot()` has been
+                    opened with, if any
+    :type archive: :class:`langdev.archive.Archive`
+    :returns: an iterator of records
+    :rtype: :class:`collections.Iterable`
+
+    """
+    streaming = connection.execution_options(stream_results=True)
+    archived_metadata = MetaData()
+    for type_, cls in TYPES:
+        tables = [cls.__table__]
+        if archive is not None and cls.__table__ in langdev.archive.TABLES:
+            tables.append(cls.__table__.tometadata(archived_metadata,
+                                                   schema=archive.schema))
+        for table in tables:
+            query = table.select().order_by(*table.primary_key.columns)
+            if since is not None:
+                query = query.where(table.c.modified_at >= since)
+            for row in streaming.execute(query):
+                record = dict(row.items())
+                record['type'] = type_
+                yield record
+
+
+def dump_record(record):
+    """Serializes a record to a line of JSON.
+
+    .. sourcecode:: pycon
+
+       >>> dump_record({'type': 'post', 'id': 1,
+       ...              'created_at': datetime.datetime(2011, 10, 10, 4, 55)})
+       '{"created_at":"2011-10-10T04:55:00","id":1,"type":"post"}'
+
+    """
+    return json.dumps(record, default=datetime.datetime.isoformat,
+                      separators=(',', ':'), sort_keys=True)
@@ -3,11 +3,66 @@
 
 """
 from sqlalchemy import *
-from sqlalchemy import orm
-from sqlalchemy.sql import functions
+from sqlalchemy import orm, event
+from sqlalchemy.sql import functions, expression
+import threading
 import markdown2
 import langdev.orm
 import langdev.user
+from langdev.util import tracing
+
+
+#: The number of hexadecimal digits of each :attr:`Comment.path` segment.
+PATH_SEGMENT_WIDTH = 8
+
+#: The maximum :attr:`Comment.depth`. Replies can't be nested more deeply,
+#: since :attr:`Comment.path` has room for this many ancestors only.
+MAX_DEPTH = 99
+
+
+def path_segment(comment_id):
+    """Encodes the ``comment_id`` to a fixed-width :attr:`Comment.path`
+    segment, so that paths sort in the order of ids.
+
+    >>> path_segment(1)
+    '00000001'
+    >>> path_segment(255)
+    '000000ff'
+
+    :param comment_id: a comment id
+    :type comment_id: :class:`int`
+    :returns: a path segment
+    :rtype: :class:`str`
+
+    """
+    return '{0:0{1}x}'.format(comment_id, PATH_SEGMENT_WIDTH)
+
+
+#: Per-thread :class:`markdown2.Markdown` converters. A converter keeps
+#: the state of the text being converted in itself, so threads can't
+#: share one.
+markdowns = threading.local()
+
+
+def markdown(text):
+    """Compiles Markdown_ ``text`` to HTML with the converter of the
+    current thread.
+
+    .. _Markdown: http://daringfireball.net/projects/markdown/
+
+    :param text: Markdown text
+    :type text: :class:`basestring`
+    :returns: HTML
+    :rtype: :class:`unicode`
+
+    """
+    try:
+        converter = markdowns.converter
+    except AttributeError:
+        converter = markdowns.converter = \
+            markdown2.Markdown(extras=['footnotes'])
+    with tracing.span('body_html', 'markdown'):
+        return converter.convert(text)
 
 
 class Post(langdev.orm.Base):
@@ -29,19 +84,37 @@ class Post(langdev.orm.Base):
     #: A post title.
     title = Column(Unicode(255), nullable=False, index=True)
 
-    #: A post content.
-    body = orm.deferred(Column(UnicodeText, nullable=False))
+    #: A post content. Long ones are compressed in the database.
+    body = orm.deferred(Column(langdev.orm.CompressedText, nullable=False))
 
     #: Whether it is sticky.
     sticky = Column(Boolean, nullable=False, default=False, index=True)
 
+    #: Whether it has deleted. Deleted posts are hidden immediately, and then
+    #: deleted with their comments in background.
+    #:
+    #: .. seealso:: Module :mod:`langdev.purge`
+    hidden = Column(Boolean, nullable=False, default=False,
+                    server_default=expression.false(), index=True)
+
     #: (:class:`datetime.datetime`) Created time.
     created_at = Column(DateTime(timezone=True),
                         nullable=False, default=functions.now(), index=True)
 
     #: (:class:`datetime.datetime`) Lastly modified time.
     modified_at = Column(DateTime(timezone=True), nullable=False,
-                         default=functions.now(), onupdate=functions.now())
+                         default=functions.now(), onupdate=functions.now(),
+                         index=True)
+
+    __table_args__ = (
+        # the listing: visible posts by sticky DESC, created_at DESC
+        Index('ix_posts_hidden_sticky_created_at', hidden, sticky, created_at),
+        # the feed: visible posts by created_at DESC
+        Index('ix_posts_hidden_created_at', hidden, created_at),
+        # visible posts of a user by created_at
+        Index('ix_posts_author_id_hidden_created_at',
+              author_id, hidden, created_at),
+    )
 
     @property
     def body_html(self):
@@ -50,24 +123,21 @@ class Post(langdev.orm.Base):
         .. _Markdown: http://daringfireball.net/projects/markdown/
 
         """
-        global markdown
-        try:
-            markdown
-        except NameError:
-            markdown = markdown2.Markdown(extras=['footnotes'])
-        return markdown.convert(self.body)
+        return markdown(self.body)
 
     @property
     def replies(self):
         """Comments that don't have :attr:`~Comment.parent` comments."""
-        from sqlalchemy.dialects.sqlite.base import SQLiteDialect
-        session = langdev.orm.Session.object_session(self)
-        engine = session.get_bind(type(self))
-        pid = Comment.parent_id
-        cond = pid == None
-        if isinstance(engine.dialect, SQLiteDialect):
-            cond = cond | (pid == '')
-        return self.comments.filter(cond)
+        return self.comments.filter(Comment.parent_id == None) \
+                            .filter(Comment.hidden == False)
+
+    @property
+    def thread(self):
+        """All comments in display order (depth-first). It includes hidden
+        comments and their replies; use :class:`CommentTree` to skip them.
+
+        """
+        return self.comments.order_by(None).order_by(Comment.path)
 
     def __unicode__(self):
         return self.title
@@ -95,25 +165,90 @@ class Comment(langdev.orm.Base):
     author = orm.relationship(langdev.user.User,
                               backref=orm.backref('comments', lazy='dynamic'))
 
-    #: A comment content.
-    body = Column(UnicodeText, nullable=False)
+    #: A comment content. Long ones are compressed in the database.
+    body = Column(langdev.orm.CompressedText, nullable=False)
+
+    #: Whether it has deleted. Deleted comments are hidden immediately with
+    #: their replies, and then deleted in background.
+    #:
+    #: .. seealso:: Module :mod:`langdev.purge`
+    hidden = Column(Boolean, nullable=False, default=False,
+                    server_default=expression.false())
+
+    #: Materialized path: :func:`path_segment()` of ids of all ancestors
+    #: and itself, from the top-level comment. Sorting comments of a post by
+    #: it gives the display order, and descendants of a comment are in the
+    #: range from its path to the path followed by ``'g'``. It is filled
+    #: after the comment is inserted.
+    path = Column(String(PATH_SEGMENT_WIDTH * (MAX_DEPTH + 1)))
+
+    #: The number of ancestors. Top-level comments are 0.
+    depth = Column(Integer, nullable=False, default=0, server_default='0')
 
     #: (:class:`datetime.datetime`) Created time.
     created_at = Column(DateTime(timezone=True),
                         nullable=False, default=functions.now(), index=True)
 
+    #: (:class:`datetime.datetime`) Lastly modified time, for incremental
+    #: exports. ``NULL`` only in rows older than the column until
+    #: :func:`~langdev.orm.fill_modified_at()` fills it.
+    modified_at = orm.deferred(Column(DateTime(timezone=True),
+                                      default=functions.now(),
+                                      onupdate=functions.now(), index=True))
+
+    __table_args__ = (
+        Index('ix_comments_post_id_path', post_id, path),
+        # replies on a post or a comment by created_at
+        Index('ix_comments_post_id_parent_id_created_at',
+              post_id, parent_id, created_at),
+        # visible comments of authors, to count them
+        Index('ix_comments_author_id_hidden', author_id, hidden),
+    )
+
     #: (:class:`Post`) A post this comment belongs to.
     post = orm.relationship(Post, innerjoin=True,
                             backref=orm.backref('comments',
                                                 order_by=created_at,
                                                 lazy='dynamic'))
 
-    #: Replies on this comment.
-    replies = orm.relationship('Comment',
-                               innerjoin=True,
-                               lazy='dynamic',
-                               order_by=created_at,
-                               backref=orm.backref('parent', remote_side=[id]))
+    #: All replies on this comment including hidden ones.
+    children = orm.relationship('Comment',
+                                innerjoin=True,
+                                lazy='dynamic',
+                                order_by=created_at,
+                                backref=orm.backref('parent',
+                                                    remote_side=[id]))
+
+    @property
+    def replies(self):
+        """Replies on this comment, except of hidden ones."""
+        return self.children.filter(Comment.post_id == self.post_id) \
+                            .filter(Comment.hidden == False)
+
+    @property
+    def ancestor_ids(self):
+        """Ids of the ancestors from the top-level comment, read from
+        :attr:`path`.
+
+        """
+        if not self.path:
+            return [self.parent_id] if self.parent_id else []
+        return [int(self.path[i:i + PATH_SEGMENT_WIDTH], 16)
+                for i in xrange(0, len(self.path) - PATH_SEGMENT_WIDTH,
+                                PATH_SEGMENT_WIDTH)]
+
+    @property
+    def subtree(self):
+        """All descendants in display order (depth-first). Like
+        :attr:`Post.thread`, it includes hidden ones.
+
+        """
+        session = langdev.orm.Session.object_session(self)
+        return session.query(Comment) \
+                      .filter(Comment.post_id == self.post_id) \
+                      .filter(Comment.path > self.path) \
+                      .filter(Comment.path < self.path + 'g') \
+                      .order_by(Comment.path)
 
     @property
     def body_html(self):
@@ -122,12 +257,7 @@ class Comment(langdev.orm.Base):
         .. _Markdown: http://daringfireball.net/projects/markdown/
 
         """
-        global markdown
-        try:
-            markdown
-        except NameError:
-            markdown = markdown2.Markdown(extras=['footnotes'])
-        return markdown.convert(self.body)
+        return markdown(self.body)
 
     def __unicode__(self):
         return self.body
@@ -135,3 +265,513 @@ class Comment(langdev.orm.Base):
     def __html__(self):
         return self.body_html
 
+
+@event.listens_for(Comment, 'after_insert')
+def set_comment_path(mapper, connection, target):
+    """Fills :attr:`Comment.path` and :attr:`Comment.depth` of the
+    just inserted comment, because the path contains its own id.
+
+    :raises: :exc:`~exceptions.ValueError` when the parent is already
+             :const:`MAX_DEPTH` deep
+
+    """
+    table = Comment.__table__
+    path = path_segment(target.id)
+    depth = 0
+    if target.parent_id is not None:
+        parent = connection.execute(
+            select([table.c.path, table.c.depth])
+            .where(table.c.id == target.parent_id)
+        ).first()
+        if parent is None or parent.path is None:
+            # the parent has not been migrated yet; upgradedb will fill it
+            path = None
+        elif parent.depth >= MAX_DEPTH:
+            raise ValueError('replies cannot be nested more than {0} levels '
+                             'deep'.format(MAX_DEPTH))
+        else:
+            path = parent.path + path
+            depth = parent.depth + 1
+    connection.execute(table.update()
+                            .where(table.c.id == target.id)
+                            .values(path=path, depth=depth))
+    orm.attributes.set_committed_value(target, 'path', path)
+    orm.attributes.set_committed_value(target, 'depth', depth)
+
+
+class PostEntry(object):
+    """A read-only projection of a :class:`Post` for lists. It has the
+    attributes that lists render or serialize, and is loaded by
+    :func:`load_post_entries()` with its :attr:`author` in a single
+    query, without identity map and change tracking of the session.
+
+    :attr:`body` is ``None`` unless it's loaded, and so are
+    :attr:`comments_count`, :attr:`replies_count` and
+    :attr:`first_reply_id` unless counts are loaded.
+
+    """
+
+    __slots__ = ('id', 'author', 'title', 'sticky', 'created_at',
+                 'modified_at', 'body', 'comments_count', 'replies_count',
+                 'first_reply_id')
+
+    def __init__(self, id, author, title, sticky, created_at, modified_at,
+                 body=None, comments_count=None, replies_count=None,
+                 first_reply_id=None):
+        self.id = id
+        #: (:class:`~langdev.user.UserEntry`) The post author.
+        self.author = author
+        self.title = title
+        self.sticky = sticky
+        self.created_at = created_at
+        self.modified_at = modified_at
+        self.body = body
+        self.comments_count = comments_count
+        self.replies_count = replies_count
+        #: The :attr:`~Comment.id` of the first of :attr:`Post.replies`.
+        self.first_reply_id = first_reply_id
+
+    body_html = Post.body_html
+
+    def __unicode__(self):
+        return self.title
+
+    def __repr__(self):
+        return '<{0}.PostEntry id={1!r}>'.format(__name__, self.id)
+
+
+def load_post_entries(connectable, criterion=None, order_by=None,
+                      offset=None, limit=None, body=False, counts=False):
+    """Loads :class:`PostEntry` objects of posts selected by the
+    ``criterion``. ::
+
+        entries = load_post_entries(session, Post.author_id == user.id,
+                                    order_by=Post.created_at.desc(),
+                                    limit=30)
+
+    :param connectable: an engine, a connection or a session
+    :param criterion: a where clause on :class:`Post` columns
+    :param order_by: an order by clause
+    :param offset: the number of posts to skip
+    :type offset: :class:`int`
+    :param limit: the maximum number of posts to load
+    :type limit: :class:`int`
+    :param body: whether to load :attr:`PostEntry.body`
+    :type body: :class:`bool`
+    :param counts: whether to load counts of comments and of posts and
+                   comments of authors, and the first reply. they are
+                   counted by subqueries for each row
+    :type counts: :class:`bool`
+    :returns: a list of :class:`PostEntry`
+    :rtype: :class:`list`
+
+    """
+    posts = Post.__table__
+    users = langdev.user.User.__table__
+    comments = Comment.__table__
+    columns = [posts.c.id, posts.c.title, posts.c.sticky, posts.c.created_at,
+               posts.c.modified_at, users.c.id, users.c.login, users.c.name,
+               users.c.url, users.c.created_at, users.c.email]
+    if body:
+        columns.append(posts.c.body)
+    if counts:
+        replies = (comments.c.post_id == posts.c.id) & \
+                  (comments.c.parent_id == None) & \
+                  (comments.c.hidden == False)
+        own_posts = posts.alias()
+        columns.extend([
+            select([functions.count(comments.c.id)],
+                   (comments.c.post_id == posts.c.id) &
+                   (comments.c.hidden == False)).as_scalar(),
+            select([functions.count(comments.c.id)], replies).as_scalar(),
+            select([comments.c.id], replies)
+                .order_by(comments.c.created_at).limit(1).as_scalar(),
+            select([functions.count(own_posts.c.id)],
+                   (own_posts.c.author_id == users.c.id) &
+                   (own_posts.c.hidden == False)).as_scalar(),
+            select([functions.count(comments.c.id)],
+                   (comments.c.author_id == users.c.id) &
+                   (comments.c.hidden == False)).as_scalar()
+        ])
+    authored = posts.join(users, users.c.id == posts.c.author_id)
+    query = select(columns, criterion, from_obj=[authored],
+                   order_by=order_by, offset=offset, limit=limit,
+                   use_labels=True)
+    entries = []
+    for row in connectable.execute(query):
+        author = langdev.user.UserEntry(*row[5:11])
+        entry = PostEntry(row[0], author, *row[1:5])
+        if body:
+            entry.body = row[11]
+        if counts:
+            (entry.comments_count, entry.replies_count, entry.first_reply_id,
+             author.posts_count, author.comments_count) = row[-5:]
+        entries.append(entry)
+    return entries
+
+
+def count_authored(connectable, user_ids, chunk_size=500):
+    """Counts posts and comments that users have written, except of hidden
+    ones, by a query per table for every ``chunk_size`` users.
+
+    :param connectable: an engine, a connection or a session
+    :param user_ids: :attr:`~langdev.user.User.id` of users to count
+    :type user_ids: :class:`collections.Iterable`
+    :param chunk_size: the maximum number of ids in an ``IN`` clause
+    :type chunk_size: :class:`int`
+    :returns: the dictionary of user ids to pairs of the numbers of posts
+              and comments. users who have written nothing are left out
+    :rtype: :class:`dict`
+
+    """
+    user_ids = list(set(user_ids))
+    counts = {}
+    for i, table in enumerate((Post.__table__, Comment.__table__)):
+        for j in xrange(0, len(user_ids), chunk_size):
+            chunk = user_ids[j:j + chunk_size]
+            query = select([table.c.author_id, functions.count(table.c.id)],
+                           table.c.author_id.in_(chunk) &
+                           (table.c.hidden == False)) \
+                    .group_by(table.c.author_id)
+            for author_id, count in connectable.execute(query):
+                counts.setdefault(author_id, [0, 0])[i] = count
+    return dict((user_id, tuple(pair)) for user_id, pair in counts.iteritems())
+
+
+class Change(langdev.orm.Base):
+    """A change of a post or a comment. Changes are appended by mapper
+    events in the same transaction as the change itself, so that API
+    clients can follow what has changed since the last :attr:`id` they
+    have seen, no matter how large the tables are. Hidden posts and
+    comments are logged as deleted.
+
+    .. note::
+
+       Changes made through SQL expressions, not through the session, have
+       to be logged by :func:`log_changes()`.
+
+    """
+
+    __tablename__ = 'changes'
+
+    #: Unique primary key. It increases in the order of commits, because
+    #: :func:`log_changes()` serializes transactions from logging changes
+    #: to committing: SQLite does by itself, and PostgreSQL does by
+    #: :data:`CHANGES_LOCK`. Otherwise a transaction could commit a lower
+    #: id after a higher one has been read, and be skipped by cursors.
+    id = Column(Integer, primary_key=True)
+
+    #: ``'post'`` or ``'comment'``.
+    kind = Column(String(10), nullable=False)
+
+    #: ``'created'``, ``'modified'`` or ``'deleted'``.
+    action = Column(String(10), nullable=False)
+
+    #: The id of the changed post or comment.
+    target_id = Column(Integer, nullable=False)
+
+    #: The :attr:`~Post.id` of the changed post, or of the post that the
+    #: changed comment belongs to.
+    post_id = Column(Integer, nullable=False)
+
+    #: (:class:`datetime.datetime`) Changed time.
+    created_at = Column(DateTime(timezone=True),
+                        nullable=False, default=functions.now())
+
+
+#: The key of the PostgreSQL advisory lock that transactions hold from
+#: logging changes until they end, so that :attr:`Change.id` increases in
+#: the order of commits.
+CHANGES_LOCK = 0x6c616e67
+
+
+def log_changes(connection, kind, action, targets):
+    """Appends changes of rows changed through SQL expressions.
+
+    :param connection: the connection in the transaction of the change
+    :param kind: ``'post'`` or ``'comment'``
+    :type kind: :class:`str`
+    :param action: ``'created'``, ``'modified'`` or ``'deleted'``
+    :type action: :class:`str`
+    :param targets: pairs of an id of a changed row and its post id
+    :type targets: :class:`collections.Iterable`
+
+    """
+    rows = [{'kind': kind, 'action': action,
+             'target_id': target_id, 'post_id': post_id}
+            for target_id, post_id in targets]
+    if rows:
+        if connection.dialect.name == 'postgresql':
+            # ids are taken from the sequence regardless of commits; other
+            # transactions wait here until this one ends
+            connection.execute(
+                select([func.pg_advisory_xact_lock(CHANGES_LOCK)])
+            )
+        connection.execute(Change.__table__.insert(), rows)
+
+
+def log_change(connection, target, action):
+    if isinstance(target, Post):
+        kind, post_id = 'post', target.id
+    else:
+        kind, post_id = 'comment', target.post_id
+    log_changes(connection, kind, action, [(target.id, post_id)])
+
+
+@event.listens_for(Post, 'after_insert')
+@event.listens_for(Comment, 'after_insert')
+def log_creation(mapper, connection, target):
+    """Logs a created post or comment."""
+    log_change(connection, target, 'created')
+
+
+@event.listens_for(Post, 'after_update')
+@event.listens_for(Comment, 'after_update')
+def log_modification(mapper, connection, target):
+    """Logs a modified post or comment. Being hidden is logged as being
+    deleted.
+
+    """
+    hidden = orm.attributes.get_history(target, 'hidden')
+    if hidden.added and hidden.added[0]:
+        log_change(connection, target, 'deleted')
+        return
+    # it's called even if no columns have changed
+    session = orm.object_session(target)
+    if session.is_modified(target, include_collections=False, passive=True):
+        log_change(connection, target, 'modified')
+
+
+class CommentTree(object):
+    """Nests comments listed in display order, e.g. :attr:`Post.thread` or
+    :attr:`Comment.subtree`. Hidden comments and their replies are left out.
+
+    :param comments: comments in :attr:`Comment.path` order
+    :param root: the comment whose :attr:`~Comment.subtree` is given.
+                 ``None`` for the whole thread of a post
+    :type root: :class:`Comment`
+
+    """
+
+    @classmethod
+    def load(cls, post, parent=None, after=None,
+             limit=50, depth=5, rows=500):
+        """Loads a bounded part of the thread, so that the cost of rendering
+        it doesn't grow with the size of discussions. It takes at most
+        ``limit`` replies on the ``parent`` and their replies up to ``depth``
+        levels, and no more than ``rows`` comments in total. How many
+        replies are left behind is given by :meth:`remaining()`.
+
+        :param post: the post to load comments of
+        :type post: :class:`Post`
+        :param parent: the comment to load replies of. the top-level
+                       comments of the ``post`` if omitted
+        :type parent: :class:`Comment`
+        :param after: an id of the reply to :attr:`parent` to load after
+        :type after: :class:`int`
+        :param limit: the maximum number of replies on the ``parent``
+        :type limit: :class:`int`
+        :param depth: the maximum depth to load from the ``parent``
+        :type depth: :class:`int`
+        :param rows: the maximum number of comments to load
+        :type rows: :class:`int`
+        :returns: a loaded tree
+        :rtype: :class:`CommentTree`
+
+        """
+        session = langdev.orm.Session.object_session(post)
+        if parent is None:
+            siblings = post.replies
+        else:
+            # not :attr:`Comment.replies`, whose filter on post_id makes
+            # SQLite choose between the post_id and parent_id indexes by
+            # their creation order, which varies from run to run
+            siblings = parent.children.filter(Comment.hidden == False)
+        if after is not None:
+            siblings = siblings.filter(Comment.id > after)
+        # in the order of paths, which is of ids, so that ``after`` and
+        # the range of paths below agree with it
+        first = siblings.order_by(None) \
+                        .order_by(Comment.id) \
+                        .limit(limit) \
+                        .all()
+        comments = []
+        if first:
+            paths = [comment.path for comment in first]
+            comments = session.query(Comment) \
+                              .filter(Comment.post_id == post.id) \
+                              .filter(Comment.path >= min(paths)) \
+                              .filter(Comment.path < max(paths) + 'g') \
+                              .filter(Comment.depth < first[0].depth + depth) \
+                              .options(orm.joinedload(Comment.author),
+                                       orm.undefer('author.email'),
+                                       orm.undefer('author.url'),
+                                       orm.undefer('author.created_at')) \
+                              .order_by(Comment.path) \
+                              .limit(rows) \
+                              .all()
+        tree = cls(comments, root=parent)
+        shown = [comment.id
+                 for replies in tree.children.itervalues()
+                 for comment in replies]
+        if shown:
+            counts = session.query(Comment.parent_id,
+                                   functions.count(Comment.id)) \
+                            .filter(Comment.parent_id.in_(shown)) \
+                            .filter(Comment.hidden == False) \
+                            .group_by(Comment.parent_id)
+            tree.counts.update(counts)
+        tree.counts[tree._key(None)] = siblings.order_by(None).count()
+        return tree
+
+    def __init__(self, comments, root=None):
+        self.root = root
+        self.children = {}
+        #: The number of visible replies on each comment by its id,
+        #: including ones not loaded. Filled by :meth:`load()`.
+        self.counts = {}
+        top = self._key(None)
+        shown = set([top])
+        for comment in comments:
+            if comment.hidden:
+                continue
+            if comment.depth == 0:
+                parent_id = top
+            else:
+                parent_id = comment.parent_id
+            if parent_id not in shown:
+                continue
+            self.children.setdefault(parent_id, []).append(comment)
+            shown.add(comment.id)
+
+    def replies(self, comment=None):
+        """Visible replies on the ``comment``.
+
+        :param comment: a comment in the tree. the top level (or the root)
+                        if omitted
+        :type comment: :class:`Comment`
+        :returns: the list of replies
+        :rtype: :class:`list`
+
+        """
+        return self.children.get(self._key(comment), [])
+
+    def remaining(self, comment=None):
+        """The number of visible replies on the ``comment`` that haven't
+        been loaded. They come after the loaded :meth:`replies()`.
+
+        :param comment: a comment in the tree. the top level (or the root)
+                        if omitted
+        :type comment: :class:`Comment`
+        :returns: the number of replies left behind
+        :rtype: :class:`int`
+
+        """
+        count = self.counts.get(self._key(comment), 0)
+        return max(count - len(self.replies(comment)), 0)
+
+    def _key(self, comment):
+        comment = comment or self.root
+        return comment and comment.id
+
+
+@langdev.orm.migration
+def backfill_comment_paths(session, batch_size=500):
+    """Fills :attr:`Comment.path` and :attr:`Comment.depth` of existing
+    comments, parents first. Comments whose parents don't exist anymore
+    become top-level, and replies on :const:`MAX_DEPTH` deep comments
+    become replies on their grandparents. It also replaces empty strings in
+    :attr:`Comment.parent_id` that SQLite had stored by ``NULL``.
+
+    :returns: the number of migrated comments
+    :rtype: :class:`int`
+
+    """
+    table = Comment.__table__
+    parent = table.alias('parent')
+    migrated = 0
+    if session.get_bind(Comment).dialect.name == 'sqlite':
+        with session.begin():
+            result = session.execute(table.update()
+                                          .where(table.c.parent_id == '')
+                                          .values(parent_id=None))
+            migrated += result.rowcount
+    join = table.outerjoin(parent, table.c.parent_id == parent.c.id)
+    query = select([table.c.id, parent.c.id, parent.c.path, parent.c.depth,
+                    parent.c.parent_id],
+                   from_obj=join) \
+            .where(table.c.path == None) \
+            .where(or_(parent.c.id == None, parent.c.path != None)) \
+            .order_by(table.c.id) \
+            .limit(batch_size)
+    update = table.update() \
+                  .where(table.c.id == bindparam('comment_id')) \
+                  .values(parent_id=bindparam('comment_parent_id'),
+                          path=bindparam('comment_path'),
+                          depth=bindparam('comment_depth'))
+    while True:
+        rows = session.execute(query).fetchall()
+        if not rows:
+            return migrated
+        params = []
+        for id, parent_id, parent_path, parent_depth, grandparent_id in rows:
+            if parent_id is None:
+                path, depth = path_segment(id), 0
+            elif parent_depth >= MAX_DEPTH:
+                parent_id = grandparent_id
+                path = parent_path[:-PATH_SEGMENT_WIDTH] + path_segment(id)
+                depth = parent_depth
+            else:
+                path = parent_path + path_segment(id)
+                depth = parent_depth + 1
+            params.append({'comment_id': id, 'comment_parent_id': parent_id,
+                           'comment_path': path, 'comment_depth': depth})
+        with session.begin():
+            session.execute(update, params)
+        migrated += len(rows)
+
+
+@langdev.orm.migration
+def compress_bodies(session, batch_size=200):
+    """Compresses long :attr:`Post.body` and :attr:`Comment.body` values
+    that have been stored as they are, ``batch_size`` rows per
+    transaction.
+
+    :returns: the number of compressed posts and comments
+    :rtype: :class:`int`
+
+    .. seealso:: Class :class:`langdev.orm.CompressedText`
+
+    """
+    migrated = 0
+    for table in Post.__table__, Comment.__table__:
+        compressed_text = table.c.body.type
+        # reads and writes stored forms as they are
+        stored = expression.type_coerce(table.c.body, UnicodeText)
+        # a UTF-8 character takes at most 4 bytes
+        query = select([table.c.id, stored]) \
+                .where(func.length(stored) >= compressed_text.threshold // 4) \
+                .where(~stored.startswith(compressed_text.MARKER)) \
+                .order_by(table.c.id) \
+                .limit(batch_size)
+        values = {'body': bindparam('row_body', type_=compressed_text)}
+        if 'modified_at' in table.c:
+            # compressing isn't a modification; keeps it from onupdate
+            values['modified_at'] = table.c.modified_at
+        update = table.update() \
+                      .where(table.c.id == bindparam('row_id')) \
+                      .values(**values)
+        last_id = 0
+        while True:
+            rows = session.execute(query.where(table.c.id > last_id)) \
+                          .fetchall()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            params = [{'row_id': id, 'row_body': body} for id, body in rows
+                      if compressed_text.compress(body) != body]
+            if params:
+                with session.begin():
+                    session.execute(update, params)
+                migrated += len(params)
+    return migrated
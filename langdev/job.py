@@ -0,0 +1,506 @@
+""":mod:`langdev.job` --- Background jobs
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+This module provides a small durable job queue, so that web pages can move
+slow work off the request path. Jobs are persisted in the ``jobs`` table
+and run by :program:`manage_langdev.py worker`.
+
+In order to define a job, decorate a function with :func:`job`. Job
+functions take a :class:`langdev.orm.Session` as the first argument,
+and the rest of arguments have to be JSON-serializable::
+
+    @langdev.job.job
+    def recount(session, post_id):
+        ...
+
+    with session.begin():
+        recount.enqueue(session, post.id)
+
+Failed jobs are retried with exponential backoff until
+:attr:`~JobFunction.max_attempts` is exceeded.
+Workers periodically queue jobs of dead workers again and delete old
+finished jobs as well.
+
+"""
+import os
+import sys
+import json
+import time
+import socket
+import datetime
+import threading
+import traceback
+from sqlalchemy import *
+from sqlalchemy.sql import functions
+import langdev.orm
+
+__all__ = ('QUEUED', 'RUNNING', 'DONE', 'FAILED', 'Job', 'JobFunction',
+           'Worker', 'registry', 'job', 'enqueue', 'claim', 'run',
+           'requeue_stale', 'delete_done', 'stats')
+
+
+#: :attr:`Job.state` of jobs waiting to be run.
+QUEUED = 'queued'
+
+#: :attr:`Job.state` of jobs being run.
+RUNNING = 'running'
+
+#: :attr:`Job.state` of finished jobs.
+DONE = 'done'
+
+#: :attr:`Job.state` of jobs that have given up.
+FAILED = 'failed'
+
+#: The :class:`dict` of registered :class:`JobFunction` objects by their
+#: names.
+registry = {}
+
+
+class Job(langdev.orm.Base):
+    """A queued job."""
+
+    __tablename__ = 'jobs'
+
+    #: Unique primary key.
+    id = Column(Integer, primary_key=True)
+
+    #: The :attr:`~JobFunction.name` of the job function.
+    name = Column(String(255), nullable=False)
+
+    #: JSON-encoded ``[args, kwargs]``.
+    arguments = Column(UnicodeText, nullable=False)
+
+    #: One of :const:`QUEUED`, :const:`RUNNING`, :const:`DONE` or
+    #: :const:`FAILED`.
+    state = Column(String(10), nullable=False, default=QUEUED)
+
+    #: The number of attempts to run.
+    attempts = Column(Integer, nullable=False, default=0)
+
+    #: The latest error traceback, if any.
+    error = Column(UnicodeText)
+
+    #: The name of the worker that claimed the job lastly.
+    worker = Column(String(255))
+
+    #: (:class:`datetime.datetime`) The time the job can run after.
+    run_at = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+    #: (:class:`datetime.datetime`) Queued time.
+    created_at = Column(DateTime, nullable=False,
+                        default=datetime.datetime.utcnow)
+
+    #: (:class:`datetime.datetime`) The time the job has started lastly.
+    started_at = Column(DateTime)
+
+    #: (:class:`datetime.datetime`) The time the job has finished.
+    finished_at = Column(DateTime)
+
+    __table_args__ = Index('ix_jobs_state_run_at', state, run_at),
+
+    @property
+    def function(self):
+        """(:class:`JobFunction`) The registered job function."""
+        return registry[self.name]
+
+    def __unicode__(self):
+        return u'{0}#{1}'.format(self.name, self.id)
+
+
+class JobFunction(object):
+    """Registered job function. Made by :func:`job` decorator. It can be
+    called like the original function also.
+
+    :param function: a function to run in background
+    :type function: callable object
+    :param name: the job name. the import name of ``function`` by default
+    :type name: :class:`str`
+    :param max_attempts: the number of attempts before giving up
+    :type max_attempts: :class:`int`
+
+    """
+
+    __slots__ = 'function', 'name', 'max_attempts'
+
+    def __init__(self, function, name=None, max_attempts=5):
+        if not callable(function):
+            raise TypeError('function must be callable, but {0!r} is not '
+                            'callable'.format(function))
+        self.function = function
+        self.name = name or '{0}:{1}'.format(function.__module__,
+                                             function.__name__)
+        self.max_attempts = max_attempts
+
+    def enqueue(self, session, *args, **kwargs):
+        """Queues the job. It has to be called inside a transaction.
+
+        :param session: a session to add the job to
+        :type session: :class:`langdev.orm.Session`
+        :returns: a queued job
+        :rtype: :class:`Job`
+
+        """
+        job = Job(name=self.name,
+                  arguments=unicode(json.dumps([args, kwargs])))
+        session.add(job)
+        return job
+
+    def __call__(self, *args, **kwargs):
+        return self.function(*args, **kwargs)
+
+    def __repr__(self):
+        return '<{0}.{1} {2!r}>'.format(__name__, type(self).__name__,
+                                        self.name)
+
+
+def job(function=None, name=None, max_attempts=5):
+    """The decorator that registers a job function into :data:`registry`.
+    ::
+
+        @job
+        def ping(session):
+            pass
+
+        @job(name='forum.purge', max_attempts=10)
+        def purge_post(session, post_id):
+            pass
+
+    :returns: a :class:`JobFunction` object
+    :rtype: :class:`JobFunction`
+
+    """
+    def decorate(function):
+        job_function = JobFunction(function, name, max_attempts)
+        registry[job_function.name] = job_function
+        return job_function
+    if callable(function):
+        return decorate(function)
+    return decorate
+
+
+def enqueue(session, name, *args, **kwargs):
+    """Queues a job by its ``name``. Same as :meth:`JobFunction.enqueue()`.
+
+    :param session: a session to add the job to
+    :type session: :class:`langdev.orm.Session`
+    :param name: a registered job name
+    :type name: :class:`basestring`
+    :returns: a queued job
+    :rtype: :class:`Job`
+
+    """
+    return registry[name].enqueue(session, *args, **kwargs)
+
+
+def backoff(attempts, base=10, maximum=3600):
+    """Computes how long to wait before retrying a job that has failed
+    ``attempts`` times.
+
+    .. sourcecode:: pycon
+
+       >>> backoff(1)
+       datetime.timedelta(0, 10)
+       >>> backoff(3)
+       datetime.timedelta(0, 40)
+       >>> backoff(100)
+       datetime.timedelta(0, 3600)
+
+    :returns: a delay
+    :rtype: :class:`datetime.timedelta`
+
+    """
+    seconds = base * 2 ** min(attempts - 1, 16)
+    return datetime.timedelta(seconds=min(seconds, maximum))
+
+
+def claim(session, worker):
+    """Claims a runnable job. The job is marked as :const:`RUNNING` by
+    a conditional update, so that the same job is never claimed by two
+    workers at once.
+
+    :param session: a session to query
+    :type session: :class:`langdev.orm.Session`
+    :param worker: the name of the worker that claims a job
+    :type worker: :class:`str`
+    :returns: a claimed job, or ``None`` if there are no runnable jobs
+    :rtype: :class:`Job`
+
+    """
+    table = Job.__table__
+    while True:
+        now = datetime.datetime.utcnow()
+        candidates = session.query(Job.id) \
+                            .filter(Job.state == QUEUED) \
+                            .filter(Job.run_at <= now) \
+                            .order_by(Job.run_at, Job.id) \
+                            .limit(10)
+        candidates = [job_id for job_id, in candidates]
+        if not candidates:
+            return
+        for job_id in candidates:
+            with session.begin():
+                result = session.execute(
+                    table.update()
+                         .where(table.c.id == job_id)
+                         .where(table.c.state == QUEUED)
+                         .values(state=RUNNING, worker=worker, started_at=now,
+                                 attempts=table.c.attempts + 1)
+                )
+            if result.rowcount == 1:
+                return session.query(Job).get(job_id)
+
+
+def run(session, job):
+    """Runs the claimed ``job``. When it fails, it will be queued again
+    after :func:`backoff()` or marked as :const:`FAILED`.
+
+    :param session: a session to run the job with
+    :type session: :class:`langdev.orm.Session`
+    :param job: a claimed job to run
+    :type job: :class:`Job`
+    :returns: whether it has succeeded
+    :rtype: :class:`bool`
+
+    """
+    try:
+        function = job.function
+        args, kwargs = json.loads(job.arguments)
+        kwargs = dict((str(k), v) for k, v in kwargs.iteritems())
+        function(session, *args, **kwargs)
+    except Exception:
+        error = traceback.format_exc().decode('utf-8', 'replace')
+        if session.transaction is not None:
+            session.rollback()
+        max_attempts = job.name in registry and job.function.max_attempts or 0
+        with session.begin():
+            job.error = error
+            if job.attempts < max_attempts:
+                job.state = QUEUED
+                job.run_at = datetime.datetime.utcnow() + \
+                             backoff(job.attempts)
+            else:
+                job.state = FAILED
+                job.finished_at = datetime.datetime.utcnow()
+        return False
+    with session.begin():
+        job.state = DONE
+        job.finished_at = datetime.datetime.utcnow()
+    return True
+
+
+def requeue_stale(session, timeout=3600):
+    """Queues :const:`RUNNING` jobs again after :func:`backoff()` if they
+    have started more than ``timeout`` seconds ago. Their workers have
+    probably died, maybe killed by the job itself, so the run counts as a
+    failed attempt (:func:`claim()` has counted it), and jobs that have
+    no attempts left are marked as :const:`FAILED` instead.
+
+    :param session: a session to query
+    :type session: :class:`langdev.orm.Session`
+    :param timeout: seconds
+    :type timeout: :class:`int`
+    :returns: the number of jobs queued again
+    :rtype: :class:`int`
+
+    """
+    table = Job.__table__
+    now = datetime.datetime.utcnow()
+    limit = now - datetime.timedelta(seconds=timeout)
+    stale = session.query(Job.id, Job.name, Job.attempts) \
+                   .filter(Job.state == RUNNING) \
+                   .filter(Job.started_at < limit) \
+                   .all()
+    error = u'the worker has not finished it in {0} seconds'.format(timeout)
+    requeued = 0
+    for job_id, name, attempts in stale:
+        max_attempts = name in registry and registry[name].max_attempts or 0
+        if attempts < max_attempts:
+            values = {'state': QUEUED, 'error': error,
+                      'run_at': now + backoff(attempts)}
+        else:
+            values = {'state': FAILED, 'error': error, 'finished_at': now}
+        # conditional, in case the worker has finished it meanwhile
+        with session.begin():
+            result = session.execute(
+                table.update()
+                     .where(table.c.id == job_id)
+                     .where(table.c.state == RUNNING)
+                     .where(table.c.started_at < limit)
+                     .values(**values)
+            )
+        if result.rowcount == 1 and values['state'] == QUEUED:
+            requeued += 1
+    return requeued
+
+
+def delete_done(session, age=604800, batch_size=1000):
+    """Deletes :const:`DONE` jobs that have finished more than ``age``
+    seconds ago, so that the ``jobs`` table doesn't grow forever.
+    Failed jobs are kept to be looked into.
+
+    :param session: a session to query
+    :type session: :class:`langdev.orm.Session`
+    :param age: seconds. a week by default
+    :type age: :class:`int`
+    :param batch_size: the number of jobs to delete per transaction
+    :type batch_size: :class:`int`
+    :returns: the number of deleted jobs
+    :rtype: :class:`int`
+
+    """
+    table = Job.__table__
+    limit = datetime.datetime.utcnow() - datetime.timedelta(seconds=age)
+    deleted = 0
+    while True:
+        ids = [job_id for job_id, in session.query(Job.id)
+                                            .filter(Job.state == DONE)
+                                            .filter(Job.finished_at < limit)
+                                            .limit(batch_size)]
+        if not ids:
+            return deleted
+        with session.begin():
+            session.execute(table.delete().where(table.c.id.in_(ids)))
+        deleted += len(ids)
+
+
+def stats(session, recent=100):
+    """Gets the statistics of the queue.
+
+    - ``'queued'``: the number of jobs waiting to be run
+    - ``'running'``: the number of running jobs
+    - ``'failed'``: the number of jobs that have given up
+    - ``'oldest'``: seconds the oldest runnable job has waited
+    - ``'latency'``: average seconds between queued and started, of
+      ``recent`` finished jobs
+
+    :param session: a session to query
+    :type session: :class:`langdev.orm.Session`
+    :returns: statistics
+    :rtype: :class:`dict`
+
+    """
+    counts = dict((state, 0) for state in (QUEUED, RUNNING, FAILED))
+    query = session.query(Job.state, functions.count(Job.id)) \
+                   .filter(Job.state != DONE) \
+                   .group_by(Job.state)
+    counts.update(query)
+    now = datetime.datetime.utcnow()
+    oldest = session.query(functions.min(Job.run_at)) \
+                    .filter(Job.state == QUEUED) \
+                    .filter(Job.run_at <= now) \
+                    .scalar()
+    finished = session.query(Job.created_at, Job.started_at) \
+                      .filter(Job.state == DONE) \
+                      .order_by(Job.finished_at.desc()) \
+                      .limit(recent) \
+                      .all()
+    total_seconds = lambda d: d.days * 86400 + d.seconds + d.microseconds / 1e6
+    latency = sum(total_seconds(started - created)
+                  for created, started in finished)
+    return {'queued': counts[QUEUED],
+            'running': counts[RUNNING],
+            'failed': counts[FAILED],
+            'oldest': total_seconds(now - oldest) if oldest else 0.0,
+            'latency': latency / len(finished) if finished else 0.0}
+
+
+class Worker(object):
+    """Runs queued jobs in threads.
+
+    :param engine: a database engine
+    :type engine: :class:`sqlalchemy.engine.base.Engine`
+    :param threads: the number of worker threads
+    :type threads: :class:`int`
+    :param poll_interval: seconds to wait when there are no jobs
+    :type poll_interval: :class:`numbers.Real`
+    :param context: an optional function that returns a context manager
+                    every thread runs in e.g.
+                    :meth:`flask.Flask.test_request_context`
+    :type context: callable object
+    :param stale_timeout: seconds after which running jobs are queued
+                          again by :func:`requeue_stale()`
+    :type stale_timeout: :class:`int`
+    :param keep_done: seconds to keep finished jobs for, before
+                      :func:`delete_done()` deletes them
+    :type keep_done: :class:`int`
+
+    """
+
+    def __init__(self, engine, threads=1, poll_interval=1, context=None,
+                 stale_timeout=3600, keep_done=604800):
+        self.engine = engine
+        self.threads = threads
+        self.poll_interval = poll_interval
+        self.context = context
+        self.stale_timeout = stale_timeout
+        self.keep_done = keep_done
+        self.stopped = threading.Event()
+        self.name = '{0}:{1}'.format(socket.gethostname(),
+                                     os.getpid())
+
+    def work(self, name):
+        """The loop each thread runs."""
+        session = langdev.orm.Session(bind=self.engine)
+        while not self.stopped.is_set():
+            job = claim(session, name)
+            if job is None:
+                self.stopped.wait(self.poll_interval)
+                continue
+            if not run(session, job):
+                print>>sys.stderr, u'{0} has failed:\n{1}'.format(job,
+                                                                   job.error)
+            session.expunge_all()
+
+    def _work(self, name):
+        if self.context is None:
+            self.work(name)
+        else:
+            with self.context():
+                self.work(name)
+
+    def maintain(self):
+        """Queues stale jobs again and deletes old finished jobs.
+        :meth:`run()` calls it every :attr:`stale_timeout` / 10 seconds.
+
+        """
+        session = langdev.orm.Session(bind=self.engine)
+        requeued = requeue_stale(session, self.stale_timeout)
+        if requeued:
+            print '{0} stale jobs have queued again'.format(requeued)
+        delete_done(session, self.keep_done)
+
+    def run(self):
+        """Starts threads and blocks until :meth:`stop()` is called or
+        :exc:`KeyboardInterrupt` is raised. Meanwhile, it calls
+        :meth:`maintain()` periodically.
+
+        """
+        threads = []
+        for i in xrange(self.threads):
+            name = '{0}:{1}'.format(self.name, i)
+            thread = threading.Thread(target=self._work, args=(name,))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        maintained_at = None
+        try:
+            while any(thread.is_alive() for thread in threads):
+                now = time.time()
+                if maintained_at is None or \
+                   now - maintained_at >= self.stale_timeout / 10.0:
+                    maintained_at = now
+                    try:
+                        self.maintain()
+                    except Exception:
+                        # e.g. the database is down for a moment; the next
+                        # round will do it
+                        traceback.print_exc()
+                time.sleep(0.5)
+        except KeyboardInterrupt:
+            self.stop()
+        for thread in threads:
+            thread.join()
+
+    def stop(self):
+        """Stops all threads after their current jobs."""
+        self.stopped.set()
@@ -0,0 +1,258 @@
+""":mod:`langdev.mail` --- Outbound mail queue
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Sending a mail through SMTP can take seconds, so web pages don't send
+mails by themselves. Instead, they put messages into the durable queue
+table, and then :program:`manage_langdev.py mailer` sends them in batches
+reusing a SMTP connection::
+
+    msg = Message('Subject', recipients=['hong.minhee@gmail.com'])
+    msg.body = 'Hello'
+    with session.begin():
+        langdev.mail.enqueue(session, msg)
+
+A sender leases mails it claims for :const:`CLAIM_TIMEOUT`, and mails
+that have failed are tried again after :func:`langdev.job.backoff()`
+until :const:`MAX_ATTEMPTS` is exceeded.
+
+.. seealso:: Flask-Mail_
+
+.. _Flask-Mail: http://packages.python.org/Flask-Mail/
+
+"""
+import socket
+import smtplib
+import datetime
+from sqlalchemy import *
+from sqlalchemy.sql import functions
+from flaskext.mail import Message
+import langdev.orm
+import langdev.job
+
+__all__ = ('MAX_ATTEMPTS', 'CLAIM_TIMEOUT', 'RETRY_DELAY', 'QueuedMail',
+           'enqueue', 'queue_depth', 'claim', 'send_queued')
+
+
+#: The number of attempts to send a mail before giving up.
+MAX_ATTEMPTS = 5
+
+#: (:class:`datetime.timedelta`) How long a claimed mail is left alone by
+#: other senders. If the sender dies meanwhile, it is tried again after it.
+CLAIM_TIMEOUT = datetime.timedelta(minutes=10)
+
+#: Seconds to wait before the first retry of a failed mail. It doubles
+#: on every failure.
+RETRY_DELAY = 60
+
+
+class QueuedMail(langdev.orm.Base):
+    """A queued outbound mail."""
+
+    __tablename__ = 'mail_queue'
+
+    #: Unique primary key. It also determines the sending order.
+    id = Column(Integer, primary_key=True)
+
+    #: Sender address.
+    sender = Column(Unicode(255))
+
+    #: Recipient addresses separated by newlines.
+    recipients = Column(UnicodeText, nullable=False)
+
+    #: CC addresses separated by newlines.
+    cc = Column(UnicodeText)
+
+    #: BCC addresses separated by newlines.
+    bcc = Column(UnicodeText)
+
+    #: Mail subject.
+    subject = Column(UnicodeText, nullable=False)
+
+    #: Plain text content.
+    body = Column(UnicodeText)
+
+    #: HTML content.
+    html = Column(UnicodeText)
+
+    #: The number of attempts to send.
+    attempts = Column(Integer, nullable=False, default=0)
+
+    #: The latest error message, if any.
+    error = Column(UnicodeText)
+
+    #: (:class:`datetime.datetime`) The time it can be sent after. It is
+    #: :const:`CLAIM_TIMEOUT` later than the claimed time while a sender
+    #: is sending it, and pushed back when sending has failed. ``None``
+    #: if it has never been claimed.
+    next_attempt_at = Column(DateTime)
+
+    #: (:class:`datetime.datetime`) Queued time.
+    created_at = Column(DateTime(timezone=True), nullable=False,
+                        default=functions.now())
+
+    #: (:class:`datetime.datetime`) Sent time. ``None`` if not sent yet.
+    sent_at = Column(DateTime(timezone=True), index=True)
+
+    @classmethod
+    def from_message(cls, message):
+        """Makes a :class:`QueuedMail` from a Flask-Mail message.
+
+        :param message: a message to queue
+        :type message: :class:`flaskext.mail.Message`
+        :returns: a queued mail (not added to any session yet)
+        :rtype: :class:`QueuedMail`
+
+        """
+        if message.attachments:
+            raise ValueError('attachments cannot be queued')
+        def text(value):
+            if isinstance(value, str):
+                return value.decode('utf-8')
+            return value
+        join = lambda addrs: u'\n'.join(map(text, addrs)) if addrs else None
+        return cls(sender=text(message.sender),
+                   recipients=join(message.recipients),
+                   cc=join(message.cc),
+                   bcc=join(message.bcc),
+                   subject=text(message.subject),
+                   body=text(message.body),
+                   html=text(message.html))
+
+    def to_message(self):
+        """Restores the Flask-Mail message.
+
+        :returns: a message to send
+        :rtype: :class:`flaskext.mail.Message`
+
+        """
+        split = lambda addrs: addrs.split(u'\n') if addrs else None
+        return Message(self.subject,
+                       recipients=split(self.recipients),
+                       body=self.body,
+                       html=self.html,
+                       sender=self.sender,
+                       cc=split(self.cc),
+                       bcc=split(self.bcc))
+
+
+def enqueue(session, message):
+    """Puts the ``message`` into the queue. It has to be called inside
+    a transaction.
+
+    :param session: a session to add the message to
+    :type session: :class:`langdev.orm.Session`
+    :param message: a message to send
+    :type message: :class:`flaskext.mail.Message`
+    :returns: a queued mail
+    :rtype: :class:`QueuedMail`
+
+    """
+    queued = QueuedMail.from_message(message)
+    session.add(queued)
+    return queued
+
+
+def queue_depth(session):
+    """Counts mails waiting to be sent, except ones claimed by a sender or
+    waiting to retry.
+
+    :param session: a session to query
+    :type session: :class:`langdev.orm.Session`
+    :returns: the number of mails to send
+    :rtype: :class:`int`
+
+    """
+    return _sendable(session.query(QueuedMail),
+                     datetime.datetime.utcnow()).count()
+
+
+def _sendable(query, now):
+    """Filters the ``query`` of :class:`QueuedMail` to mails that can be
+    sent at ``now``: not sent yet, have attempts left, and neither claimed
+    by a sender nor waiting to retry.
+
+    """
+    return query.filter(QueuedMail.sent_at == None) \
+                .filter(QueuedMail.attempts < MAX_ATTEMPTS) \
+                .filter(or_(QueuedMail.next_attempt_at == None,
+                            QueuedMail.next_attempt_at <= now))
+
+
+def claim(session, queued):
+    """Increases :attr:`~QueuedMail.attempts` of the ``queued`` mail and
+    leases it for :const:`CLAIM_TIMEOUT` only if another sender hasn't done
+    it yet, so that a mail isn't sent twice by concurrent senders.
+
+    :returns: whether it has been claimed
+    :rtype: :class:`bool`
+
+    """
+    table = QueuedMail.__table__
+    now = datetime.datetime.utcnow()
+    with session.begin():
+        result = session.execute(
+            table.update()
+                 .where(table.c.id == queued.id)
+                 .where(table.c.attempts == queued.attempts)
+                 .where(table.c.sent_at == None)
+                 .where(or_(table.c.next_attempt_at == None,
+                            table.c.next_attempt_at <= now))
+                 .values(attempts=table.c.attempts + 1,
+                         next_attempt_at=now + CLAIM_TIMEOUT)
+        )
+    session.expire(queued, ['attempts', 'next_attempt_at'])
+    return result.rowcount == 1
+
+
+def send_queued(session, mail, limit=100):
+    """Sends at most ``limit`` queued mails through a single SMTP connection.
+
+    :param session: a session to query
+    :type session: :class:`langdev.orm.Session`
+    :param mail: a mail manager
+    :type mail: :class:`flaskext.mail.Mail`
+    :param limit: the maximum number of mails to send at once
+    :type limit: :class:`int`
+    :returns: the number of sent mails
+    :rtype: :class:`int`
+
+    """
+    query = _sendable(session.query(QueuedMail), datetime.datetime.utcnow())
+    queued = query.order_by(QueuedMail.id).limit(limit).all()
+    if not queued:
+        return 0
+    sent = 0
+    try:
+        with mail.connect() as connection:
+            if connection.host is None and not mail.suppress:
+                # the connection has failed silently; try again later
+                return 0
+            for queued_mail in queued:
+                if not claim(session, queued_mail):
+                    continue
+                try:
+                    connection.send(queued_mail.to_message())
+                except (smtplib.SMTPException, socket.error) as e:
+                    delay = langdev.job.backoff(queued_mail.attempts,
+                                                base=RETRY_DELAY)
+                    with session.begin():
+                        queued_mail.error = unicode(e)
+                        queued_mail.next_attempt_at = \
+                            datetime.datetime.utcnow() + delay
+                    if isinstance(e, (smtplib.SMTPServerDisconnected,
+                                      socket.error)):
+                        # the connection is dead, so it can't even quit
+                        if connection.host is not None:
+                            connection.host.close()
+                            connection.host = None
+                        break
+                    continue
+                with session.begin():
+                    queued_mail.sent_at = functions.now()
+                    queued_mail.error = None
+                sent += 1
+    except (smtplib.SMTPException, socket.error):
+        # connecting or quitting has failed; unsent mails are left in the
+        # queue to try again later
+        pass
+    return sent
@@ -4,13 +4,14 @@
 """
 import collections
 import langdev.util.visitor
+import langdev.orm
 import langdev.user
 import langdev.forum
 import langdev.thirdparty
 
 
 def simplify(value, identifier_map, type_map={}, url_map=None, user=None,
-             **extra):
+             archive=None, **extra):
     """Simplifies a given :data:`value`.
     
     :param value: an object to simplify
@@ -26,6 +27,9 @@ def simplify(value, identifier_map, type_map={}, url_map=None, user=None,
     :type url_map: callable object
     :param user: an user object for signing
     :type user: :class:`langdev.user.User`
+    :param archive: the archive whose posts and comments are counted for
+                    users as well
+    :type archive: :class:`langdev.archive.Archive`
     :param under_list: whether :data:`value` is contained by a list.
                        :data:`False` by default
     :param under_list: :clasS:`bool`
@@ -36,13 +40,19 @@ def simplify(value, identifier_map, type_map={}, url_map=None, user=None,
     options.update({'identifier_map': identifier_map,
                     'type_map': type_map,
                     'url_map': url_map,
-                    'user': user})
+                    'user': user,
+                    'archive': archive})
+    author_counts = options.get('author_counts')
+    if author_counts is None:
+        author_counts = options['author_counts'] = AuthorCounts(archive)
     if type(value) in transform:
         d = transform(value, **options)
     elif hasattr(value, '__iter__'):
         d = transform[collections.Iterable](value, **options)
     else:
         d = value
+    if 'author_counts' not in extra:
+        author_counts.fill()
     try:
         mapf = type_map[type(d)]
     except KeyError:
@@ -113,6 +123,46 @@ def camelCase(identifier):
     return ''.join(words)
 
 
+class AuthorCounts(object):
+    """Counts posts and comments of users that :func:`simplify()` has
+    serialized, all at once after the whole value is simplified, instead
+    of querying for each user.
+
+    :param archive: the archive whose posts and comments are counted as
+                    well
+    :type archive: :class:`langdev.archive.Archive`
+
+    """
+
+    def __init__(self, archive=None):
+        self.archive = archive
+        self.session = None
+        #: Simplified users to fill counts in, by user ids. Each is a pair
+        #: of the dictionary and the options it has been simplified with.
+        self.pending = {}
+
+    def add(self, user, d, options):
+        """Puts counts of the ``user`` into the simplified ``d`` later."""
+        if self.session is None:
+            self.session = langdev.orm.Session.object_session(user)
+        self.pending.setdefault(user.id, []).append((d, options))
+
+    def fill(self):
+        if not self.pending:
+            return
+        if self.archive is not None:
+            counts = self.archive.count_authored(self.pending)
+        else:
+            counts = langdev.forum.count_authored(self.session, self.pending)
+        for user_id, simplified in self.pending.iteritems():
+            posts, comments = counts.get(user_id, (0, 0))
+            for d, options in simplified:
+                idmap = options['identifier_map']
+                d[idmap('posts count')] = simplify(posts, **options)
+                d[idmap('comments count')] = simplify(comments, **options)
+        self.pending.clear()
+
+
 class Result(dict):
     """A dictionary subclass that contains the result. All keys are
     :func:`idmap`-ed and all values are :func:`simplify`-ed during
@@ -151,6 +201,22 @@ def transform(value, **options):
 
 
 @transform.visit(langdev.user.User)
+def transform(value, **options):
+    idmap = options['identifier_map']
+    d = {idmap('ID'): simplify(value.id, **options),
+         idmap('login'): simplify(value.login, **options),
+         idmap('name'): simplify(value.name, **options),
+         idmap('url'): simplify(value.url, **options),
+         idmap('created at'): simplify(value.created_at, **options)}
+    options['author_counts'].add(value, d, options)
+    user = options['user']
+    # the value may be of another session, e.g. of the archive
+    if user is not None and user.id == value.id:
+        d[idmap('email')] = simplify(value.email, **options)
+    return d
+
+
+@transform.visit(langdev.user.UserEntry)
 def transform(value, **options):
     idmap = options['identifier_map']
     d = {idmap('ID'): simplify(value.id, **options),
@@ -158,10 +224,10 @@ def transform(value, **options):
          idmap('name'): simplify(value.name, **options),
          idmap('url'): simplify(value.url, **options),
          idmap('created at'): simplify(value.created_at, **options),
-         idmap('posts count'): simplify(value.posts.count(), **options),
-         idmap('comments count'): simplify(value.comments.count(),
-                                           **options)}
-    if options['user'] == value:
+         idmap('posts count'): simplify(value.posts_count, **options),
+         idmap('comments count'): simplify(value.comments_count, **options)}
+    user = options['user']
+    if user is not None and user.id == value.id:
         d[idmap('email')] = simplify(value.email, **options)
     return d
 
@@ -169,17 +235,35 @@ def transform(value, **options):
 @transform.visit(langdev.forum.Post)
 def transform(value, **options):
     idmap = options['identifier_map']
+    comments = value.comments.filter(langdev.forum.Comment.hidden == False)
     d = {idmap('ID'): simplify(value.id, **options),
          idmap('author'): simplify(value.author, **options),
          idmap('title'): simplify(value.title, **options),
          idmap('sticky'): simplify(value.sticky, **options),
          idmap('created at'): simplify(value.created_at, **options),
          idmap('modified at'): simplify(value.modified_at, **options),
-         idmap('comments count'): simplify(value.comments.count(), **options),
+         idmap('comments count'): simplify(comments.count(), **options),
          idmap('replies count'): simplify(value.replies.count(), **options)}
     if not options.get('under_list'):
         d[idmap('body')] = simplify(value.body, **options)
-        d[idmap('replies')] = simplify(value.replies, **options)
+        d[idmap('replies')] = simplify(langdev.forum.CommentTree.load(value),
+                                       **options)
+    return d
+
+
+@transform.visit(langdev.forum.PostEntry)
+def transform(value, **options):
+    idmap = options['identifier_map']
+    d = {idmap('ID'): simplify(value.id, **options),
+         idmap('author'): simplify(value.author, **options),
+         idmap('title'): simplify(value.title, **options),
+         idmap('sticky'): simplify(value.sticky, **options),
+         idmap('created at'): simplify(value.created_at, **options),
+         idmap('modified at'): simplify(value.modified_at, **options),
+         idmap('comments count'): simplify(value.comments_count, **options),
+         idmap('replies count'): simplify(value.replies_count, **options)}
+    if value.body is not None and not options.get('under_list'):
+        d[idmap('body')] = simplify(value.body, **options)
     return d
 
 
@@ -193,10 +277,30 @@ def transform(value, **options):
          idmap('replies count'): simplify(value.replies.count(), **options)}
     if not options.get('under_list'):
         d[idmap('post')] = simplify(value.post, **options)
-        d[idmap('replies')] = simplify(value.replies, **options)
+        tree = langdev.forum.CommentTree.load(value.post, value)
+        d[idmap('replies')] = simplify(tree, **options)
     return d
 
 
+@transform.visit(langdev.forum.CommentTree)
+def transform(value, **options):
+    idmap = options['identifier_map']
+    def replies(parent):
+        result = []
+        for comment in value.replies(parent):
+            count = value.counts.get(comment.id, 0)
+            result.append({
+                idmap('ID'): simplify(comment.id, **options),
+                idmap('author'): simplify(comment.author, **options),
+                idmap('body'): simplify(comment.body, **options),
+                idmap('created at'): simplify(comment.created_at, **options),
+                idmap('replies count'): simplify(count, **options),
+                idmap('replies'): replies(comment)
+            })
+        return result
+    return replies(None)
+
+
 @transform.visit(langdev.thirdparty.Application)
 def transform(value, **options):
     idmap = options['identifier_map']
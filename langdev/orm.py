@@ -20,7 +20,15 @@ In order to define persist model class, just subclass :class:`Base`::
 .. _SQLAlchemy: http://www.sqlalchemy.org/
 
 """
+import re
+import zlib
+import base64
 import sqlalchemy.orm
+import sqlalchemy.types
+import sqlalchemy.schema
+import sqlalchemy.sql.expression
+import sqlalchemy.engine.reflection
+import sqlalchemy.ext.compiler
 import sqlalchemy.ext.declarative
 
 
@@ -53,3 +61,309 @@ def make_repr(self):
 
 Base.__repr__ = make_repr
 
+
+class CompressedText(sqlalchemy.types.TypeDecorator):
+    """Unicode text that is compressed if it takes ``threshold`` bytes or
+    more in UTF-8, e.g. bodies with pasted code and logs. Compressed values
+    are still text, so that columns don't have to be altered: zlib-deflated
+    UTF-8 in Base64, prefixed by :attr:`MARKER`.
+
+    .. sourcecode:: pycon
+
+       >>> text = CompressedText(threshold=100)
+       >>> text.compress(u'short text')
+       u'short text'
+       >>> stored = text.compress(u'long text ' * 100)
+       >>> stored.startswith(CompressedText.MARKER), len(stored)
+       (True, 42)
+       >>> text.decompress(stored) == u'long text ' * 100
+       True
+
+    Values are stored as they are if compression doesn't make them
+    shorter, except for ones that begin with :attr:`MARKER`. They are
+    always compressed, so that they aren't mistaken for compressed ones.
+
+    :param threshold: the minimum size in bytes to compress
+    :type threshold: :class:`int`
+    :param level: the :mod:`zlib` compression level
+    :type level: :class:`int`
+
+    """
+
+    impl = sqlalchemy.types.UnicodeText
+
+    #: The prefix of compressed values.
+    MARKER = u'\x1bzlib:'
+
+    def __init__(self, threshold=1024, level=6, *args, **kwargs):
+        super(CompressedText, self).__init__(*args, **kwargs)
+        self.threshold = threshold
+        self.level = level
+
+    def compress(self, value):
+        """Makes the stored form of the ``value``."""
+        if value is None:
+            return None
+        encoded = value.encode('utf-8')
+        marked = value.startswith(self.MARKER)
+        if len(encoded) < self.threshold and not marked:
+            return value
+        compressed = zlib.compress(encoded, self.level)
+        compressed = self.MARKER + base64.b64encode(compressed).decode()
+        if marked or len(compressed) < len(encoded):
+            return compressed
+        return value
+
+    def decompress(self, value):
+        """Restores the ``value`` from its stored form."""
+        if value is None or not value.startswith(self.MARKER):
+            return value
+        compressed = base64.b64decode(value[len(self.MARKER):])
+        return zlib.decompress(compressed).decode('utf-8')
+
+    def process_bind_param(self, value, dialect):
+        return self.compress(value)
+
+    def process_result_value(self, value, dialect):
+        return self.decompress(value)
+
+
+#: The list of registered data migration functions. They are run by
+#: :program:`manage_langdev.py upgradedb` after :func:`upgrade_schema()`.
+#:
+#: .. seealso:: :func:`migration()`
+migrations = []
+
+
+def migration(function):
+    """Registers a data migration function. The function takes a session,
+    and returns the number of migrated rows. It has to be idempotent,
+    because it is run on every upgrade::
+
+        @langdev.orm.migration
+        def fill_things(session):
+            ...
+
+    """
+    migrations.append(function)
+    return function
+
+
+def upgrade_schema(engine, metadata=Base.metadata, tables=None):
+    """Upgrades the schema of the existing database to the ``metadata``.
+    It creates missing tables, adds missing columns and creates missing
+    indexes. It never drops or alters anything.
+
+    Columns to be added have to be nullable or have a ``server_default``.
+
+    :param engine: a database engine
+    :type engine: :class:`sqlalchemy.engine.base.Engine`
+    :param metadata: the metadata to upgrade to. :attr:`Base.metadata` by
+                     default
+    :type metadata: :class:`sqlalchemy.schema.MetaData`
+    :param tables: tables of the ``metadata`` to upgrade. all of them if
+                   omitted
+    :type tables: :class:`collections.Container`
+    :returns: the list of applied changes in strings
+    :rtype: :class:`list`
+
+    """
+    Inspector = sqlalchemy.engine.reflection.Inspector
+    inspector = Inspector.from_engine(engine)
+    existing_tables = set(inspector.get_table_names())
+    changes = []
+    for table in metadata.sorted_tables:
+        if tables is not None and table not in tables:
+            continue
+        if table.name not in existing_tables:
+            table.create(bind=engine)
+            changes.append('create table ' + table.name)
+            continue
+        columns = set(c['name'] for c in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name in columns:
+                continue
+            ddl = 'ALTER TABLE {0} ADD COLUMN {1} {2}'.format(
+                table.name, column.name,
+                column.type.compile(dialect=engine.dialect)
+            )
+            if column.server_default is not None:
+                default = column.server_default.arg
+                if not isinstance(default, basestring):
+                    default = default.compile(dialect=engine.dialect)
+                ddl += ' DEFAULT {0}'.format(default)
+                if not column.nullable:
+                    ddl += ' NOT NULL'
+            engine.execute(ddl)
+            changes.append('add column {0}.{1}'.format(table.name,
+                                                       column.name))
+    for index in missing_indexes(engine, metadata, tables):
+        create_index(engine, index)
+        changes.append('create index ' + index.name)
+    return changes
+
+
+def missing_indexes(engine, metadata=Base.metadata, tables=None):
+    """Finds indexes declared in the ``metadata`` but not in the database.
+    Indexes of tables that don't exist yet are not included.
+
+    :param engine: a database engine
+    :type engine: :class:`sqlalchemy.engine.base.Engine`
+    :param metadata: the metadata to compare with. :attr:`Base.metadata`
+                     by default
+    :type metadata: :class:`sqlalchemy.schema.MetaData`
+    :param tables: tables of the ``metadata`` to compare. all of them if
+                   omitted
+    :type tables: :class:`collections.Container`
+    :returns: the list of missing indexes
+    :rtype: :class:`list`
+
+    """
+    Inspector = sqlalchemy.engine.reflection.Inspector
+    inspector = Inspector.from_engine(engine)
+    existing_tables = set(inspector.get_table_names())
+    missing = []
+    for table in metadata.sorted_tables:
+        if table.name not in existing_tables or \
+           tables is not None and table not in tables:
+            continue
+        indexes = set(i['name'] for i in inspector.get_indexes(table.name))
+        missing.extend(index for index in table.indexes
+                             if index.name not in indexes)
+    return missing
+
+
+def create_index(engine, index):
+    """Creates the ``index``. On PostgreSQL it is built concurrently, so
+    that the table can be written while the index is being built.
+
+    :param engine: a database engine
+    :type engine: :class:`sqlalchemy.engine.base.Engine`
+    :param index: an index to create
+    :type index: :class:`sqlalchemy.schema.Index`
+
+    """
+    if engine.dialect.name != 'postgresql':
+        index.create(bind=engine)
+        return
+    ddl = sqlalchemy.schema.CreateIndex(index).compile(dialect=engine.dialect)
+    ddl = re.sub(r'^CREATE (UNIQUE )?INDEX', r'\g<0> CONCURRENTLY',
+                 unicode(ddl))
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction block
+    connection = engine.raw_connection()
+    try:
+        dbapi_connection = connection.connection
+        isolation_level = dbapi_connection.isolation_level
+        dbapi_connection.set_isolation_level(0)
+        try:
+            connection.cursor().execute(ddl)
+        finally:
+            dbapi_connection.set_isolation_level(isolation_level)
+    finally:
+        connection.close()
+
+
+@migration
+def fill_modified_at(session, tables=None, batch_size=500):
+    """Fills ``modified_at`` columns that have been added to existing
+    tables by their ``created_at``, ``batch_size`` rows per transaction.
+
+    :param tables: tables to fill. all tables of :attr:`Base.metadata` if
+                   omitted
+    :type tables: :class:`collections.Iterable`
+    :returns: the number of filled rows
+    :rtype: :class:`int`
+
+    """
+    if tables is None:
+        tables = Base.metadata.sorted_tables
+    filled = 0
+    for table in tables:
+        if 'modified_at' not in table.c or 'created_at' not in table.c:
+            continue
+        key = list(table.primary_key.columns)[0]
+        query = sqlalchemy.sql.select([key], table.c.modified_at == None) \
+                              .limit(batch_size)
+        while True:
+            ids = [id for id, in session.execute(query)]
+            if not ids:
+                break
+            with session.begin():
+                session.execute(table.update()
+                                     .where(key.in_(ids))
+                                     .values(modified_at=table.c.created_at))
+            filled += len(ids)
+    return filled
+
+
+class Explain(sqlalchemy.sql.expression.Executable,
+              sqlalchemy.sql.expression.ClauseElement):
+    """The ``EXPLAIN`` statement of the given ``statement``. On SQLite
+    it is ``EXPLAIN QUERY PLAN``.
+
+    :param statement: a statement to explain
+    :type statement: :class:`sqlalchemy.sql.expression.ClauseElement`
+
+    """
+
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@sqlalchemy.ext.compiler.compiles(Explain)
+def compile_explain(element, compiler, **kw):
+    if compiler.dialect.name == 'sqlite':
+        prefix = 'EXPLAIN QUERY PLAN '
+    else:
+        prefix = 'EXPLAIN '
+    return prefix + compiler.process(element.statement)
+
+
+def explain(bind, statement):
+    """Gets the query plan of the ``statement``.
+
+    :param bind: an engine or a connection to query
+    :param statement: a statement or a query to explain
+    :type statement: :class:`sqlalchemy.sql.expression.ClauseElement`,
+                     :class:`sqlalchemy.orm.query.Query`
+    :returns: the list of plan lines
+    :rtype: :class:`list`
+
+    """
+    if isinstance(statement, sqlalchemy.orm.Query):
+        statement = statement.statement
+    return [tuple(row)[-1] for row in bind.execute(Explain(statement))]
+
+
+def plan_warnings(plan):
+    """Finds full table scans and sorts in temporary storage from the
+    query ``plan``, which is a result of :func:`explain()`.
+
+    >>> plan_warnings(['SCAN posts',
+    ...                'SEARCH users USING INTEGER PRIMARY KEY (rowid=?)',
+    ...                'USE TEMP B-TREE FOR ORDER BY'])
+    ['full scan: SCAN posts', 'temporary sort: USE TEMP B-TREE FOR ORDER BY']
+    >>> plan_warnings(['SCAN TABLE posts USING INDEX ix_posts_created_at'])
+    []
+    >>> plan_warnings(['Limit  (cost=0.00..1.00 rows=20 width=8)',
+    ...                '  ->  Sort  (cost=0.00..1.00 rows=20 width=8)',
+    ...                '        ->  Seq Scan on posts  (cost=0.00..1.00)'])
+    ... # doctest: +NORMALIZE_WHITESPACE
+    ['temporary sort: ->  Sort  (cost=0.00..1.00 rows=20 width=8)',
+     'full scan: ->  Seq Scan on posts  (cost=0.00..1.00)']
+
+    :param plan: the list of plan lines
+    :type plan: :class:`list`
+    :returns: the list of warning messages
+    :rtype: :class:`list`
+
+    """
+    warnings = []
+    for line in plan:
+        line = line.strip()
+        if re.match(r'^SCAN (TABLE )?\w+( AS \w+)?$', line) or \
+           'Seq Scan on ' in line:
+            warnings.append('full scan: ' + line)
+        elif 'TEMP B-TREE' in line or re.match(r'^(->\s+)?Sort\b', line):
+            warnings.append('temporary sort: ' + line)
+    return warnings
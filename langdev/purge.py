@@ -0,0 +1,174 @@
+""":mod:`langdev.purge` --- Batched deletion in background
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Deleting a post with thousands of comments, or a user who has written
+a lot, in a single transaction locks the database for a long time.
+Instead, web pages mark the row as :attr:`~langdev.forum.Post.hidden`
+and queue one of the following jobs. They delete dependent rows
+:data:`BATCH_SIZE` rows per transaction, so that the lock is held for
+a bounded time no matter how much content is removed::
+
+    with session.begin():
+        post.hidden = True
+        langdev.purge.purge_post.enqueue(session, post.id)
+
+All jobs are idempotent, so they can be retried safely.
+
+.. seealso:: Module :mod:`langdev.job`
+
+"""
+import flask
+from langdev.job import job
+from langdev.user import User
+from langdev.forum import Post, Comment, log_changes
+from langdev.thirdparty import Application
+import langdev.web
+
+__all__ = 'BATCH_SIZE', 'purge_post', 'purge_comment', 'purge_user'
+
+
+#: The number of rows to delete per transaction.
+BATCH_SIZE = 200
+
+
+def delete_batches(session, query, column):
+    """Deletes rows whose ``column`` values are selected by the ``query``,
+    :data:`BATCH_SIZE` rows per transaction.
+
+    :param session: a session to delete rows with
+    :type session: :class:`langdev.orm.Session`
+    :param query: a query that selects ``column`` only
+    :type query: :class:`sqlalchemy.orm.query.Query`
+    :param column: a unique column of the table to delete rows from
+    :type column: :class:`sqlalchemy.schema.Column`
+    :returns: the number of deleted rows
+    :rtype: :class:`int`
+
+    """
+    table = column.table
+    deleted = 0
+    while True:
+        ids = [id for id, in query.limit(BATCH_SIZE)]
+        if not ids:
+            return deleted
+        with session.begin():
+            session.execute(table.delete().where(column.in_(ids)))
+        deleted += len(ids)
+
+
+def delete_ids(session, ids, column):
+    """Deletes rows whose ``column`` values are in ``ids``,
+    :data:`BATCH_SIZE` rows per transaction in the given order.
+
+    """
+    table = column.table
+    for i in xrange(0, len(ids), BATCH_SIZE):
+        with session.begin():
+            session.execute(
+                table.delete().where(column.in_(ids[i:i + BATCH_SIZE]))
+            )
+    return len(ids)
+
+
+def descendant_ids(session, comment_ids):
+    """Finds all descendants of comments. Every descendant comes after its
+    ancestors.
+
+    :param session: a session to query
+    :type session: :class:`langdev.orm.Session`
+    :param comment_ids: comment ids to find descendants
+    :type comment_ids: :class:`list`
+    :returns: the list of descendant comment ids
+    :rtype: :class:`list`
+
+    """
+    descendants = []
+    for i in xrange(0, len(comment_ids), BATCH_SIZE):
+        roots = session.query(Comment.post_id, Comment.path) \
+                       .filter(Comment.id.in_(comment_ids[i:i + BATCH_SIZE]))
+        for post_id, path in roots:
+            query = session.query(Comment.id) \
+                           .filter(Comment.post_id == post_id) \
+                           .filter(Comment.path > path) \
+                           .filter(Comment.path < path + 'g') \
+                           .order_by(Comment.path)
+            descendants.extend(id for id, in query)
+    return descendants
+
+
+@job(name='langdev.purge:purge_post')
+def purge_post(session, post_id):
+    """Deletes the post and its comments."""
+    # children have greater ids than their parents
+    comments = session.query(Comment.id) \
+                      .filter_by(post_id=post_id) \
+                      .order_by(Comment.id.desc())
+    delete_batches(session, comments, Comment.__table__.c.id)
+    with session.begin():
+        session.execute(Post.__table__.delete().where(Post.id == post_id))
+
+
+@job(name='langdev.purge:purge_comment')
+def purge_comment(session, comment_id):
+    """Deletes the comment and its replies."""
+    ids = descendant_ids(session, [comment_id])
+    ids.reverse()
+    ids.append(comment_id)
+    delete_ids(session, ids, Comment.__table__.c.id)
+
+
+@job(name='langdev.purge:purge_user')
+def purge_user(session, user_id):
+    """Deletes the user and its posts, comments and applications. If it
+    runs in the application context as the worker runs jobs, posts that
+    the user has written or commented on are restored from the archive
+    first, so that they are deleted as well.
+
+    """
+    if flask.current_app:
+        archive = langdev.web.get_archive(flask.current_app.config)
+        if archive is not None:
+            archive.restore_user(user_id)
+    apps = session.query(Application.key).filter_by(owner_id=user_id)
+    delete_batches(session, apps, Application.__table__.c.key)
+    posts = Post.__table__
+    # hide posts first, so that they disappear from listings soon
+    visible = session.query(Post.id).filter_by(author_id=user_id,
+                                               hidden=False)
+    while True:
+        post_ids = [id for id, in visible.limit(BATCH_SIZE)]
+        if not post_ids:
+            break
+        with session.begin():
+            session.execute(posts.update()
+                                 .where(posts.c.id.in_(post_ids))
+                                 .values(hidden=True))
+            log_changes(session.connection(), 'post', 'deleted',
+                        [(id, id) for id in post_ids])
+    while True:
+        post_ids = [id for id, in session.query(Post.id)
+                                         .filter_by(author_id=user_id)
+                                         .limit(BATCH_SIZE)]
+        if not post_ids:
+            break
+        for post_id in post_ids:
+            purge_post(session, post_id)
+    while True:
+        comments = session.query(Comment.id, Comment.post_id, Comment.hidden) \
+                          .filter_by(author_id=user_id) \
+                          .order_by(Comment.id.desc()) \
+                          .limit(BATCH_SIZE) \
+                          .all()
+        if not comments:
+            break
+        comment_ids = [id for id, post_id, hidden in comments]
+        with session.begin():
+            log_changes(session.connection(), 'comment', 'deleted',
+                        [(id, post_id)
+                         for id, post_id, hidden in comments if not hidden])
+        ids = descendant_ids(session, comment_ids)
+        ids.reverse()
+        ids.extend(comment_ids)
+        delete_ids(session, ids, Comment.__table__.c.id)
+    with session.begin():
+        session.execute(User.__table__.delete().where(User.id == user_id))
@@ -71,6 +71,13 @@ class Application(langdev.orm.Base):
                                      default=functions.now()),
                               group='info')
 
+    #: (:class:`datetime.datetime`) Lastly modified time, for incremental
+    #: exports. ``NULL`` only in rows older than the column until
+    #: :func:`~langdev.orm.fill_modified_at()` fills it.
+    modified_at = orm.deferred(Column(DateTime(timezone=True),
+                                      default=functions.now(),
+                                      onupdate=functions.now()))
+
     __tablename__ = 'applications'
 
     def hmac(self, string):
@@ -0,0 +1,292 @@
+""":mod:`langdev.timeline` --- In-memory index of the post listing
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+The listing of posts (sticky ones first, and then the latest first) is
+the same sequence for every reader, but counting it and skipping
+``offset`` rows of it cost the database time in proportion to the number
+of posts. :class:`Timeline` keeps the ids of visible posts in listing
+order in :mod:`array`\ s instead, 16 bytes a post, so that pages are
+sliced in memory:
+
+.. sourcecode:: pycon
+
+   >>> from datetime import datetime
+   >>> timeline = Timeline()
+   >>> timeline.load([(1, False, datetime(2011, 10, 1)),
+   ...                (2, True, datetime(2011, 10, 2)),
+   ...                (3, False, datetime(2011, 10, 3)),
+   ...                (4, False, datetime(2011, 10, 4))])
+   >>> len(timeline)
+   4
+   >>> timeline.page(0, 2)
+   ([2, 4], 3)
+   >>> timeline.page(0, 2, before=3)
+   ([3, 1], None)
+   >>> timeline.update([(5, False, datetime(2011, 10, 5))], [4, 5])
+   >>> timeline.page(0, 10)
+   ([2, 5, 3, 1], None)
+
+Each process has its own timeline. It is built from the database by
+:meth:`Timeline.build()`, and :meth:`Timeline.refresh()` keeps it current
+by applying post changes logged in :class:`~langdev.forum.Change` by any
+process since then. Archived posts are listed as well if the archive is
+given, since moving posts to the archive doesn't change the listing.
+
+"""
+import os
+import time
+import array
+import bisect
+import calendar
+import itertools
+import threading
+from sqlalchemy import sql
+from langdev.forum import Post, Change
+
+__all__ = 'REBUILD_THRESHOLD', 'Timeline', 'timestamp'
+
+
+#: The number of post changes to apply at once. The timeline is rebuilt
+#: instead if more posts have changed since the last refresh.
+REBUILD_THRESHOLD = 200
+
+
+def timestamp(value):
+    """Converts a :class:`datetime.datetime` to seconds since the epoch.
+    Naive values are treated as UTC.
+
+    .. sourcecode:: pycon
+
+       >>> import datetime
+       >>> timestamp(datetime.datetime(2011, 10, 1, 12, 30, 0, 500000))
+       1317472200.5
+
+    """
+    return calendar.timegm(value.utctimetuple()) + value.microsecond / 1e6
+
+
+class Segment(object):
+    """Posts in ascending order of created time, and then of id."""
+
+    __slots__ = 'times', 'ids'
+
+    def __init__(self):
+        self.times = array.array('d')
+        self.ids = array.array('l')
+
+    def __len__(self):
+        return len(self.ids)
+
+    def locate(self, time, id):
+        index = bisect.bisect_left(self.times, time)
+        end = bisect.bisect_right(self.times, time, index)
+        while index < end and self.ids[index] < id:
+            index += 1
+        return index
+
+    def insert(self, time, id):
+        index = self.locate(time, id)
+        self.times.insert(index, time)
+        self.ids.insert(index, id)
+
+    def remove(self, id):
+        try:
+            index = self.ids.index(id)
+        except ValueError:
+            return False
+        del self.times[index]
+        del self.ids[index]
+        return True
+
+
+class Timeline(object):
+    """The ids of visible posts in listing order.
+
+    :param refresh_interval: the minimum seconds between checks for
+                             changes in :meth:`refresh()`. the timeline
+                             can be behind other processes for this long
+    :type refresh_interval: :class:`numbers.Real`
+
+    """
+
+    def __init__(self, refresh_interval=1.0):
+        self.refresh_interval = refresh_interval
+        self.sticky = Segment()
+        self.other = Segment()
+        #: The :attr:`~langdev.forum.Change.id` of the last change applied.
+        #: ``None`` if it hasn't been built yet.
+        self.cursor = None
+        self.refreshed_at = None
+        self.reset()
+
+    def reset(self):
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.refreshing = threading.Lock()
+
+    def __len__(self):
+        return len(self.sticky) + len(self.other)
+
+    def load(self, rows, cursor=0):
+        """Replaces posts with ``rows``.
+
+        :param rows: ``(id, sticky, created_at)`` tuples of visible posts
+        :type rows: :class:`collections.Iterable`
+        :param cursor: the id of the last change that ``rows`` reflect
+        :type cursor: :class:`int`
+
+        """
+        sticky, other = Segment(), Segment()
+        for time, id, is_sticky in sorted((timestamp(created_at), id, s)
+                                          for id, s, created_at in rows):
+            segment = sticky if is_sticky else other
+            segment.times.append(time)
+            segment.ids.append(id)
+        with self.lock:
+            self.sticky, self.other = sticky, other
+            self.cursor = cursor
+
+    def update(self, rows, ids):
+        """Replaces posts of ``ids`` with ``rows``.
+
+        :param rows: ``(id, sticky, created_at)`` tuples of changed posts
+                     that are visible
+        :type rows: :class:`collections.Iterable`
+        :param ids: ids of all changed posts, including deleted ones
+        :type ids: :class:`collections.Iterable`
+
+        """
+        rows = list(rows)
+        with self.lock:
+            for id in ids:
+                self.sticky.remove(id) or self.other.remove(id)
+            for id, is_sticky, created_at in rows:
+                segment = self.sticky if is_sticky else self.other
+                segment.insert(timestamp(created_at), id)
+
+    def page(self, offset, limit, before=None):
+        """Slices a page of the listing.
+
+        :param offset: the number of posts to skip
+        :type offset: :class:`int`
+        :param limit: the number of posts in the page
+        :type limit: :class:`int`
+        :param before: a post id. if it's given, only posts not sticky and
+                       not created later than the post are listed
+        :type before: :class:`int`
+        :returns: a pair of the list of post ids in the page and the id of
+                  the post next to the page (``None`` if it's the last)
+        :rtype: :class:`tuple`
+        :raises KeyError: when ``before`` is not in the timeline
+
+        """
+        with self.lock:
+            if before is None:
+                segments = ((self.sticky, len(self.sticky)),
+                            (self.other, len(self.other)))
+            else:
+                top = bisect.bisect_right(self.other.times,
+                                          self.time_of(before))
+                segments = (self.other, top),
+            ids = []
+            skip, count = offset, limit + 1
+            for segment, top in segments:
+                if skip >= top:
+                    skip -= top
+                    continue
+                start = max(top - skip - count, 0)
+                ids.extend(reversed(segment.ids[start:top - skip]))
+                count -= top - skip - start
+                skip = 0
+                if not count:
+                    break
+        return ids[:limit], (ids[limit] if len(ids) > limit else None)
+
+    def time_of(self, id):
+        for segment in self.sticky, self.other:
+            try:
+                return segment.times[segment.ids.index(id)]
+            except ValueError:
+                pass
+        raise KeyError(id)
+
+    def build(self, connectable, archive=None):
+        """Loads all visible posts from the database.
+
+        :param connectable: an engine, a connection or a session
+        :param archive: an engine whose posts are listed as well, i.e.
+                        :attr:`langdev.archive.Archive.engine`
+
+        """
+        changes = Change.__table__
+        posts = Post.__table__
+        # the cursor is read first, so that changes made while loading are
+        # applied again by the next refresh rather than missed
+        cursor = connectable.scalar(sql.select([sql.func.max(changes.c.id)]))
+        query = sql.select([posts.c.id, posts.c.sticky, posts.c.created_at]) \
+                   .where(posts.c.hidden == False)
+        rows = connectable.execute(query)
+        if archive is not None:
+            rows = itertools.chain(rows, archive.execute(query))
+        self.load(rows, cursor or 0)
+
+    def refresh(self, connectable, archive=None):
+        """Builds the timeline if it hasn't been, or applies post changes
+        logged since the last refresh. Changes are checked at most once
+        in :attr:`refresh_interval`.
+
+        :param connectable: an engine, a connection or a session
+        :param archive: an engine whose posts are listed as well, i.e.
+                        :attr:`langdev.archive.Archive.engine`
+        :returns: whether the timeline can be used. it can't while another
+                  thread is building it
+        :rtype: :class:`bool`
+
+        """
+        if self.pid != os.getpid():
+            self.reset()
+        if not self.refreshing.acquire(False):
+            return self.cursor is not None
+        try:
+            now = time.time()
+            if self.cursor is None:
+                self.build(connectable, archive)
+            elif now - self.refreshed_at >= self.refresh_interval:
+                self.apply_changes(connectable, archive)
+            self.refreshed_at = now
+        finally:
+            self.refreshing.release()
+        return True
+
+    def expire(self):
+        """Makes the next :meth:`refresh()` check changes regardless of
+        :attr:`refresh_interval`, e.g. after the process has changed posts.
+
+        """
+        self.refreshed_at = float('-inf')
+
+    def apply_changes(self, connectable, archive=None):
+        changes = Change.__table__
+        posts = Post.__table__
+        head = connectable.scalar(sql.select([sql.func.max(changes.c.id)]))
+        if not head or head <= self.cursor:
+            return
+        ids = set(target_id for target_id, in connectable.execute(
+            sql.select([changes.c.target_id])
+               .where((changes.c.id > self.cursor) & (changes.c.id <= head) &
+                      (changes.c.kind == 'post'))
+               .limit(REBUILD_THRESHOLD + 1)
+        ))
+        if len(ids) > REBUILD_THRESHOLD:
+            self.build(connectable, archive)
+            return
+        if ids:
+            query = sql.select([posts.c.id, posts.c.sticky,
+                                posts.c.created_at]) \
+                       .where(posts.c.id.in_(ids) & (posts.c.hidden == False))
+            rows = connectable.execute(query)
+            if archive is not None:
+                # posts may have been archived since they were changed
+                rows = itertools.chain(rows, archive.execute(query))
+            self.update(rows, ids)
+        self.cursor = head
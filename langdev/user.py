@@ -12,13 +12,19 @@ Many services for LangDev can provide single sign on based on this module.
 
 """
 import re
+import hmac
 import hashlib
+import binascii
+import os
+import threading
+import multiprocessing.pool
+import sqlalchemy.engine.reflection
 from sqlalchemy import *
 from sqlalchemy import orm
-from sqlalchemy.sql import functions
+from sqlalchemy.sql import functions, expression
 import langdev.orm
 
-__all__ = 'User', 'Password'
+__all__ = 'User', 'UserEntry', 'Password'
 
 
 class User(langdev.orm.Base):
@@ -46,8 +52,8 @@ class User(langdev.orm.Base):
     #: Login name.
     login = Column(Unicode(45), nullable=False, unique=True)
 
-    #: Hashed password.
-    password_hash = orm.deferred(Column(String(32), nullable=False))
+    #: Hashed password. See :class:`Password` for its formats.
+    password_hash = orm.deferred(Column(String(255), nullable=False))
 
     #: Screen name.
     name = Column(Unicode(45), nullable=False, index=True)
@@ -63,6 +69,20 @@ class User(langdev.orm.Base):
                                      default=functions.now(), index=True),
                               group='profile')
 
+    #: (:class:`datetime.datetime`) Lastly modified time, for incremental
+    #: exports. ``NULL`` only in rows older than the column until
+    #: :func:`~langdev.orm.fill_modified_at()` fills it.
+    modified_at = orm.deferred(Column(DateTime(timezone=True),
+                                      default=functions.now(),
+                                      onupdate=functions.now(), index=True))
+
+    #: Whether the user has left. Left users are hidden immediately, and then
+    #: deleted with their contents in background.
+    #:
+    #: .. seealso:: Module :mod:`langdev.purge`
+    hidden = Column(Boolean, nullable=False, default=False,
+                    server_default=expression.false(), index=True)
+
     @orm.validates(login)
     def validate_login(self, key, login):
         """Validates the :attr:`login` name format.
@@ -101,14 +121,49 @@ class User(langdev.orm.Base):
         if isinstance(password, Password):
             self.password_hash = password.hash_string
         elif isinstance(password, basestring):
-            self.password_hash = Password.hash_algorithm(password).hexdigest()
+            self.password_hash = Password.hash(password).hash_string
         else:
             raise TypeError('password have to be a string, not ' +
                             repr(password))
 
     def __unicode__(self):
         return self.name
-            
+
+
+class UserEntry(object):
+    """A read-only projection of an :class:`User` for lists, e.g. authors
+    of listed posts. It's loaded with SQL expressions, so it costs much
+    less than :class:`User` that the session tracks.
+
+    :attr:`email` is loaded only to serialize the current user, and
+    :attr:`posts_count` and :attr:`comments_count` only if they are
+    serialized, so they can be ``None``.
+
+    .. seealso:: Function :func:`langdev.forum.load_post_entries()`
+
+    """
+
+    __slots__ = ('id', 'login', 'name', 'url', 'created_at', 'email',
+                 'posts_count', 'comments_count')
+
+    def __init__(self, id, login, name, url=None, created_at=None,
+                 email=None, posts_count=None, comments_count=None):
+        self.id = id
+        self.login = login
+        self.name = name
+        self.url = url
+        self.created_at = created_at
+        self.email = email
+        self.posts_count = posts_count
+        self.comments_count = comments_count
+
+    def __unicode__(self):
+        return self.name
+
+    def __repr__(self):
+        return '<{0}.{1} id={2!r}>'.format(type(self).__module__,
+                                           type(self).__name__, self.id)
+
 
 class Password(object):
     """Tests two passwords' equality. It overloads ``==`` and ``!=`` operators.
@@ -133,6 +188,33 @@ class Password(object):
        >>> u.password != u.password
        False
 
+    There are two hash formats:
+
+    Legacy
+       Unsalted MD5 hexadecimal digest of the password. Only old passwords
+       are in this format, and they are upgraded when their users sign in.
+
+    ``pbkdf2_sha256$<cost>$<salt>$<digest>``
+       PBKDF2-HMAC-SHA256 of the MD5 hexadecimal digest of the password,
+       iterated ``cost`` times. Wrapping the MD5 digest makes legacy hashes
+       able to be upgraded without their passwords.
+
+    .. sourcecode:: pycon
+
+       >>> Password.hash(u'password string', cost=1000)  # doctest: +ELLIPSIS
+       <langdev.user.Password 'pbkdf2_sha256$1000$...$...'>
+       >>> legacy = Password('03d105778ae0b4d8205a05a5dbdfcfe9')
+       >>> legacy == u'password string'
+       True
+       >>> legacy.needs_rehash
+       True
+       >>> Password.upgrade(legacy, cost=1000) == u'password string'
+       True
+
+    Slow hashes are computed in the bounded :attr:`pool` of threads if it is
+    configured by :meth:`configure()`, so that they can't occupy every
+    request thread at once. The pool is made lazily in each process.
+
     :param hash_string: a hashed password string
     :type hash_string: :class:`str`
 
@@ -141,12 +223,142 @@ class Password(object):
     #: UTF-8 by default.
     ENCODING = 'utf-8'
 
+    #: The identifier of the current hash format.
+    ALGORITHM = 'pbkdf2_sha256'
+
+    #: The default :attr:`cost`.
+    DEFAULT_COST = 10000
+
     #: Hashed password string.
     hash_string = None
 
-    #: Hash algorithm. MD5 is used.
+    #: Legacy hash algorithm. MD5 is used.
     hash_algorithm = hashlib.md5
 
+    #: The number of PBKDF2 iterations for new hashes.
+    cost = DEFAULT_COST
+
+    #: The number of threads in the :attr:`pool`. If it is ``None``, hashes
+    #: are computed in the calling thread.
+    workers = None
+
+    #: (:class:`multiprocessing.pool.ThreadPool`) The bounded pool of threads
+    #: to compute slow hashes in. It is made on the first use in each
+    #: process, because threads aren't inherited by forked children.
+    pool = None
+
+    #: The id of the process that the :attr:`pool` has been made in.
+    pool_pid = None
+
+    pool_lock = threading.Lock()
+
+    @classmethod
+    def configure(cls, cost=None, workers=None):
+        """Configures the :attr:`cost` and the number of threads in the
+        :attr:`pool`.
+
+        :param cost: the number of PBKDF2 iterations for new hashes.
+                     :const:`DEFAULT_COST` by default
+        :type cost: :class:`int`
+        :param workers: the number of hashing threads. if it is ``None``
+                        or ``0``, hashes are computed in the calling thread
+        :type workers: :class:`int`
+
+        """
+        cls.cost = int(cost or cls.DEFAULT_COST)
+        with cls.pool_lock:
+            cls.workers = workers or None
+            old_pool, old_pid = cls.pool, cls.pool_pid
+            cls.pool = cls.pool_pid = None
+        if old_pool is not None and old_pid == os.getpid():
+            old_pool.close()
+
+    @classmethod
+    def get_pool(cls):
+        """Gets the :attr:`pool` of the current process. It's made if it
+        doesn't exist yet.
+
+        :returns: the pool, or ``None`` if :attr:`workers` is ``None``
+        :rtype: :class:`multiprocessing.pool.ThreadPool`
+
+        """
+        pid = os.getpid()
+        with cls.pool_lock:
+            if cls.workers and cls.pool_pid != pid:
+                # a pool inherited from the parent has no living threads
+                cls.pool = multiprocessing.pool.ThreadPool(cls.workers)
+                cls.pool_pid = pid
+            return cls.pool
+
+    @classmethod
+    def apply(cls, function, *args):
+        """Calls the ``function`` in the :attr:`pool`, and waits for its
+        result.
+
+        """
+        pool = cls.get_pool()
+        if pool is None:
+            return function(*args)
+        return pool.apply(function, args)
+
+    @classmethod
+    def digest(cls, password):
+        """Gets the legacy MD5 hexadecimal digest of the ``password``."""
+        if isinstance(password, unicode):
+            password = password.encode(cls.ENCODING)
+        return cls.hash_algorithm(password).hexdigest()
+
+    @staticmethod
+    def derive(digest, salt, cost):
+        """Derives the key from the legacy ``digest``."""
+        return binascii.hexlify(hashlib.pbkdf2_hmac('sha256', digest,
+                                                    salt, cost))
+
+    @classmethod
+    def wrap(cls, digest, cost=None):
+        """Makes a :class:`Password` from the legacy MD5 ``digest``.
+
+        :param digest: the legacy MD5 hexadecimal digest
+        :type digest: :class:`str`
+        :param cost: the number of PBKDF2 iterations. :attr:`cost` by default
+        :type cost: :class:`int`
+        :rtype: :class:`Password`
+
+        """
+        cost = int(cost or cls.cost)
+        salt = binascii.hexlify(os.urandom(8))
+        key = cls.apply(cls.derive, digest, salt, cost)
+        return cls('$'.join((cls.ALGORITHM, str(cost), salt, key)))
+
+    @classmethod
+    def hash(cls, password, cost=None):
+        """Hashes the ``password`` in the current format.
+
+        :param password: a raw password
+        :type password: :class:`basestring`
+        :param cost: the number of PBKDF2 iterations. :attr:`cost` by default
+        :type cost: :class:`int`
+        :rtype: :class:`Password`
+
+        """
+        return cls.wrap(cls.digest(password), cost)
+
+    @classmethod
+    def upgrade(cls, password, cost=None):
+        """Upgrades the legacy ``password`` hash to the current format.
+        It doesn't need the raw password.
+
+        :param password: a password hash to upgrade
+        :type password: :class:`Password`
+        :param cost: the number of PBKDF2 iterations. :attr:`cost` by default
+        :type cost: :class:`int`
+        :rtype: :class:`Password`
+
+        """
+        if password.is_legacy:
+            return cls.wrap(password.hash_string, cost)
+        return password
+
     def __init__(self, hash_string):
         if isinstance(hash_string, unicode):
             hash_string = hash_string.encode(self.ENCODING)
@@ -155,6 +367,41 @@ class Password(object):
                             ' is a invalid type for hash_string')
         self.hash_string = hash_string
 
+    @property
+    def is_legacy(self):
+        """Whether it is in the legacy format (unsalted MD5)."""
+        return '$' not in self.hash_string
+
+    @property
+    def needs_rehash(self):
+        """Whether it should be hashed again in the current format with
+        the current :attr:`cost`.
+
+        """
+        if self.is_legacy:
+            return True
+        algorithm, cost = self.hash_string.split('$')[:2]
+        return algorithm != self.ALGORITHM or int(cost) != self.cost
+
+    def verify_digest(self, digest):
+        """Tests the legacy MD5 hexadecimal ``digest`` of a password.
+
+        :param digest: a legacy MD5 hexadecimal digest
+        :type digest: :class:`str`
+        :rtype: :class:`bool`
+
+        """
+        if self.is_legacy:
+            return hmac.compare_digest(digest, self.hash_string)
+        try:
+            algorithm, cost, salt, key = self.hash_string.split('$')
+        except ValueError:
+            return False
+        if algorithm != self.ALGORITHM:
+            return False
+        derived = self.apply(self.derive, digest, salt, int(cost))
+        return hmac.compare_digest(derived, key)
+
     def __eq__(self, password):
         if isinstance(password, type(self)):
             return self.hash_string == password.hash_string
@@ -162,7 +409,7 @@ class Password(object):
             password = password.encode(self.ENCODING)
         if not isinstance(password, str):
             return False
-        return self.hash_algorithm(password).hexdigest() == self.hash_string
+        return self.verify_digest(self.digest(password))
 
     def __ne__(self, password):
         return not (self == password)
@@ -176,3 +423,23 @@ class Password(object):
     def __repr__(self):
         return '<{0}.Password {1!r}>'.format(__name__, self.hash_string)
 
+
+@langdev.orm.migration
+def clear_sso_digests(session):
+    """Clears ``users.sso_digest``, unsalted MD5 digests of passwords that
+    SSO used to be checked against, from databases that have the column.
+    It can't be dropped on every database, but it is never read.
+
+    :returns: the number of cleared users
+    :rtype: :class:`int`
+
+    """
+    bind = session.get_bind(User)
+    inspector = sqlalchemy.engine.reflection.Inspector.from_engine(bind)
+    columns = [column['name'] for column in inspector.get_columns('users')]
+    if 'sso_digest' not in columns:
+        return 0
+    with session.begin():
+        result = session.execute('UPDATE users SET sso_digest = NULL '
+                                 'WHERE sso_digest IS NOT NULL')
+    return result.rowcount
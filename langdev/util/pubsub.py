@@ -0,0 +1,242 @@
+""":mod:`langdev.util.pubsub` --- Publish/subscribe across processes
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+:class:`Hub` delivers messages published in a process to subscribers in
+the same process:
+
+.. sourcecode:: pycon
+
+   >>> hub = Hub()
+   >>> subscription = hub.subscribe('posts')
+   >>> hub.publish(['posts', 'post:1'], {'id': 1})
+   0
+   >>> subscription.get(timeout=1)
+   {'id': 1}
+   >>> subscription.close()
+
+If the hub is configured with a directory, messages are fanned out to
+other processes that share the directory as well, e.g. preforked workers
+of the same server. Every process that has subscribers binds a Unix
+datagram socket in the directory, and publishers send each message to
+all sockets in it. Messages are serialized as JSON for that.
+
+Delivery is best effort: messages are dropped for slow subscribers and
+for processes whose socket buffers are full, instead of making
+publishers wait. A serialized message has to fit in
+:data:`MAX_MESSAGE_SIZE` bytes, the size of a datagram.
+
+"""
+import os
+import json
+import errno
+import Queue
+import atexit
+import socket
+import threading
+
+__all__ = 'MAX_MESSAGE_SIZE', 'Hub', 'Subscription'
+
+
+#: The maximum size of a message serialized in JSON, in bytes. Larger
+#: messages can't be sent in a datagram.
+MAX_MESSAGE_SIZE = 65536
+
+
+class Subscription(object):
+    """Messages published to a channel. Use it as a context manager, or
+    call :meth:`close()` when it's not needed anymore.
+
+    """
+
+    def __init__(self, hub, channel, size):
+        self.hub = hub
+        #: The channel name.
+        self.channel = channel
+        self.queue = Queue.Queue(size)
+
+    def get(self, timeout=None):
+        """Waits for a message.
+
+        :param timeout: seconds to wait. waits forever if omitted
+        :type timeout: :class:`numbers.Real`
+        :returns: a message, or ``None`` if there is no message in the
+                  ``timeout``
+
+        """
+        try:
+            return self.queue.get(timeout=timeout)
+        except Queue.Empty:
+            return None
+
+    def put(self, message):
+        try:
+            self.queue.put_nowait(message)
+        except Queue.Full:
+            pass
+
+    def close(self):
+        """Stops receiving messages."""
+        self.hub.unsubscribe(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class Hub(object):
+    """The publish/subscribe hub of a process.
+
+    :param directory: the directory to make sockets in, to fan out
+                      messages to other processes. messages are delivered
+                      only in the process if it's omitted
+    :type directory: :class:`basestring`
+    :param queue_size: the number of messages kept for each subscriber
+    :type queue_size: :class:`int`
+
+    """
+
+    def __init__(self, directory=None, queue_size=100):
+        self.configure(directory, queue_size)
+
+    def configure(self, directory=None, queue_size=100):
+        """Sets the ``directory`` and the ``queue_size``. Subscriptions
+        so far are left out.
+
+        """
+        self.directory = directory
+        self.queue_size = queue_size
+        self.reset()
+
+    def reset(self):
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.subscriptions = {}
+        self.socket = self.path = None
+
+    def check_fork(self):
+        # sockets and the receiving thread aren't inherited by children
+        if self.pid != os.getpid():
+            self.reset()
+
+    def subscribe(self, channel):
+        """Subscribes the ``channel``.
+
+        :param channel: a channel name
+        :type channel: :class:`basestring`
+        :rtype: :class:`Subscription`
+
+        """
+        self.check_fork()
+        subscription = Subscription(self, channel, self.queue_size)
+        with self.lock:
+            self.subscriptions.setdefault(channel, set()).add(subscription)
+            if self.directory and self.socket is None:
+                self.listen()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            subscriptions = self.subscriptions.get(subscription.channel, ())
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                self.subscriptions.pop(subscription.channel, None)
+
+    def publish(self, channels, message):
+        """Publishes the ``message`` to the ``channels``.
+
+        :param channels: channel names
+        :type channels: :class:`collections.Iterable`
+        :param message: a JSON-serializable message
+        :returns: the number of processes the message has been sent to
+                  other than the current one
+        :rtype: :class:`int`
+        :raises: :exc:`~exceptions.ValueError` when the serialized
+                 ``message`` is larger than :data:`MAX_MESSAGE_SIZE`
+
+        """
+        self.check_fork()
+        channels = list(channels)
+        data = json.dumps({'channels': channels, 'message': message})
+        if len(data) > MAX_MESSAGE_SIZE:
+            raise ValueError('the message is {0} bytes; the limit is '
+                             '{1}'.format(len(data), MAX_MESSAGE_SIZE))
+        self.deliver(channels, message)
+        if not self.directory:
+            return 0
+        sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sender.setblocking(False)
+        sent = 0
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            names = []
+        for name in names:
+            path = os.path.join(self.directory, name)
+            if not name.endswith('.sock') or path == self.path:
+                continue
+            try:
+                sender.sendto(data, path)
+            except socket.error as e:
+                if e.errno in (errno.ECONNREFUSED, errno.ENOENT):
+                    # the process has exited without removing its socket
+                    try:
+                        os.unlink(path)
+                    except OSError:
+                        pass
+                elif e.errno not in (errno.EAGAIN, errno.ENOBUFS,
+                                     errno.EMSGSIZE):
+                    # EMSGSIZE: the system limits datagrams under
+                    # MAX_MESSAGE_SIZE
+                    raise
+            else:
+                sent += 1
+        sender.close()
+        return sent
+
+    def deliver(self, channels, message):
+        with self.lock:
+            subscriptions = [subscription
+                             for channel in channels
+                             for subscription in
+                                 self.subscriptions.get(channel, ())]
+        for subscription in subscriptions:
+            subscription.put(message)
+
+    def listen(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        path = os.path.join(self.directory, '{0}.sock'.format(self.pid))
+        if os.path.exists(path):
+            os.unlink(path)
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.socket.bind(path)
+        self.path = path
+        atexit.register(self.close)
+        thread = threading.Thread(target=self.receive,
+                                  args=(self.socket, self.pid))
+        thread.daemon = True
+        thread.start()
+
+    def receive(self, sock, pid):
+        while self.pid == pid:
+            try:
+                data = sock.recv(MAX_MESSAGE_SIZE)
+            except socket.error as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            try:
+                data = json.loads(data)
+            except ValueError:
+                continue
+            self.deliver(data['channels'], data['message'])
+
+    def close(self):
+        """Removes the socket of this process."""
+        with self.lock:
+            if self.socket is not None and self.pid == os.getpid():
+                self.socket.close()
+                os.unlink(self.path)
+            self.socket = self.path = None
@@ -0,0 +1,219 @@
+""":mod:`langdev.util.tracing` --- Lightweight tracing spans
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+Spans measure how long each part of a unit of work (e.g. a request) takes.
+They are recorded only while a :class:`Trace` is active in the current
+thread, so spans cost almost nothing when tracing is off::
+
+    trace = langdev.util.tracing.begin()
+    with langdev.util.tracing.span('query', 'sql'):
+        ...
+    langdev.util.tracing.end()
+    trace.save('/tmp/traces')
+
+Saved traces are in the trace event format of Chrome, so they can be
+opened with ``chrome://tracing`` or Perfetto_ UI.
+
+.. _Perfetto: https://ui.perfetto.dev/
+
+"""
+import os
+import json
+import time
+import thread
+import functools
+import itertools
+import threading
+import contextlib
+
+__all__ = 'Trace', 'current', 'begin', 'end', 'span', 'traced', 'record'
+
+
+#: Thread-local storage of the active trace.
+local = threading.local()
+
+#: Serial numbers of saved trace files.
+serial = itertools.count()
+
+
+class Trace(object):
+    """Spans recorded in a thread.
+
+    :param name: the name of the trace
+    :type name: :class:`basestring`
+
+    """
+
+    def __init__(self, name=None):
+        self.name = name
+        self.pid = os.getpid()
+        self.tid = thread.get_ident()
+
+        #: (:class:`float`) The time the trace has begun.
+        self.started_at = time.time()
+
+        #: (:class:`float`) The time the trace has ended.
+        self.ended_at = None
+
+        #: The :class:`list` of recorded events.
+        self.events = []
+
+        #: The :class:`dict` of extra information to save together.
+        self.metadata = {}
+
+    @property
+    def duration(self):
+        """The duration of the trace in seconds."""
+        return (self.ended_at or time.time()) - self.started_at
+
+    def add(self, name, category, start, end, args=None):
+        """Adds a span.
+
+        :param name: the name of the span
+        :type name: :class:`basestring`
+        :param category: the category of the span
+        :type category: :class:`basestring`
+        :param start: the started time in seconds since the epoch
+        :type start: :class:`float`
+        :param end: the ended time in seconds since the epoch
+        :type end: :class:`float`
+        :param args: extra information of the span
+        :type args: :class:`dict`
+
+        """
+        event = {'name': name, 'cat': category, 'ph': 'X',
+                 'ts': int(start * 1e6), 'dur': int((end - start) * 1e6),
+                 'pid': self.pid, 'tid': self.tid}
+        if args:
+            event['args'] = args
+        self.events.append(event)
+
+    def to_json(self):
+        """Makes the Chrome trace event object.
+
+        :rtype: :class:`dict`
+
+        """
+        metadata = dict(self.metadata, name=self.name)
+        return {'traceEvents': self.events, 'displayTimeUnit': 'ms',
+                'otherData': metadata}
+
+    def save(self, directory):
+        """Saves the trace as a JSON file into the ``directory``.
+
+        :param directory: the directory to save into. it is made if it
+                          doesn't exist
+        :type directory: :class:`basestring`
+        :returns: the path of the saved file
+        :rtype: :class:`basestring`
+
+        """
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # another process may have made it
+                if not os.path.isdir(directory):
+                    raise
+        filename = 'trace-{0}-{1}-{2}.json'.format(
+            time.strftime('%Y%m%d%H%M%S', time.gmtime(self.started_at)),
+            self.pid, next(serial)
+        )
+        path = os.path.join(directory, filename)
+        with open(path, 'w') as f:
+            json.dump(self.to_json(), f)
+        return path
+
+
+def current():
+    """Gets the active trace of the current thread.
+
+    :returns: the active trace, or ``None``
+    :rtype: :class:`Trace`
+
+    """
+    return getattr(local, 'trace', None)
+
+
+def begin(name=None):
+    """Begins a new trace in the current thread.
+
+    :param name: the name of the trace
+    :type name: :class:`basestring`
+    :returns: the begun trace
+    :rtype: :class:`Trace`
+
+    """
+    local.trace = Trace(name)
+    return local.trace
+
+
+def end():
+    """Ends the active trace of the current thread.
+
+    :returns: the ended trace, or ``None`` if there's no active trace
+    :rtype: :class:`Trace`
+
+    """
+    trace = current()
+    if trace is not None:
+        trace.ended_at = time.time()
+        local.trace = None
+    return trace
+
+
+def record(name, category, start, end, **args):
+    """Adds an already measured span to the active trace, if any."""
+    trace = current()
+    if trace is not None:
+        trace.add(name, category, start, end, args)
+
+
+@contextlib.contextmanager
+def span(name, category='function', **args):
+    """Measures the ``with`` block as a span of the active trace.
+
+    >>> trace = begin('test')
+    >>> with span('outer', n=1):
+    ...     with span('inner'):
+    ...         pass
+    >>> end() is trace
+    True
+    >>> [(e['name'], e['cat'], e.get('args')) for e in trace.events]
+    [('inner', 'function', None), ('outer', 'function', {'n': 1})]
+
+    """
+    trace = current()
+    if trace is None:
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        trace.add(name, category, start, time.time(), args)
+
+
+def traced(name=None, category='function'):
+    """The decorator that measures every call of the function as a span.
+
+    :param name: the name of spans. the function name by default
+    :type name: :class:`basestring`
+    :param category: the category of spans
+    :type category: :class:`basestring`
+
+    """
+    def decorate(function):
+        span_name = name or function.__name__
+        @functools.wraps(function)
+        def decorated(*args, **kwargs):
+            trace = current()
+            if trace is None:
+                return function(*args, **kwargs)
+            start = time.time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                trace.add(span_name, category, start, time.time())
+        return decorated
+    return decorate
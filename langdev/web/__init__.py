@@ -27,6 +27,15 @@ and Jinja2_ also.
    Module :mod:`langdev.web.wsgi`
       Custom WSGI middlewares for LangDev web application.
 
+   Module :mod:`langdev.web.querylog`
+      Per-request SQL instrumentation.
+
+   Module :mod:`langdev.web.tracing`
+      End-to-end tracing of sampled requests.
+
+   Module :mod:`langdev.web.metrics`
+      Request metrics in the Prometheus text format.
+
 
 .. _Flask: http://flask.pocoo.org/
 .. _Werkzeug: http://werkzeug.pocoo.org/
@@ -35,7 +44,8 @@ and Jinja2_ also.
 .. attribute:: flask.g.session
 
    (:class:`langdev.orm.Session`) The global variable that stores the
-   SQLAlchemy session.
+   SQLAlchemy session. Requests on an archived post get a session bound
+   to the archive instead.
 
 .. attribute:: flask.g.database_engine
 
@@ -51,6 +61,9 @@ import werkzeug
 import jinja2
 import sqlalchemy
 import langdev.orm
+import langdev.forum
+import langdev.archive
+import langdev.util.tracing
 
 
 #: The :class:`dict` of blueprints to be registered by default.
@@ -201,10 +214,23 @@ def create_app(modifier=None, config_filename=None):
     app.jinja_env.globals['require'] = werkzeug.utils.import_string
     app.jinja_env.filters.update(template_filters)
     app.mail = flaskext.mail.Mail(app)
+    if app.config.get('PROFILE_SECRET'):
+        # innermost, so that it matches requests as the application does
+        # e.g. after MethodRewriteMiddleware
+        profiler = werkzeug.utils.import_string(
+            'langdev.web.wsgi:ProfilerMiddleware'
+        )
+        app.wsgi_app = profiler(app)
     middlewares = list(wsgi_middlewares)
     middlewares.extend(app.config.get('WSGI_MIDDLEWARES', []))
     for import_name in middlewares:
         app.wsgi_app = werkzeug.utils.import_string(import_name)(app.wsgi_app)
+    if app.config.get('SQL_INSTRUMENTATION'):
+        werkzeug.utils.import_string('langdev.web.querylog:install')(app)
+    if app.config.get('TRACE_SAMPLE_RATE', 0) > 0:
+        werkzeug.utils.import_string('langdev.web.tracing:install')(app)
+    if app.config.get('METRICS'):
+        werkzeug.utils.import_string('langdev.web.metrics:install')(app)
     return app
 
 
@@ -319,6 +345,34 @@ def render(template_name, value, **context):
     .. seealso:: Constant :const:`content_types`
     .. todo:: Adding :mailheader:`Vary` header.
 
+    """
+    content_type = negotiate(template_name)
+    serializer = content_types[content_type]
+    if isinstance(serializer, basestring):
+        if serializer.startswith('.'):
+            template_name += serializer
+            result = flask.render_template(template_name, **context)
+            response = flask.Response(result, mimetype=content_type)
+        else:
+            serializer = werkzeug.utils.import_string(serializer)
+    if callable(serializer):
+        with langdev.util.tracing.span('serialize', 'serialize',
+                                       content_type=content_type):
+            result = serializer(value)
+        response = flask.Response(result, mimetype=content_type)
+    response.headers['Vary'] = 'Accept'
+    return response
+
+
+def negotiate(template_name):
+    """Chooses the content type that :func:`render()` responds in for the
+    current request.
+
+    :param template_name: the name of the template, but postfix excluded
+    :type template_name: :class:`basestring`
+    :returns: a key of :const:`content_types`
+    :rtype: :class:`str`
+
     """
     jinja_env = flask.current_app.jinja_env
     def _tpl_avail(postfix):
@@ -338,22 +392,24 @@ def render(template_name, value, **context):
         accept_mimetypes = [(default_content_type, 1)]
         accept_mimetypes = werkzeug.datastructures.MIMEAccept(accept_mimetypes)
     content_type = accept_mimetypes.best_match(types)
-    try:
-        serializer = content_types[content_type]
-    except KeyError:
+    if content_type not in content_types:
         flask.abort(406)
-    if isinstance(serializer, basestring):
-        if serializer.startswith('.'):
-            template_name += serializer
-            result = flask.render_template(template_name, **context)
-            response = flask.Response(result, mimetype=content_type)
-        else:
-            serializer = werkzeug.utils.import_string(serializer)
-    if callable(serializer):
-        result = serializer(value)
-        response = flask.Response(result, mimetype=content_type)
-    response.headers['Vary'] = 'Accept'
-    return response
+    return content_type
+
+
+def is_serialized(template_name):
+    """Whether :func:`render()` serializes the value rather than renders
+    the template for the current request. Views use it to load what only
+    serialized values have, e.g. counts.
+
+    :param template_name: the name of the template, but postfix excluded
+    :type template_name: :class:`basestring`
+    :rtype: :class:`bool`
+
+    """
+    serializer = content_types[negotiate(template_name)]
+    return not (isinstance(serializer, basestring) and
+                serializer.startswith('.'))
 
 
 def get_database_engine(config):
@@ -378,6 +434,60 @@ def get_database_engine(config):
     return config['ENGINE']
 
 
+def get_archive(config):
+    """Gets the :class:`~langdev.archive.Archive` of the database from the
+    ``config``. It's configured by ``'ARCHIVE_DATABASE'``: the path of the
+    archive database file on SQLite, or the name of the archive schema on
+    PostgreSQL.
+
+    :param config: the configuration
+    :type config: :class:`flask.Config`, :class:`dict`
+    :returns: the archive, or ``None`` if it's not configured
+    :rtype: :class:`langdev.archive.Archive`
+
+    """
+    try:
+        return config['ARCHIVE']
+    except KeyError:
+        pass
+    location = config.get('ARCHIVE_DATABASE')
+    archive = None
+    if location:
+        archive = langdev.archive.Archive(get_database_engine(config),
+                                          location)
+    config['ARCHIVE'] = archive
+    return archive
+
+
+def list_posts(criterion=None, order_by=None, key=None, offset=None,
+               limit=None, **options):
+    """Loads :class:`~langdev.forum.PostEntry` objects through
+    :attr:`g.session <flask.g.session>`, and from the archive as well if
+    it's configured. ``key`` gives the value of an entry that ``order_by``
+    sorts in descending order, to merge both. ::
+
+        posts = list_posts(Post.hidden == False,
+                           order_by=Post.created_at.desc(),
+                           key=operator.attrgetter('created_at'), limit=20)
+
+    .. seealso::
+
+       Function :func:`langdev.forum.load_post_entries()`
+
+       Method :meth:`langdev.archive.Archive.load_post_entries()`
+
+    """
+    archive = get_archive(flask.current_app.config)
+    if archive is None:
+        return langdev.forum.load_post_entries(
+            flask.g.session, criterion, order_by=order_by,
+            offset=offset, limit=limit, **options
+        )
+    return archive.load_post_entries(flask.g.session, criterion,
+                                     order_by=order_by, key=key,
+                                     offset=offset, limit=limit, **options)
+
+
 @before_request
 def define_session():
     """Sets the :attr:`g.session <flask.g.session>` and
@@ -4,14 +4,25 @@
 """
 import re
 import math
-from flask import (Blueprint, request, g, abort, render_template,
-                   make_response, redirect, url_for)
+import json
+import weakref
+import operator
+import datetime
+from flask import (Blueprint, Response, request, g, abort, render_template,
+                   make_response, redirect, url_for, current_app)
 from flask.ext import wtf
-from wtforms.ext.sqlalchemy.fields import QuerySelectField
-from langdev.forum import Post, Comment
-from langdev.web import render
+from sqlalchemy import orm
+from langdev.forum import (Post, Comment, CommentTree, Change,
+                           PATH_SEGMENT_WIDTH, MAX_DEPTH, load_post_entries)
+from langdev.objsimplify import Result, simplify, camelCase
+from langdev.web import render, is_serialized, list_posts
+import langdev.orm
 import langdev.web.user
 import langdev.web.pager
+import langdev.web.metrics
+import langdev.util.pubsub
+import langdev.timeline
+import langdev.purge
 
 
 #: Forum web pages blueprint.
@@ -19,10 +30,131 @@ import langdev.web.pager
 #: .. seealso:: Flask --- :ref:`flask:blueprints`
 forum = Blueprint('forum', __name__)
 
+#: The number of top-level comments (or replies on a comment) to show at
+#: once. The rest are loaded on demand through :func:`replies()`.
+COMMENTS_PER_PAGE = 50
+
+#: The number of reply levels to show at once.
+COMMENT_DEPTH = 5
+
+#: The maximum number of comments to show at once.
+COMMENTS_LIMIT = 300
+
+#: The maximum number of changes to list at once.
+CHANGES_LIMIT = 500
+
+#: Seconds between keep-alive comments of event streams, so that
+#: disconnected clients are noticed.
+EVENTS_KEEPALIVE = 15
+
+#: The maximum number of characters of comment bodies in events. Longer
+#: bodies are cut, so that events fit in
+#: :data:`~langdev.util.pubsub.MAX_MESSAGE_SIZE`.
+EVENT_BODY_LENGTH = 2000
+
+#: (:class:`langdev.util.pubsub.Hub`) The hub that new posts and comments
+#: are published to. Channel ``'posts'`` has everything, and
+#: ``'post:<id>'`` has comments on the post.
+hub = langdev.util.pubsub.Hub()
+
+
+@forum.record
+def configure_events(state):
+    """Configures the :data:`hub` by ``EVENTS_SOCKET_DIR``, the directory
+    to fan out events across processes of the same server through. Set it
+    when the server runs more than one process, e.g. preforked workers.
+
+    """
+    hub.configure(directory=state.app.config.get('EVENTS_SOCKET_DIR'))
+
+
+#: (:class:`weakref.WeakKeyDictionary`) The
+#: :class:`~langdev.timeline.Timeline` of each database engine in this
+#: process.
+timelines = weakref.WeakKeyDictionary()
+
+
+def get_timeline(engine=None):
+    """Gets the :class:`~langdev.timeline.Timeline` of the current database
+    after refreshing it. It's checked for changes made by other processes
+    at most once in ``TIMELINE_REFRESH_INTERVAL`` seconds (1 by default).
+    Archived posts are in it as well.
+
+    :returns: the timeline, or ``None`` if it can't be used yet
+    :rtype: :class:`langdev.timeline.Timeline`
+
+    """
+    if engine is None:
+        engine = g.database_engine
+    timeline = timelines.get(engine)
+    if timeline is None:
+        interval = current_app.config.get('TIMELINE_REFRESH_INTERVAL', 1)
+        timeline = langdev.timeline.Timeline(refresh_interval=interval)
+        timeline = timelines.setdefault(engine, timeline)
+    archive = langdev.web.get_archive(current_app.config)
+    if timeline.refresh(engine, archive and archive.engine):
+        return timeline
+
+
+def expire_timeline():
+    """Makes the next request see posts changed by this process."""
+    timeline = timelines.get(g.database_engine)
+    if timeline is not None:
+        timeline.expire()
+
+
+@forum.before_app_first_request
+def build_timeline():
+    """Builds the timeline on startup, so that the first reader doesn't
+    wait for it.
+
+    """
+    get_timeline(langdev.web.get_database_engine(current_app.config))
+
+
+@forum.before_request
+def route_archived():
+    """Serves requests on an archived post from the archive: they read it
+    through :attr:`g.session <flask.g.session>` bound to the archive, and
+    write views call :func:`restore_archived()` before changing it.
+
+    .. seealso:: Module :mod:`langdev.archive`
+
+    """
+    post_id = (request.view_args or {}).get('post_id')
+    archive = langdev.web.get_archive(current_app.config)
+    if post_id is None or archive is None or \
+       g.session.query(Post.id).filter_by(id=post_id).first():
+        return
+    g.database_session = g.session
+    g.session = langdev.orm.Session(bind=archive.engine)
+
+
+def restore_archived(post_id):
+    """Moves the post back to the database if :func:`route_archived()` has
+    served the request from the archive, and binds :attr:`g.session
+    <flask.g.session>` to the database again. Write views call it only
+    after the request has been authorized and validated, and load objects
+    again if it returns ``True``.
+
+    :param post_id: the :attr:`~langdev.forum.Post.id` of the post
+    :type post_id: :class:`int`
+    :returns: whether the post has been restored
+    :rtype: :class:`bool`
+
+    """
+    database_session = getattr(g, 'database_session', None)
+    if database_session is None:
+        return False
+    langdev.web.get_archive(current_app.config).restore([post_id])
+    g.session = database_session
+    del g.database_session
+    return True
+
 
 def get_post(post_id):
     try:
-        return g.session.query(Post).filter_by(id=post_id)[0]
+        return g.session.query(Post).filter_by(id=post_id, hidden=False)[0]
     except IndexError:
         abort(404)
 
@@ -40,38 +172,257 @@ def posts():
     :status 404: ``next`` post is not exists.
 
     """
-    posts = g.session.query(Post) \
-                     .order_by(Post.sticky.desc(), Post.created_at.desc())
-    cnt = posts.count()
     view = request.args.get('view', 'table')
     next_id = request.args.get('next')
-    offset = int(request.args.get('offset', 0))
-    limit = min(int(request.args.get('limit', 20)), 100)
     if next_id:
-        basis = g.session.query(Post).get(next_id)
-        if not basis:
+        if not next_id.isdigit():
             abort(404)
-        posts = posts.filter(~Post.sticky) \
-                     .filter(Post.created_at <= basis.created_at)
-    paged_posts = posts.offset(offset).limit(limit)
-    next = posts.offset(offset+limit).first()
+        next_id = int(next_id)
+    offset = int(request.args.get('offset', 0))
+    limit = min(int(request.args.get('limit', 20)), 100)
+    # the summary view shows bodies and comment counts, and serialized
+    # values have counts
+    options = {'body': view == 'summary',
+               'counts': view == 'summary' or is_serialized('forum/posts')}
+    timeline = get_timeline()
+    if timeline is not None:
+        try:
+            ids, next_id = timeline.page(offset, limit, next_id or None)
+        except KeyError:
+            # the basis is hidden, or has been written after the refresh
+            timeline = None
+    langdev.web.metrics.record_cache('timeline', timeline is not None)
+    if timeline is None:
+        paged_posts, next, cnt = query_posts(offset, limit, next_id,
+                                             **options)
+    else:
+        cnt = len(timeline)
+        if next_id is not None:
+            ids.append(next_id)
+        loaded = load_post_entries(g.session, Post.id.in_(ids),
+                                   **options) if ids else []
+        archive = langdev.web.get_archive(current_app.config)
+        if archive is not None:
+            loaded = archive.complete_post_entries(g.session, loaded, ids,
+                                                   **options)
+        loaded = dict((post.id, post) for post in loaded)
+        paged_posts = [loaded[id] for id in ids if id in loaded]
+        next = paged_posts.pop() if next_id in loaded else None
     pager = langdev.web.pager.Pager(math.ceil(cnt / float(limit)),
                                     1 + offset / limit)
-    return render('forum/posts', posts,
+    return render('forum/posts', paged_posts,
                   view=view, next=next,
                   posts=paged_posts, pager=pager, limit=limit)
 
 
+def listing_key(post):
+    return post.sticky, post.created_at
+
+
+def query_posts(offset, limit, next_id=None, **options):
+    """Queries a page of the listing from the database and the archive,
+    for when the timeline can't be used. ``options`` are passed to
+    :func:`~langdev.forum.load_post_entries()`.
+
+    :returns: a triple of the page, the post next to the page, and the
+              number of all visible posts
+
+    """
+    criterion = Post.hidden == False
+    sessions = [g.session]
+    archive = langdev.web.get_archive(current_app.config)
+    if archive is not None:
+        sessions.append(langdev.orm.Session(bind=archive.engine))
+    cnt = sum(session.query(Post).filter(criterion).count()
+              for session in sessions)
+    if next_id:
+        for session in sessions:
+            basis = session.query(Post).get(next_id)
+            if basis:
+                break
+        else:
+            abort(404)
+        criterion &= ~Post.sticky & (Post.created_at <= basis.created_at)
+    posts = list_posts(criterion,
+                       order_by=[Post.sticky.desc(), Post.created_at.desc()],
+                       key=listing_key, offset=offset, limit=limit + 1,
+                       **options)
+    next = posts.pop() if len(posts) > limit else None
+    return posts, next, cnt
+
+
 @forum.route('/atom.xml')
 def atom():
     limit = int(request.args.get('limit', 20))
-    posts = g.session.query(Post).order_by(Post.created_at.desc()).limit(limit)
+    posts = list_posts(Post.hidden == False,
+                       order_by=Post.created_at.desc(),
+                       key=operator.attrgetter('created_at'), limit=limit,
+                       body=True)
     xml = render_template('forum/atom.xml', posts=posts)
     response = make_response(xml)
     response.content_type = 'application/atom+xml'
     return response
 
 
+@forum.route('/changes')
+def changes():
+    """Lists posts and comments created, modified or deleted since the
+    ``since`` cursor, in the order they were committed, so that API
+    clients can mirror the forum without fetching posts again. Pass the
+    ``cursor`` of a response to the next request; it's the same as the
+    ``since`` if there are no more changes. Deleting a post or a comment
+    deletes its comments or replies as well.
+
+    Each change has the current state of the ``post`` or the ``comment``
+    unless it has been deleted since then; its deletion follows in the
+    stream in that case.
+
+    :query since: ``cursor`` of the last response. all changes if omitted
+    :query limit: number of changes to list. default is 100, minimum is 1,
+                  maximum is 500.
+    :status 200: no error.
+
+    """
+    since = request.args.get('since', 0, type=int)
+    limit = max(1, min(request.args.get('limit', 100, type=int),
+                       CHANGES_LIMIT))
+    changes = g.session.query(Change) \
+                       .filter(Change.id > since) \
+                       .order_by(Change.id) \
+                       .limit(limit + 1) \
+                       .all()
+    more = len(changes) > limit
+    changes = changes[:limit]
+    ids = {'post': set(), 'comment': set()}
+    for change in changes:
+        if change.action != 'deleted':
+            ids[change.kind].add(change.target_id)
+    targets = {'post': {}, 'comment': {}}
+    sessions = [g.session]
+    archive = langdev.web.get_archive(current_app.config)
+    if archive is not None:
+        # posts may have been archived since they were changed
+        sessions.append(langdev.orm.Session(bind=archive.engine))
+    for session in sessions:
+        post_ids = ids['post'].difference(targets['post'])
+        if post_ids:
+            posts = session.query(Post) \
+                           .filter(Post.id.in_(post_ids)) \
+                           .filter(Post.hidden == False) \
+                           .options(orm.joinedload(Post.author),
+                                    orm.undefer(Post.body))
+            targets['post'].update((post.id, Result({
+                'ID': post.id, 'author': author_result(post.author),
+                'title': post.title, 'body': post.body,
+                'sticky': post.sticky, 'created at': post.created_at,
+                'modified at': post.modified_at
+            })) for post in posts)
+        comment_ids = ids['comment'].difference(targets['comment'])
+        if comment_ids:
+            comments = session.query(Comment) \
+                              .filter(Comment.id.in_(comment_ids)) \
+                              .filter(Comment.hidden == False) \
+                              .options(orm.joinedload(Comment.author))
+            targets['comment'].update((comment.id, Result({
+                'ID': comment.id, 'author': author_result(comment.author),
+                'post ID': comment.post_id, 'parent ID': comment.parent_id,
+                'body': comment.body, 'created at': comment.created_at
+            })) for comment in comments)
+    results = []
+    for change in changes:
+        result = Result({'ID': change.id, 'type': change.kind,
+                         'action': change.action, 'post ID': change.post_id,
+                         'changed at': change.created_at})
+        result[change.kind] = targets[change.kind].get(change.target_id)
+        if change.kind == 'comment':
+            result['comment ID'] = change.target_id
+        results.append(result)
+    result = Result(changes=results, more=more,
+                    cursor=changes[-1].id if changes else since)
+    return render('forum/changes', result, **result)
+
+
+def author_result(user):
+    return Result({'ID': user.id, 'login': user.login, 'name': user.name})
+
+
+@forum.route('/events')
+@forum.route('/<int:post_id>/events')
+def events(post_id=None):
+    """Streams new posts and comments as `server-sent events`_, instead of
+    polling the listing. Events are ``post`` and ``comment``, and their
+    data are JSON objects. Comment bodies longer than
+    :data:`EVENT_BODY_LENGTH` are cut, and ``bodyTruncated`` is ``true``
+    then. Comments on other posts are left out if ``post_id`` is given.
+    Missed events can be caught up with :func:`changes()`.
+
+    .. _server-sent events: http://www.w3.org/TR/eventsource/
+
+    :status 200: no error.
+    :status 404: the post doesn't exist.
+
+    """
+    if post_id is None:
+        channel = 'posts'
+    else:
+        channel = 'post:{0}'.format(get_post(post_id).id)
+    subscription = hub.subscribe(channel)
+    def stream():
+        try:
+            yield 'retry: 5000\n\n'
+            while True:
+                message = subscription.get(timeout=EVENTS_KEEPALIVE)
+                if message is None:
+                    yield ': keep-alive\n\n'
+                else:
+                    yield 'event: {0}\ndata: {1}\n\n'.format(
+                        message['event'], json.dumps(message['data'])
+                    )
+        finally:
+            subscription.close()
+    response = Response(stream(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # tells nginx not to buffer the stream
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def publish(post, comment=None):
+    """Publishes a new post, or a new comment on it, to the :data:`hub`.
+    Call it after the transaction is committed. Events are best effort, so
+    failures are logged instead of failing the request that has written.
+
+    """
+    try:
+        publish_event(post, comment)
+    except Exception:
+        current_app.logger.exception('failed to publish an event')
+
+
+def publish_event(post, comment=None):
+    author = (comment or post).author
+    data = Result({'ID': post.id, 'title': post.title,
+                   'author': author_result(author),
+                   'created at': post.created_at,
+                   'URL': url_for('.post', post_id=post.id)})
+    channels = ['posts']
+    if comment is not None:
+        body = comment.body
+        data = Result({'ID': comment.id, 'post': data,
+                       'parent ID': comment.parent_id,
+                       'author': author_result(author),
+                       'body': body[:EVENT_BODY_LENGTH],
+                       'body truncated': len(body) > EVENT_BODY_LENGTH,
+                       'created at': comment.created_at,
+                       'URL': url_for('.comment', post_id=post.id,
+                                      comment_id=comment.id)})
+        channels.append('post:{0}'.format(post.id))
+    type_map = {datetime.datetime: datetime.datetime.isoformat}
+    data = simplify(data, identifier_map=camelCase, type_map=type_map)
+    hub.publish(channels, {'event': 'comment' if comment else 'post',
+                           'data': data})
+
+
 class PostForm(wtf.Form):
 
     title = wtf.TextField('Title', validators=[wtf.Required()],
@@ -85,21 +436,85 @@ class PostForm(wtf.Form):
 
 class CommentForm(wtf.Form):
 
-    parent = QuerySelectField('Reply to', allow_blank=True)
+    parent_id = wtf.HiddenField(validators=[wtf.Optional()])
     body = wtf.TextAreaField('Comment', validators=[wtf.Required()])
     submit = wtf.SubmitField('Submit')
 
-    def fill_comments(self, post):
-        self.parent.query = post.comments
+    #: (:class:`~langdev.forum.Post`) The post to comment on. Parent
+    #: comments are looked up only in this post.
+    post = None
+
+    #: (:class:`~langdev.forum.Comment`) The comment to reply to given by
+    #: the URL, not by :attr:`parent_id`.
+    parent = None
+
+    too_deep = 'Replies cannot be nested more deeply.'
+
+    def validate(self):
+        valid = wtf.Form.validate(self)
+        if self.parent is not None and self.parent.depth >= MAX_DEPTH:
+            self.parent_id.errors.append(self.too_deep)
+            valid = False
+        return valid
+
+    def validate_parent_id(form, field):
+        try:
+            parent_id = int(field.data)
+        except ValueError:
+            raise wtf.ValidationError('Invalid comment.')
+        parent = g.session.query(Comment.depth) \
+                          .filter_by(id=parent_id, post_id=form.post.id,
+                                     hidden=False) \
+                          .first()
+        if parent is None:
+            raise wtf.ValidationError('There is no such comment.')
+        if parent.depth >= MAX_DEPTH:
+            raise wtf.ValidationError(form.too_deep)
+        field.data = parent_id
 
 
 @forum.route('/<int:post_id>')
 def post(post_id, comment_form=None):
+    """Shows a post and a bounded part of its comments.
+
+    :query after: id of the top-level comment to show comments after.
+
+    """
     post = get_post(post_id)
-    if not comment_form:
-        comment_form = CommentForm()
-        comment_form.fill_comments(post)
-    return render('forum/post', post, post=post, comment_form=comment_form)
+    comment_form = comment_form or CommentForm()
+    # serialized posts load their replies by themselves
+    thread = None if is_serialized('forum/post') else load_thread(post)
+    return render('forum/post', post, post=post, thread=thread,
+                  comment_form=comment_form)
+
+
+def load_thread(post, parent=None):
+    after = request.args.get('after', type=int)
+    return CommentTree.load(post, parent, after=after,
+                            limit=COMMENTS_PER_PAGE, depth=COMMENT_DEPTH,
+                            rows=COMMENTS_LIMIT)
+
+
+@forum.route('/<int:post_id>/replies')
+@forum.route('/<int:post_id>/<int:comment_id>/replies')
+def replies(post_id, comment_id=None):
+    """Loads more comments collapsed in the post page. HTML responses are
+    fragments to be inserted in the page.
+
+    :query after: id of the reply to show replies after.
+    :status 200: no error.
+    :status 404: the post or the comment doesn't exist.
+
+    """
+    if comment_id:
+        parent = get_comment(comment_id, post_id)
+        post = parent.post
+    else:
+        post = get_post(post_id)
+        parent = None
+    thread = load_thread(post, parent)
+    return render('forum/replies', thread,
+                  post=post, parent=parent, thread=thread)
 
 
 @forum.route('/write')
@@ -118,6 +533,8 @@ def write():
         form.populate_obj(post)
         with g.session.begin():
             g.session.add(post)
+        expire_timeline()
+        publish(post)
         return redirect(url_for('.post', post_id=post.id), 302)
     return write_form(form=form)
 
@@ -136,8 +553,11 @@ def edit(post_id):
     langdev.web.user.ensure_signin(post_object.author)
     form = PostForm()
     if form.validate():
+        if restore_archived(post_id):
+            post_object = get_post(post_id)
         with g.session.begin():
             form.populate_obj(post_object)
+        expire_timeline()
         return post(post_object.id)
     return edit_form(post_id, form)
 
@@ -146,19 +566,34 @@ def edit(post_id):
 def delete(post_id):
     post = get_post(post_id)
     langdev.web.user.ensure_signin(post.author)
+    if restore_archived(post_id):
+        post = get_post(post_id)
     with g.session.begin():
-        g.session.delete(post)
+        post.hidden = True
+        langdev.purge.purge_post.enqueue(g.session, post.id)
+    expire_timeline()
     return redirect(url_for('.posts'), 302)
 
 
 def get_comment(comment_id, post_id=None):
-    comments = g.session.query(Comment).filter_by(id=comment_id)
+    comments = g.session.query(Comment).filter_by(id=comment_id, hidden=False)
     if post_id:
         comments = comments.filter_by(post_id=post_id)
     try:
-        return comments[0]
+        comment = comments[0]
     except IndexError:
         abort(404)
+    # comments of deleted posts and replies of deleted comments are hidden
+    # with them until purged
+    if comment.post.hidden:
+        abort(404)
+    ancestor_ids = comment.ancestor_ids
+    if ancestor_ids and g.session.query(Comment.id) \
+                                 .filter(Comment.id.in_(ancestor_ids)) \
+                                 .filter(Comment.hidden == True) \
+                                 .first():
+        abort(404)
+    return comment
 
 
 @forum.route('/<int:post_id>', methods=['POST'])
@@ -172,12 +607,23 @@ def write_comment(post_id, comment_id=None):
         parent = None
     langdev.web.user.ensure_signin()
     form = CommentForm()
-    form.fill_comments(post_object)
+    form.post = post_object
+    form.parent = parent
     if form.validate():
+        if restore_archived(post_id):
+            if parent:
+                parent = get_comment(comment_id, post_id)
+                post_object = parent.post
+            else:
+                post_object = get_post(post_id)
         with g.session.begin():
-            cmt = Comment(author=g.current_user, parent=parent)
-            form.populate_obj(cmt)
+            cmt = Comment(author=g.current_user, body=form.body.data)
+            if parent:
+                cmt.parent = parent
+            elif form.parent_id.data:
+                cmt.parent_id = form.parent_id.data
             post_object.comments.append(cmt)
+        publish(post_object, cmt)
         return comment(post_object.id, cmt.id)
     return post(post_id, form)
 
@@ -188,8 +634,14 @@ def comment(post_id, comment_id):
     response = render('forum/base', comment, comment=comment)
     if re.match(r'^(application/xhtml\+xml|text/html)\s*($|;)',
                 response.content_type):
-        return redirect(url_for('.post', post_id=post_id) +
-                        '#comment-{0}'.format(comment.id))
+        # start the page from its thread if it is not on the first page
+        url = url_for('.post', post_id=post_id)
+        if comment.path:
+            top_id = int(comment.path[:PATH_SEGMENT_WIDTH], 16)
+            preceding = comment.post.replies.filter(Comment.id < top_id)
+            if preceding.order_by(None).count() >= COMMENTS_PER_PAGE:
+                url = url_for('.post', post_id=post_id, after=top_id - 1)
+        return redirect(url + '#comment-{0}'.format(comment.id))
     return response
 
 
@@ -197,7 +649,10 @@ def comment(post_id, comment_id):
 def delete_comment(post_id, comment_id):
     comment = get_comment(comment_id, post_id)
     langdev.web.user.ensure_signin(comment.author)
+    if restore_archived(post_id):
+        comment = get_comment(comment_id, post_id)
     with g.session.begin():
-        g.session.delete(comment)
+        comment.hidden = True
+        langdev.purge.purge_comment.enqueue(g.session, comment.id)
     return redirect(url_for('.post', post_id=post_id), 302)
 
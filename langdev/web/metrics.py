@@ -0,0 +1,535 @@
+""":mod:`langdev.web.metrics` --- Request metrics
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+It counts requests and measures their latency, DB time and template
+render time into counters and fixed-bucket histograms, and serves them
+in the Prometheus_ text format.
+
+Turn it on in the config file::
+
+    METRICS = True
+    METRICS_DIR = '/var/run/langdev/metrics'
+
+Recording only touches a :class:`dict` of the current thread, so it
+takes no lock. Each process writes its values into ``METRICS_DIR`` every
+``METRICS_FLUSH_INTERVAL`` seconds (5 by default), and the endpoint sums
+files of all processes, so that numbers of preforked workers are
+aggregated. Without ``METRICS_DIR``, the endpoint serves values of the
+process that answers only. Clear the directory when the application is
+deployed; files of stopped workers are counted until then.
+
+The endpoint is served at ``METRICS_PATH`` (:file:`/metrics` by default;
+``None`` not to serve) to requests that have ``METRICS_SECRET`` as their
+bearer token::
+
+    METRICS_SECRET = 'long random string'
+
+Without the secret, it is served only to ``METRICS_ALLOWED_ADDRS`` (only
+``127.0.0.1`` by default) and not to requests forwarded by proxies, whose
+address is the proxy's.
+
+.. _Prometheus: http://prometheus.io/
+
+"""
+import os
+import re
+import hmac
+import json
+import time
+import weakref
+import tempfile
+import threading
+import flask
+from sqlalchemy import event
+import langdev.web
+import langdev.mail
+
+__all__ = ('LATENCY_BUCKETS', 'Registry', 'Metric', 'Counter', 'Histogram',
+           'Gauge', 'registry', 'request_duration', 'request_db_duration',
+           'request_queries', 'template_duration', 'cache_requests',
+           'mail_queue_depth', 'record_cache', 'install', 'format_text')
+
+
+#: The default upper bounds of histogram buckets in seconds.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+
+
+class Registry(object):
+    """The set of metrics. Values are recorded into a separate
+    :class:`dict` per thread, and merged when they are collected.
+
+    """
+
+    def __init__(self):
+        #: The :class:`list` of registered :class:`Metric` objects.
+        self.metrics = []
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        #: Pairs of a weak reference to a thread and its values.
+        self.stores = []
+        #: Values of threads that have finished.
+        self.retired = {}
+
+    @property
+    def values(self):
+        """The :class:`dict` of values of the current thread."""
+        try:
+            return self.local.values
+        except AttributeError:
+            values = self.local.values = {}
+            with self.lock:
+                self.stores.append((weakref.ref(threading.current_thread()),
+                                    values))
+            return values
+
+    def register(self, metric):
+        """Registers the ``metric``, and returns it."""
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwargs):
+        """Makes and registers a :class:`Counter`."""
+        return self.register(Counter(self, *args, **kwargs))
+
+    def histogram(self, *args, **kwargs):
+        """Makes and registers a :class:`Histogram`."""
+        return self.register(Histogram(self, *args, **kwargs))
+
+    def gauge(self, *args, **kwargs):
+        """Makes and registers a :class:`Gauge`."""
+        return self.register(Gauge(self, *args, **kwargs))
+
+    def collect(self):
+        """Merges values of all threads.
+
+        >>> registry = Registry()
+        >>> hits = registry.counter('hits', 'Hits.', ('page',))
+        >>> hits.inc('a')
+        >>> t = threading.Thread(target=hits.inc, args=('a',))
+        >>> t.start(); t.join()
+        >>> registry.collect()
+        {('hits', ('a',)): 2}
+
+        :returns: values keyed by pairs of a metric name and label values
+        :rtype: :class:`dict`
+
+        """
+        collected = {}
+        with self.lock:
+            alive = []
+            for thread, values in self.stores:
+                if thread() is None or not thread().is_alive():
+                    merge(self.retired, values.items())
+                else:
+                    alive.append((thread, values))
+            self.stores = alive
+            merge(collected, self.retired.items())
+        for thread, values in alive:
+            merge(collected, values.items())
+        return collected
+
+    def dump(self, path):
+        """Writes collected values of this process into the ``path``
+        atomically.
+
+        """
+        items = [[name, list(labels), value]
+                 for (name, labels), value in self.collect().iteritems()]
+        directory = os.path.dirname(path)
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(items, f)
+        os.rename(temp_path, path)
+
+    def load(self, directory):
+        """Merges values written by :meth:`dump()` into ``directory``.
+
+        :rtype: :class:`dict`
+
+        """
+        collected = {}
+        for filename in os.listdir(directory):
+            if not filename.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(directory, filename)) as f:
+                    items = json.load(f)
+            except (IOError, ValueError):
+                continue
+            merge(collected, (((str(name), tuple(labels)), value)
+                              for name, labels, value in items))
+        return collected
+
+
+def merge(target, items):
+    """Adds values of ``items`` to the ``target`` :class:`dict`. Numbers are
+    summed, and lists (of histograms) are summed element-wise.
+
+    """
+    for key, value in items:
+        try:
+            current = target[key]
+        except KeyError:
+            target[key] = list(value) if isinstance(value, list) else value
+            continue
+        if isinstance(value, list):
+            for i, v in enumerate(value):
+                current[i] += v
+        else:
+            target[key] = current + value
+
+
+class Metric(object):
+    """The base class of metrics.
+
+    :param registry: the registry that records values
+    :type registry: :class:`Registry`
+    :param name: the metric name
+    :type name: :class:`str`
+    :param help: the description
+    :type help: :class:`str`
+    :param labels: label names
+    :type labels: :class:`tuple`
+
+    """
+
+    #: The Prometheus metric type.
+    type = None
+
+    def __init__(self, registry, name, help, labels=()):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+
+    def samples(self, values):
+        """Generates Prometheus samples from collected ``values``, as
+        triples of a sample name, a label :class:`dict` and a value.
+
+        """
+        for (name, labels), value in sorted(values.iteritems()):
+            if name == self.name:
+                yield name, dict(zip(self.labels, labels)), value
+
+
+class Counter(Metric):
+    """The monotonically increasing number."""
+
+    type = 'counter'
+
+    def inc(self, *labels):
+        """Increases the value of ``labels`` by one."""
+        self.add(1, *labels)
+
+    def add(self, amount, *labels):
+        """Increases the value of ``labels`` by ``amount``."""
+        values = self.registry.values
+        key = self.name, labels
+        values[key] = values.get(key, 0) + amount
+
+
+class Histogram(Metric):
+    """The distribution of observed values in fixed buckets.
+
+    :param buckets: the sorted upper bounds of buckets.
+                    :data:`LATENCY_BUCKETS` by default
+    :type buckets: :class:`tuple`
+
+    """
+
+    type = 'histogram'
+
+    def __init__(self, registry, name, help, labels=(),
+                 buckets=LATENCY_BUCKETS):
+        super(Histogram, self).__init__(registry, name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        """Observes the ``value`` for ``labels``."""
+        values = self.registry.values
+        key = self.name, labels
+        try:
+            counts = values[key]
+        except KeyError:
+            # counts of buckets and +Inf, then the sum
+            counts = values[key] = [0] * (len(self.buckets) + 2)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                break
+        else:
+            i = len(self.buckets)
+        counts[i] += 1
+        counts[-1] += value
+
+    def samples(self, values):
+        """Generates cumulative ``_bucket`` samples, ``_sum`` and
+        ``_count``.
+
+        >>> histogram = Histogram(Registry(), 'h', 'Help.', buckets=(1, 2))
+        >>> histogram.observe(0.5); histogram.observe(3)
+        >>> for sample in histogram.samples(histogram.registry.collect()):
+        ...     print sample
+        ('h_bucket', {'le': '1'}, 1)
+        ('h_bucket', {'le': '2'}, 1)
+        ('h_bucket', {'le': '+Inf'}, 2)
+        ('h_sum', {}, 3.5)
+        ('h_count', {}, 2)
+
+        """
+        samples = super(Histogram, self).samples(values)
+        for name, labels, counts in samples:
+            total = 0
+            bounds = [format_number(b) for b in self.buckets] + ['+Inf']
+            for bound, count in zip(bounds, counts):
+                total += count
+                yield name + '_bucket', dict(labels, le=bound), total
+            yield name + '_sum', labels, counts[-1]
+            yield name + '_count', labels, total
+
+
+class Gauge(Metric):
+    """The value measured when metrics are served.
+
+    :param function: the function that returns the value
+    :type function: callable object
+
+    """
+
+    type = 'gauge'
+
+    def __init__(self, registry, name, help, function):
+        super(Gauge, self).__init__(registry, name, help)
+        self.function = function
+
+    def samples(self, values):
+        yield self.name, {}, self.function()
+
+
+#: The default registry.
+registry = Registry()
+
+#: Request latency by endpoint and status code.
+request_duration = registry.histogram(
+    'langdev_request_duration_seconds', 'Request latency.',
+    ('endpoint', 'status')
+)
+
+#: Total time of SQL statements per request.
+request_db_duration = registry.histogram(
+    'langdev_request_db_duration_seconds', 'SQL time per request.',
+    ('endpoint',)
+)
+
+#: The number of SQL statements.
+request_queries = registry.counter(
+    'langdev_db_queries_total', 'Executed SQL statements.', ('endpoint',)
+)
+
+#: Template render time.
+template_duration = registry.histogram(
+    'langdev_template_render_seconds', 'Template render time.',
+    ('template',)
+)
+
+#: Lookups of caches by the result, ``hit`` or ``miss``.
+#: See :func:`record_cache()`.
+cache_requests = registry.counter(
+    'langdev_cache_requests_total', 'Cache lookups.', ('cache', 'result')
+)
+
+#: The number of mails waiting to be sent.
+mail_queue_depth = registry.gauge(
+    'langdev_mail_queue_depth', 'Mails waiting to be sent.',
+    lambda: langdev.mail.queue_depth(flask.g.session)
+)
+
+
+def record_cache(cache, hit):
+    """Records a lookup of the ``cache``. Hit ratios are computed from
+    them.
+
+    :param cache: the name of the cache
+    :type cache: :class:`str`
+    :param hit: whether the value was in the cache
+    :type hit: :class:`bool`
+
+    """
+    cache_requests.inc(cache, 'hit' if hit else 'miss')
+
+
+def format_number(number):
+    """Formats the ``number`` for the Prometheus text format.
+
+    >>> format_number(0.25), format_number(10.0), format_number(3)
+    ('0.25', '10', '3')
+
+    """
+    if isinstance(number, float) and number.is_integer():
+        number = int(number)
+    return repr(number)
+
+
+def escape_label(value):
+    return re.sub(r'[\\"\n]', lambda m: '\\n' if m.group() == '\n'
+                                        else '\\' + m.group(), value)
+
+
+def format_text(registry, values):
+    """Formats collected ``values`` of metrics in the ``registry`` in the
+    Prometheus text format.
+
+    :rtype: :class:`str`
+
+    """
+    lines = []
+    for metric in registry.metrics:
+        lines.append('# HELP {0} {1}'.format(metric.name, metric.help))
+        lines.append('# TYPE {0} {1}'.format(metric.name, metric.type))
+        for name, labels, value in metric.samples(values):
+            if labels:
+                name += '{' + ','.join(
+                    '{0}="{1}"'.format(k, escape_label(unicode(v)))
+                    for k, v in sorted(labels.iteritems())
+                ) + '}'
+            lines.append('{0} {1}'.format(name, format_number(value)))
+    return '\n'.join(lines).encode('utf-8') + '\n'
+
+
+class TemplateTimingMixin(object):
+    """Measures template renders into :data:`template_duration`."""
+
+    def render(self, *args, **kwargs):
+        started_at = time.time()
+        try:
+            return super(TemplateTimingMixin, self).render(*args, **kwargs)
+        finally:
+            template_duration.observe(time.time() - started_at,
+                                      self.name or '<string>')
+
+
+#: Engines that the event listeners have been installed to.
+measured_engines = weakref.WeakSet()
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    conn.info.setdefault('metrics_started_at', []).append(time.time())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    started_at = conn.info['metrics_started_at'].pop()
+    if flask._request_ctx_stack.top is None:
+        return
+    timing = getattr(flask.g, 'metrics_timing', None)
+    if timing is not None:
+        timing[1] += time.time() - started_at
+        timing[2] += 1
+
+
+def install(app):
+    """Installs the metrics to the ``app``. :func:`create_app()
+    <langdev.web.create_app>` calls it if ``METRICS`` is set.
+
+    :param app: a LangDev application
+    :type app: :class:`flask.Flask`
+
+    """
+    engine = langdev.web.get_database_engine(app.config)
+    if engine not in measured_engines:
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+        measured_engines.add(engine)
+    jinja_env = app.jinja_env
+    if not issubclass(jinja_env.template_class, TemplateTimingMixin):
+        jinja_env.template_class = type(
+            'MeasuredTemplate',
+            (TemplateTimingMixin, jinja_env.template_class),
+            {}
+        )
+    directory = app.config.get('METRICS_DIR')
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    app.before_request_funcs.setdefault(None, []).insert(0, start_timing)
+    app.after_request(record_response)
+    app.teardown_request(finish_timing)
+    path = app.config.get('METRICS_PATH', '/metrics')
+    if path:
+        app.add_url_rule(path, 'metrics', serve)
+
+
+def start_timing():
+    # the start time, SQL time and the number of SQL statements
+    flask.g.metrics_timing = [time.time(), 0.0, 0]
+
+
+def record_response(response):
+    flask.g.metrics_status = response.status_code
+    return response
+
+
+def finish_timing(exception=None):
+    timing = getattr(flask.g, 'metrics_timing', None)
+    if timing is None:
+        return
+    # responses of unhandled exceptions don't go through after_request
+    status = getattr(flask.g, 'metrics_status', 500)
+    endpoint = flask.request.endpoint or '(unmatched)'
+    request_duration.observe(time.time() - timing[0], endpoint, str(status))
+    request_db_duration.observe(timing[1], endpoint)
+    if timing[2]:
+        request_queries.add(timing[2], endpoint)
+    flush()
+
+
+#: The time this process has written its values last.
+flushed_at = [0]
+
+
+def flush(force=False):
+    """Writes values of this process into ``METRICS_DIR`` if
+    ``METRICS_FLUSH_INTERVAL`` seconds have passed since the last time.
+
+    """
+    config = flask.current_app.config
+    directory = config.get('METRICS_DIR')
+    if not directory:
+        return
+    now = time.time()
+    if force or now - flushed_at[0] >= config.get('METRICS_FLUSH_INTERVAL', 5):
+        flushed_at[0] = now
+        path = os.path.join(directory, 'metrics-{0}.json'.format(os.getpid()))
+        registry.dump(path)
+
+
+def forbidden():
+    # the 403 handler of the application renders the signin form, which
+    # scrapers don't accept
+    return flask.Response('forbidden\n', 403, mimetype='text/plain')
+
+
+def serve():
+    """Serves the metrics in the Prometheus text format."""
+    config = flask.current_app.config
+    request = flask.request
+    secret = config.get('METRICS_SECRET')
+    if secret:
+        scheme, _, token = request.headers.get('Authorization', '') \
+                                  .partition(' ')
+        if scheme.lower() != 'bearer' or \
+           not hmac.compare_digest(str(token.strip()), str(secret)):
+            return forbidden()
+    else:
+        allowed = config.get('METRICS_ALLOWED_ADDRS', ('127.0.0.1',))
+        if request.remote_addr not in allowed or \
+           'X-Forwarded-For' in request.headers:
+            return forbidden()
+    directory = config.get('METRICS_DIR')
+    if directory:
+        flush(force=True)
+        values = registry.load(directory)
+    else:
+        values = registry.collect()
+    return flask.Response(format_text(registry, values),
+                          mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,314 @@
+""":mod:`langdev.web.querylog` --- Per-request SQL instrumentation
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+It records SQL statements that each request executes with their time,
+the template and the call site that have executed them. Statements of
+the same shape executed many times, which usually mean lazy loading in
+a loop of a template (the N+1 pattern), are reported as well.
+
+Turn it on in the config file::
+
+    SQL_INSTRUMENTATION = True
+
+The results are exposed in three ways:
+
+- :mailheader:`Server-Timing` response header, which browser developer
+  tools show.
+- The debug footer appended to HTML pages, if ``SQL_DEBUG_FOOTER`` is
+  set. It defaults to :attr:`~flask.Flask.debug`.
+- The slow request log. Requests taking ``SQL_SLOW_REQUEST`` seconds
+  (0.5 by default) or more are logged through the :mod:`logging` logger
+  named ``langdev.web.querylog``, or into the ``SQL_SLOW_LOG`` file if
+  it is set.
+
+Statements of the same shape executed ``SQL_REPEAT_THRESHOLD`` (5 by
+default) times or more are regarded as repeated.
+
+"""
+import os
+import re
+import sys
+import time
+import logging
+import weakref
+import flask
+from sqlalchemy import event
+import langdev
+import langdev.web
+
+__all__ = ('Statement', 'StatementGroup', 'QueryLog', 'install', 'normalize',
+           'current_log')
+
+
+#: The logger of the slow request log.
+logger = logging.getLogger(__name__)
+
+#: Engines that the event listeners have been installed to.
+instrumented_engines = weakref.WeakSet()
+
+package_dir = os.path.dirname(os.path.abspath(langdev.__file__))
+this_file = os.path.splitext(os.path.abspath(__file__))[0]
+
+
+class Statement(object):
+    """An executed SQL statement.
+
+    :param text: the :func:`normalize()`-d statement
+    :type text: :class:`basestring`
+    :param duration: the execution time in seconds
+    :type duration: :class:`float`
+    :param template: the template name and line number that executed it
+    :type template: :class:`str`
+    :param call_site: the filename, line number and function name of
+                      LangDev code that executed it
+    :type call_site: :class:`str`
+
+    """
+
+    __slots__ = 'text', 'duration', 'template', 'call_site'
+
+    def __init__(self, text, duration, template=None, call_site=None):
+        self.text = text
+        self.duration = duration
+        self.template = template
+        self.call_site = call_site
+
+
+class QueryLog(object):
+    """Statements executed in a request."""
+
+    def __init__(self):
+        #: (:class:`float`) The time the request has started.
+        self.started_at = time.time()
+
+        #: The :class:`list` of executed :class:`Statement` objects.
+        self.statements = []
+
+    @property
+    def count(self):
+        """The number of executed statements."""
+        return len(self.statements)
+
+    @property
+    def duration(self):
+        """The total execution time of statements in seconds."""
+        return sum(statement.duration for statement in self.statements)
+
+    def repeated(self, threshold=5):
+        """Groups statements of the same shape executed ``threshold`` times
+        or more, from the most frequent.
+
+        >>> log = QueryLog()
+        >>> for i in range(3):
+        ...     log.statements.append(Statement('SELECT 1', 0.1, 'a.html:1'))
+        >>> log.statements.append(Statement('SELECT 2', 0.1))
+        >>> [(g.text, len(g.statements), g.templates)
+        ...  for g in log.repeated(3)]
+        [('SELECT 1', 3, ['a.html:1'])]
+
+        :param threshold: the minimum number of executions
+        :type threshold: :class:`int`
+        :returns: the list of :class:`StatementGroup`
+        :rtype: :class:`list`
+
+        """
+        groups = {}
+        for statement in self.statements:
+            try:
+                group = groups[statement.text]
+            except KeyError:
+                group = groups[statement.text] = StatementGroup(statement.text)
+            group.statements.append(statement)
+        repeated = [group for group in groups.itervalues()
+                          if len(group.statements) >= threshold]
+        repeated.sort(key=lambda group: len(group.statements), reverse=True)
+        return repeated
+
+
+class StatementGroup(object):
+    """Statements of the same shape."""
+
+    def __init__(self, text):
+        self.text = text
+        self.statements = []
+
+    @property
+    def duration(self):
+        """The total execution time in seconds."""
+        return sum(statement.duration for statement in self.statements)
+
+    @property
+    def templates(self):
+        """The sorted list of templates that executed statements."""
+        return sorted(set(s.template for s in self.statements if s.template))
+
+    @property
+    def call_sites(self):
+        """The sorted list of call sites that executed statements."""
+        return sorted(set(s.call_site for s in self.statements
+                                      if s.call_site))
+
+
+def normalize(statement):
+    """Normalizes the ``statement`` so that statements of the same shape
+    are equal: literals and bound parameters become ``?``, and
+    ``IN`` lists are collapsed.
+
+    >>> normalize("SELECT *  FROM t\\nWHERE a IN (?, ?, ?) AND b = 'x'")
+    'SELECT * FROM t WHERE a IN (?) AND b = ?'
+    >>> normalize('SELECT users_1.id FROM users AS users_1 WHERE id = 12')
+    'SELECT users_1.id FROM users AS users_1 WHERE id = ?'
+    >>> normalize('SELECT * FROM t WHERE id = %(id_1)s')
+    'SELECT * FROM t WHERE id = ?'
+
+    """
+    statement = ' '.join(statement.split())
+    statement = re.sub(r"'(?:[^']|'')*'", '?', statement)
+    statement = re.sub(r'%\(\w+\)s|%s|:\w+|\b\d+(?:\.\d+)?\b', '?',
+                       statement)
+    return re.sub(r'\?(?:\s*,\s*\?)+', '?', statement)
+
+
+def current_log():
+    """Gets the :class:`QueryLog` of the current request. ``None`` if
+    there's no request or the instrumentation is turned off.
+
+    """
+    if flask._request_ctx_stack.top is None:
+        return
+    return getattr(flask.g, 'query_log', None)
+
+
+def find_origin(frame):
+    """Finds the template and the LangDev code that are running in the
+    stack ``frame``.
+
+    :returns: a pair of the template and the call site. each can be
+              ``None``
+    :rtype: :class:`tuple`
+
+    """
+    template = call_site = None
+    while frame is not None and not (template and call_site):
+        jinja_template = frame.f_globals.get('__jinja_template__')
+        if jinja_template is not None:
+            if template is None:
+                lineno = jinja_template.get_corresponding_lineno(
+                    frame.f_lineno
+                )
+                template = '{0}:{1}'.format(jinja_template.name, lineno)
+        elif call_site is None:
+            filename = os.path.abspath(frame.f_code.co_filename)
+            if filename.startswith(package_dir) and \
+               os.path.splitext(filename)[0] != this_file:
+                call_site = '{0}:{1} ({2})'.format(
+                    os.path.relpath(filename, os.path.dirname(package_dir)),
+                    frame.f_lineno, frame.f_code.co_name
+                )
+        frame = frame.f_back
+    return template, call_site
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    conn.info.setdefault('query_started_at', []).append(time.time())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    started_at = conn.info['query_started_at'].pop()
+    log = current_log()
+    if log is None:
+        return
+    duration = time.time() - started_at
+    template, call_site = find_origin(sys._getframe(1))
+    log.statements.append(Statement(normalize(statement), duration,
+                                    template, call_site))
+
+
+def install(app):
+    """Installs the instrumentation to the ``app``. :func:`create_app()
+    <langdev.web.create_app>` calls it if ``SQL_INSTRUMENTATION`` is set.
+
+    :param app: a LangDev application
+    :type app: :class:`flask.Flask`
+
+    """
+    engine = langdev.web.get_database_engine(app.config)
+    if engine not in instrumented_engines:
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+        instrumented_engines.add(engine)
+    slow_log = app.config.get('SQL_SLOW_LOG')
+    # the logger is global; don't log twice when apps are created again
+    if slow_log and not any(
+        getattr(handler, 'baseFilename', None) == os.path.abspath(slow_log)
+        for handler in logger.handlers
+    ):
+        handler = logging.FileHandler(slow_log)
+        handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+    # it has to be run before other functions, to record their queries
+    app.before_request_funcs.setdefault(None, []).insert(0, start_log)
+    app.after_request(report)
+
+
+def start_log():
+    flask.g.query_log = QueryLog()
+
+
+def report(response):
+    log = current_log()
+    if log is None:
+        return response
+    config = flask.current_app.config
+    elapsed = time.time() - log.started_at
+    repeated = log.repeated(config.get('SQL_REPEAT_THRESHOLD', 5))
+    timing = 'sql;dur={0:.3f};desc="{1} queries"'.format(log.duration * 1000,
+                                                         log.count)
+    if repeated:
+        timing += ', sql-repeated;desc="{0} repeated statements"'.format(
+            len(repeated)
+        )
+    timing += ', app;dur={0:.3f}'.format(elapsed * 1000)
+    response.headers['Server-Timing'] = timing
+    footer = config.get('SQL_DEBUG_FOOTER', flask.current_app.debug)
+    if footer and response.mimetype == 'text/html' and \
+       not response.is_streamed:
+        html = flask.render_template('querylog.html', log=log,
+                                     repeated=repeated, elapsed=elapsed)
+        data = response.data.decode(response.charset)
+        index = data.rfind(u'</body>')
+        if index < 0:
+            index = len(data)
+        response.data = (data[:index] + html + data[index:]) \
+                        .encode(response.charset)
+    if elapsed >= config.get('SQL_SLOW_REQUEST', 0.5):
+        log_slow_request(log, elapsed, repeated)
+    return response
+
+
+def log_slow_request(log, elapsed, repeated):
+    request = flask.request
+    lines = ['slow request: {0} {1} {2:.1f}ms, {3} queries {4:.1f}ms'.format(
+        request.method, request.path, elapsed * 1000,
+        log.count, log.duration * 1000
+    )]
+    for group in repeated:
+        lines.append('  repeated {0}x {1:.1f}ms: {2}'.format(
+            len(group.statements), group.duration * 1000, group.text
+        ))
+        for template in group.templates:
+            lines.append('    template: ' + template)
+        for call_site in group.call_sites:
+            lines.append('    call site: ' + call_site)
+    slowest = sorted(log.statements, key=lambda s: s.duration, reverse=True)
+    for statement in slowest[:3]:
+        lines.append('  slowest {0:.1f}ms: {1}'.format(
+            statement.duration * 1000, statement.text
+        ))
+        origin = [o for o in (statement.template, statement.call_site) if o]
+        if origin:
+            lines.append('    at ' + ', '.join(origin))
+    logger.warning('\n'.join(lines))
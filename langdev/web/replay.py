@@ -0,0 +1,302 @@
+""":mod:`langdev.web.replay` --- Access log replay
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+It replays requests of an access log in the combined format, which
+Apache and nginx write by default, against an application with their
+original relative timing, so that the real traffic mix (feed readers,
+crawlers walking deep pages, bursts of SSO requests) can be reproduced
+on a local instance. Latency is reported per endpoint.
+
+:program:`manage_langdev.py replay` is its command line interface.
+Logs don't have request bodies, so only ``GET`` and ``HEAD`` requests are
+replayed by default.
+
+"""
+import re
+import time
+import Queue
+import urllib
+import httplib
+import calendar
+import urlparse
+import threading
+import collections
+import werkzeug.exceptions
+
+__all__ = ('LogEntry', 'Result', 'Replayer', 'parse_log', 'parse_time',
+           'percentile', 'in_process_client', 'http_client', 'report',
+           'url_map_endpoint')
+
+
+#: The :mod:`re` pattern of a line in the combined log format.
+LOG_PATTERN = re.compile(
+    r'^(?P<host>\S+) \S+ \S+ \[(?P<time>[^\]]+)\] '
+    r'"(?P<method>[A-Z]+) (?P<url>\S+)(?: [^"]*)?" '
+    r'(?P<status>\d{3}) \S+'
+    r'(?: "(?P<referer>(?:[^"\\]|\\.)*)" "(?P<user_agent>(?:[^"\\]|\\.)*)")?'
+)
+
+#: A parsed access log line. :attr:`time` is seconds since the epoch.
+LogEntry = collections.namedtuple('LogEntry', 'time method url status '
+                                              'referer user_agent')
+
+#: A replayed request. :attr:`duration` is the latency, and :attr:`lag`
+#: is how late it was sent from the schedule, in seconds.
+Result = collections.namedtuple('Result', 'entry status duration lag')
+
+MONTHS = dict((month, i + 1) for i, month in enumerate(
+    'Jan Feb Mar Apr May Jun Jul Aug Sep Oct Nov Dec'.split()
+))
+
+
+def parse_time(string):
+    """Parses the time format of access logs.
+
+    .. sourcecode:: pycon
+
+       >>> parse_time('10/Oct/2011:13:55:36 +0900')
+       1318222536
+       >>> parse_time('10/Oct/2011:04:55:36 +0000')
+       1318222536
+
+    :returns: seconds since the epoch
+    :rtype: :class:`int`
+
+    """
+    date, offset = string.split()
+    day, month, rest = date.split('/', 2)
+    year, hour, minute, second = map(int, rest.split(':'))
+    timestamp = calendar.timegm((year, MONTHS[month], int(day),
+                                 hour, minute, second))
+    sign = -1 if offset[0] == '-' else 1
+    offset = sign * (int(offset[1:3]) * 3600 + int(offset[3:5]) * 60)
+    return timestamp - offset
+
+
+def parse_log(lines):
+    """Parses lines of an access log. Lines that aren't in the combined
+    (or common) log format are skipped.
+
+    .. sourcecode:: pycon
+
+       >>> line = ('127.0.0.1 - - [10/Oct/2011:13:55:36 +0900] '
+       ...         '"GET /posts/?offset=40 HTTP/1.1" 200 2326 '
+       ...         '"http://langdev.org/" "Mozilla/5.0 (\\\\"X\\\\")"')
+       >>> list(parse_log([line, 'broken']))  # doctest: +NORMALIZE_WHITESPACE
+       [LogEntry(time=1318222536, method='GET', url='/posts/?offset=40',
+                 status=200, referer='http://langdev.org/',
+                 user_agent='Mozilla/5.0 (\\\\"X\\\\")')]
+
+    :param lines: an iterable of lines
+    :returns: an iterator of :class:`LogEntry`
+
+    """
+    for line in lines:
+        match = LOG_PATTERN.match(line)
+        if not match:
+            continue
+        url = match.group('url')
+        if url.startswith(('http://', 'https://')):
+            parsed = urlparse.urlsplit(url)
+            url = urlparse.urlunsplit(('', '') + parsed[2:])
+        yield LogEntry(parse_time(match.group('time')), match.group('method'),
+                       url, int(match.group('status')),
+                       match.group('referer'), match.group('user_agent'))
+
+
+def percentile(sorted_values, p):
+    """Gets the ``p``-th percentile of ``sorted_values``.
+
+    .. sourcecode:: pycon
+
+       >>> percentile(range(1, 101), 95)
+       95
+
+    """
+    if not sorted_values:
+        return 0
+    index = int(round(p / 100.0 * len(sorted_values))) - 1
+    return sorted_values[max(0, min(index, len(sorted_values) - 1))]
+
+
+def in_process_client(app):
+    """Makes a function that requests the ``app`` through its test client.
+    It is called for each replaying thread.
+
+    """
+    def make_client():
+        client = app.test_client()
+        def request(entry):
+            headers = {'Accept': '*/*'}
+            if entry.user_agent:
+                headers['User-Agent'] = entry.user_agent
+            if entry.referer and entry.referer != '-':
+                headers['Referer'] = entry.referer
+            response = client.open(entry.url, method=entry.method,
+                                   headers=headers)
+            response.close()
+            return response.status_code
+        return request
+    return make_client
+
+
+def http_client(base_url):
+    """Makes a function that requests the server of ``base_url`` through
+    HTTP. It is called for each replaying thread.
+
+    """
+    url = urlparse.urlsplit(base_url)
+    prefix = url.path.rstrip('/')
+    def make_client():
+        def request(entry):
+            connection = httplib.HTTPConnection(url.hostname, url.port or 80)
+            headers = {'Accept': '*/*'}
+            if entry.user_agent:
+                headers['User-Agent'] = entry.user_agent
+            connection.request(entry.method, prefix + entry.url,
+                               headers=headers)
+            response = connection.getresponse()
+            response.read()
+            connection.close()
+            return response.status
+        return request
+    return make_client
+
+
+class Replayer(object):
+    """Replays log entries with their relative timing.
+
+    :param make_client: a function that makes a function to send a
+                        :class:`LogEntry` and to return the status code.
+                        see :func:`in_process_client()` and
+                        :func:`http_client()`
+    :type make_client: callable object
+    :param concurrency: the number of requests sent at the same time
+    :type concurrency: :class:`int`
+    :param speed: how many times faster than the original timing.
+                  0 sends requests as fast as possible
+    :type speed: :class:`float`
+
+    """
+
+    def __init__(self, make_client, concurrency=8, speed=1.0):
+        self.make_client = make_client
+        self.concurrency = concurrency
+        self.speed = speed
+
+    def run(self, entries):
+        """Replays the ``entries``, and returns the list of
+        :class:`Result`.
+
+        """
+        queue = Queue.Queue(self.concurrency * 2)
+        results = []
+        def work():
+            request = self.make_client()
+            while True:
+                item = queue.get()
+                if item is None:
+                    break
+                entry, due = item
+                started = time.time()
+                try:
+                    status = request(entry)
+                except Exception:
+                    status = None
+                results.append(Result(entry, status, time.time() - started,
+                                      max(0, started - due)))
+        workers = [threading.Thread(target=work)
+                   for i in xrange(self.concurrency)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        first = started = None
+        for entry in entries:
+            now = time.time()
+            if first is None:
+                first, started = entry.time, now
+            due = now
+            if self.speed:
+                due = started + (entry.time - first) / float(self.speed)
+                if due > now:
+                    time.sleep(due - now)
+            queue.put((entry, due))
+        for worker in workers:
+            queue.put(None)
+        for worker in workers:
+            worker.join()
+        return results
+
+
+def report(results, endpoint_of, elapsed, slowest=10):
+    """Makes the report lines of replayed ``results``.
+
+    :param results: the list of :class:`Result`
+    :type results: :class:`list`
+    :param endpoint_of: a function that takes a method and a path, and
+                        returns the endpoint name
+    :type endpoint_of: callable object
+    :param elapsed: the total seconds of the replay
+    :type elapsed: :class:`float`
+    :param slowest: the number of the slowest URLs to list
+    :type slowest: :class:`int`
+    :rtype: :class:`list`
+
+    """
+    lines = ['{0} requests in {1:.1f}s ({2:.1f} req/s)'.format(
+        len(results), elapsed, len(results) / elapsed if elapsed else 0
+    )]
+    lags = sorted(result.lag for result in results)
+    lines.append('schedule lag: p50 {0:.1f}ms, p99 {1:.1f}ms'.format(
+        percentile(lags, 50) * 1000, percentile(lags, 99) * 1000
+    ))
+    differed = sum(1 for result in results
+                   if result.status != result.entry.status)
+    if differed:
+        lines.append('{0} requests answered a status different from the '
+                     'log'.format(differed))
+    groups = {}
+    for result in results:
+        path = result.entry.url.split('?', 1)[0]
+        endpoint = endpoint_of(result.entry.method, path)
+        groups.setdefault(endpoint, []).append(result)
+    lines.append('')
+    lines.append('{0:<28} {1:>6} {2:>6} {3:>8} {4:>8} {5:>8} {6:>8}'.format(
+        'endpoint', 'count', 'errors', 'p50(ms)', 'p95(ms)', 'p99(ms)',
+        'max(ms)'
+    ))
+    ordered = sorted(groups.iteritems(), key=lambda (k, v): -len(v))
+    for endpoint, group in ordered:
+        durations = sorted(result.duration * 1000 for result in group)
+        errors = sum(1 for result in group
+                     if result.status is None or result.status >= 500)
+        lines.append('{0:<28} {1:>6} {2:>6} {3:>8.1f} {4:>8.1f} {5:>8.1f} '
+                     '{6:>8.1f}'.format(endpoint, len(group), errors,
+                                        percentile(durations, 50),
+                                        percentile(durations, 95),
+                                        percentile(durations, 99),
+                                        durations[-1]))
+    if slowest:
+        lines.append('')
+        lines.append('slowest requests')
+        ordered = sorted(results, key=lambda result: -result.duration)
+        for result in ordered[:slowest]:
+            lines.append('{0:>10.1f}ms {1:>4} {2} {3}'.format(
+                result.duration * 1000, result.status or 'fail',
+                result.entry.method, result.entry.url
+            ))
+    return lines
+
+
+def url_map_endpoint(url_map):
+    """Makes the ``endpoint_of`` function of :func:`report()` from the
+    ``url_map`` of an application.
+
+    """
+    adapter = url_map.bind('localhost')
+    def endpoint_of(method, path):
+        try:
+            return adapter.match(urllib.unquote(path), method)[0]
+        except werkzeug.exceptions.HTTPException:
+            return '(unmatched)'
+    return endpoint_of
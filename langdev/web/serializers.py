@@ -7,6 +7,8 @@ import datetime
 import plistlib
 import flask
 from langdev.objsimplify import simplify, camelCase, PascalCase
+from langdev.web import get_archive
+from langdev.util import tracing
 
 
 def json(value):
@@ -19,9 +21,11 @@ def json(value):
     """
     type_map = {datetime.datetime: datetime.datetime.isoformat,
                 datetime.date: datetime.date.isoformat}
-    data = simplify(value, identifier_map=camelCase,
-                           type_map=type_map,
-                           user=flask.g.current_user)
+    with tracing.span('simplify', 'serialize'):
+        data = simplify(value, identifier_map=camelCase,
+                               type_map=type_map,
+                               user=flask.g.current_user,
+                               archive=get_archive(flask.current_app.config))
     return flask.json.dumps(data)
 
 
@@ -36,8 +40,10 @@ def plist(value):
     """
     type_map = {datetime.date: datetime.date.isoformat,
                 types.NoneType: bool}
-    data = simplify(value, identifier_map=PascalCase,
-                           type_map=type_map,
-                           user=flask.g.current_user)
+    with tracing.span('simplify', 'serialize'):
+        data = simplify(value, identifier_map=PascalCase,
+                               type_map=type_map,
+                               user=flask.g.current_user,
+                               archive=get_archive(flask.current_app.config))
     return plistlib.writePlistToString(data)
 
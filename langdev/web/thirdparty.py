@@ -2,13 +2,18 @@
 ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
 """
+import re
+import hmac
 from flask import Blueprint, request, g, redirect, url_for, abort
 from flaskext import wtf
 import werkzeug.exceptions
+import sqlalchemy.sql
+import sqlalchemy.orm
 import sqlalchemy.orm.exc
 from langdev.user import User
 from langdev.thirdparty import Application
 from langdev.web import render
+from langdev.objsimplify import Result
 import langdev.web.user
 
 
@@ -83,6 +88,45 @@ def delete_app(app_key):
     return redirect(url_for('.register'), 302)
 
 
+#: The :mod:`re` pattern that matches to MD5 hexadecimal digests.
+DIGEST_PATTERN = re.compile(r'^[0-9a-f]{32}$')
+
+
+def authenticate(app, user, password, digest=None):
+    """Tests the password of the ``user`` for SSO. The ``app`` signs the
+    MD5 ``digest`` of the input password, and the digest is tested against
+    the password hash as sign-in does.
+
+    Without the ``digest``, the signature can be tested only against
+    legacy hashes, which are the digest themselves, so it fails once the
+    user has signed in and the hash has been upgraded.
+
+    :param app: an application that requests
+    :type app: :class:`langdev.thirdparty.Application`
+    :param user: a user to authenticate
+    :type user: :class:`~langdev.user.User`
+    :param password: HMAC digest of the MD5 digest of the input password
+                     signed by the ``app``
+    :type password: :class:`basestring`
+    :param digest: the MD5 hexadecimal digest of the input password
+    :type digest: :class:`basestring`
+    :rtype: :class:`bool`
+
+    """
+    if not password:
+        return False
+    signature = password.encode('ascii', 'ignore')
+    stored = user.password
+    if digest:
+        digest = digest.encode('ascii', 'ignore').lower()
+        if not DIGEST_PATTERN.match(digest) or \
+           not hmac.compare_digest(app.hmac(digest), signature):
+            return False
+        return stored.verify_digest(digest)
+    return stored.is_legacy and \
+           hmac.compare_digest(app.hmac(stored.hash_string), signature)
+
+
 @thirdparty.route('/<app_key>/sso/<user_login>', methods=['GET', 'POST'])
 def sso(app_key, user_login):
     """Simple SSO API."""
@@ -99,7 +143,9 @@ def sso(app_key, user_login):
             success = False
     else:
         try:
-            user = g.session.query(User).filter_by(email=user_login).one()
+            user = g.session.query(User) \
+                            .filter_by(email=user_login, hidden=False) \
+                            .one()
         except sqlalchemy.orm.exc.NoResultFound:
             if error_ignored:
                 success = False
@@ -108,7 +154,8 @@ def sso(app_key, user_login):
         except sqlalchemy.orm.exc.MultipleResultsFound:
             success = False
     if success is None:
-        success = app.hmac(user.password) == request.values['password']
+        success = authenticate(app, user, request.values.get('password'),
+                               request.values.get('digest'))
     if success and require_userinfo:
         result = user
         # workaround to include ``email`` attribute in the response.
@@ -118,3 +165,72 @@ def sso(app_key, user_login):
         result = success
     return render('thirdparty/sso', result, success=success)
 
+
+@thirdparty.route('/<app_key>/sso', methods=['POST'])
+def sso_batch(app_key):
+    """Batch version of :func:`sso()`. It verifies many users at once.
+    Pairs of login name (or email) and password are given as repeated
+    ``login`` and ``password`` parameters in the same order, with
+    ``digest`` parameters as well if the application sends them::
+
+        login=dahlia&password=...&digest=...&login=foo@example.com&...
+
+    All users are resolved by a single query. Unlike :func:`sso()`, it never
+    responds 404 Not Found for nonexistent users but just fails the entry.
+
+    :form login: login names or email addresses
+    :form password: HMAC digests, same as :func:`sso()`
+    :form digest: MD5 digests, same as :func:`sso()`
+    :query with: ``userinfo`` if the user information of succeeded entries
+                 is needed
+    :status 200: no error.
+    :status 400: the number of ``login``, ``password`` and ``digest``
+                 doesn't match.
+
+    """
+    app = get_app(app_key)
+    require_userinfo = request.values.get('with') == 'userinfo'
+    logins = request.values.getlist('login')
+    passwords = request.values.getlist('password')
+    digests = request.values.getlist('digest') or [None] * len(logins)
+    if not len(logins) == len(passwords) == len(digests):
+        abort(400)
+    login_names = set()
+    emails = set()
+    for login in logins:
+        if User.LOGIN_PATTERN.match(login):
+            login_names.add(login)
+        else:
+            emails.add(login)
+    by_login = {}
+    by_email = {}
+    if login_names or emails:
+        conds = []
+        if login_names:
+            conds.append(User.login.in_(login_names))
+        if emails:
+            conds.append(User.email.in_(emails))
+        users = g.session.query(User) \
+                         .options(sqlalchemy.orm.undefer('password_hash'),
+                                  sqlalchemy.orm.undefer_group('profile')) \
+                         .filter(sqlalchemy.sql.or_(*conds)) \
+                         .filter(User.hidden == False)
+        for user in users:
+            by_login[user.login] = user
+            by_email.setdefault(user.email, []).append(user)
+    results = []
+    for login, password, digest in zip(logins, passwords, digests):
+        if login in login_names:
+            user = by_login.get(login)
+        else:
+            found = by_email.get(login, ())
+            # same as :func:`sso()`, ambiguous emails always fail
+            user = found[0] if len(found) == 1 else None
+        success = user is not None and \
+                  authenticate(app, user, password, digest)
+        result = Result(login=login, success=success)
+        if success and require_userinfo:
+            result['user'] = user
+            result['email'] = user.email
+        results.append(result)
+    return render('thirdparty/sso_batch', results, results=results)
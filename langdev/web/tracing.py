@@ -0,0 +1,98 @@
+""":mod:`langdev.web.tracing` --- Request tracing
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+It traces sampled requests end to end: the WSGI middleware chain,
+before/after request functions, view functions, SQL statements, template
+renders, Markdown conversions and serializations. Each traced request is
+saved as a Chrome trace event JSON file.
+
+Turn it on in the config file::
+
+    TRACE_SAMPLE_RATE = 0.01  # trace 1% of requests
+    TRACE_DIR = '/var/log/langdev/traces'
+    TRACE_MIN_DURATION = 0.2  # save only requests slower than 200ms
+
+``TRACE_DIR`` defaults to :file:`langdev-traces` in the temporary
+directory, and ``TRACE_MIN_DURATION`` defaults to 0 (save all sampled
+requests).
+
+.. seealso:: Module :mod:`langdev.util.tracing`
+
+"""
+import os
+import time
+import weakref
+import tempfile
+import functools
+import jinja2
+from sqlalchemy import event
+import langdev.web
+from langdev.util import tracing
+from langdev.web.wsgi import TracingMiddleware
+
+__all__ = 'TracedTemplate', 'install', 'trace_function'
+
+
+#: Engines that the event listeners have been installed to.
+traced_engines = weakref.WeakSet()
+
+
+class TracedTemplate(jinja2.Template):
+    """The template that measures its renders as spans."""
+
+    def render(self, *args, **kwargs):
+        with tracing.span(self.name or '<string>', 'template'):
+            return jinja2.Template.render(self, *args, **kwargs)
+
+
+def trace_function(function, name, category):
+    """Wraps the ``function`` to measure its calls as spans."""
+    @functools.wraps(function)
+    def traced(*args, **kwargs):
+        with tracing.span(name, category):
+            return function(*args, **kwargs)
+    return traced
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    conn.info.setdefault('span_started_at', []).append(time.time())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    started_at = conn.info['span_started_at'].pop()
+    tracing.record('sql', 'sql', started_at, time.time(),
+                   statement=' '.join(statement.split()))
+
+
+def install(app):
+    """Installs the tracing to the ``app``. :func:`create_app()
+    <langdev.web.create_app>` calls it if ``TRACE_SAMPLE_RATE`` is
+    greater than zero.
+
+    :param app: a LangDev application
+    :type app: :class:`flask.Flask`
+
+    """
+    engine = langdev.web.get_database_engine(app.config)
+    if engine not in traced_engines:
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', after_cursor_execute)
+        traced_engines.add(engine)
+    for funcs in (app.before_request_funcs, app.after_request_funcs):
+        for key, functions in funcs.iteritems():
+            funcs[key] = [trace_function(f, f.__name__, 'hook')
+                          for f in functions]
+    for endpoint, function in app.view_functions.items():
+        app.view_functions[endpoint] = trace_function(function, endpoint,
+                                                      'view')
+    app.jinja_env.template_class = TracedTemplate
+    directory = app.config.get('TRACE_DIR') or \
+                os.path.join(tempfile.gettempdir(), 'langdev-traces')
+    app.wsgi_app = TracingMiddleware(
+        app.wsgi_app,
+        sample_rate=app.config['TRACE_SAMPLE_RATE'],
+        directory=directory,
+        min_duration=app.config.get('TRACE_MIN_DURATION', 0)
+    )
@@ -10,6 +10,7 @@
 import re
 import time
 import datetime
+import operator
 import hmac
 import hashlib
 import textwrap
@@ -18,8 +19,12 @@ from flask import (Blueprint, request, session, g, abort, redirect,
 from flask.ext import wtf
 from flask.ext.mail import Message
 from sqlalchemy import orm
-from langdev.user import User
-from langdev.web import before_request, errorhandler, render
+from langdev.user import User, Password
+from langdev.forum import Post
+import langdev.mail
+import langdev.purge
+from langdev.web import (before_request, errorhandler, render, is_serialized,
+                         list_posts)
 from langdev.objsimplify import Result
 
 
@@ -29,6 +34,20 @@ from langdev.objsimplify import Result
 user = Blueprint('user', __name__)
 
 
+@user.record
+def configure_password_hashing(state):
+    """Configures :class:`~langdev.user.Password` hashing by
+    ``PASSWORD_HASH_COST`` (the number of PBKDF2 iterations) and
+    ``PASSWORD_HASH_WORKERS`` (the number of hashing threads) configurations.
+
+    .. seealso:: :meth:`langdev.user.Password.configure()`
+
+    """
+    config = state.app.config
+    Password.configure(cost=config.get('PASSWORD_HASH_COST'),
+                       workers=config.get('PASSWORD_HASH_WORKERS', 4))
+
+
 @before_request
 def define_current_user():
     """Sets the :attr:`g.current_user <flask.g.current_user>` global variable
@@ -40,7 +59,9 @@ def define_current_user():
     except KeyError:
         g.current_user = None
     else:
-        g.current_user = g.session.query(User).filter_by(id=user_id).first()
+        g.current_user = g.session.query(User) \
+                                  .filter_by(id=user_id, hidden=False) \
+                                  .first()
 
 
 @user.app_context_processor
@@ -120,12 +141,14 @@ class SignInForm(wtf.Form):
     submit = wtf.SubmitField('Login')
 
     def validate_login(form, field):
-        if g.session.query(User).filter_by(login=field.data).count() < 1:
+        users = g.session.query(User).filter_by(login=field.data, hidden=False)
+        if users.count() < 1:
             raise wtf.ValidationError('There is no {0}.'.format(field.data))
 
     def validate_password(form, field):
         try:
-            user = g.session.query(User).filter_by(login=form.login.data)[0]
+            user = g.session.query(User).filter_by(login=form.login.data,
+                                                   hidden=False)[0]
         except IndexError:
             pass
         else:
@@ -148,6 +171,9 @@ def signin():
     form = SignInForm()
     if form.validate():
         user = g.session.query(User).filter_by(login=form.login.data)[0]
+        if user.password.needs_rehash:
+            with g.session.begin():
+                user.password = form.password.data
         set_current_user(user)
         return_url = form.return_url.data or \
                      url_for('.profile', user_login=user.login)
@@ -236,7 +262,7 @@ def signup():
 
 def get_user(login, *options):
     """Gets a user by its ``login`` name."""
-    query = g.session.query(User).filter_by(login=login)
+    query = g.session.query(User).filter_by(login=login, hidden=False)
     for option in options:
         query = query.options(option)
     try:
@@ -272,7 +298,8 @@ def leave(user_login):
     user = get_user(user_login)
     ensure_signin(user)
     with g.session.begin():
-        g.session.delete(user)
+        user.hidden = True
+        langdev.purge.purge_user.enqueue(g.session, user.id)
     set_current_user(None)
     return_url = request.values.get('return_url')
     if return_url:
@@ -284,7 +311,12 @@ def leave(user_login):
 def posts(user_login):
     """Posts a user wrote."""
     user = get_user(user_login)
-    posts = user.posts
+    serialized = is_serialized('user/posts')
+    # the page lists the latest 30 posts, while serialized values have all
+    posts = list_posts((Post.author_id == user.id) & (Post.hidden == False),
+                       order_by=Post.created_at.desc(),
+                       key=operator.attrgetter('created_at'),
+                       limit=None if serialized else 30, counts=serialized)
     return render('user/posts', posts, user=user, posts=posts)
 
 
@@ -380,7 +412,8 @@ def request_find_password(user_login):
 
             But the above link will be expired at {expired_at} UTC.
         ''').format(url=url, expired_at=expired_at)
-        current_app.mail.send(msg)
+        with g.session.begin():
+            langdev.mail.enqueue(g.session, msg)
         email = hide_email(user.email)
         result = Result(user=user, email=email)
         status_code = 201
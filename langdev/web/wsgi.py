@@ -2,8 +2,33 @@
 ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
 """
+import os
+import hmac
+import json
+import time
+import random
+import tempfile
+import cProfile
+import itertools
 import flask
 import werkzeug.urls
+import werkzeug.exceptions
+from langdev.util import tracing
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+#: The directory :class:`ProfilerMiddleware` saves profiles into if
+#: ``PROFILE_DIR`` isn't configured.
+default_profile_dir = os.path.join(tempfile.gettempdir(), 'langdev-profiles')
 
 
 class MethodRewriteMiddleware(object):
@@ -83,3 +108,259 @@ class HostRewriteMiddleware(object):
             environ['HTTP_HOST'] = self.host
         return self.application(environ, start_response)
 
+
+class TracingMiddleware(object):
+    """A WSGI middleware that traces sampled requests with
+    :mod:`langdev.util.tracing`, and saves them as Chrome trace event
+    JSON files. Every span recorded while the wrapped application runs,
+    including the whole of the wrapped middleware chain, goes into the
+    trace of the request.
+
+    :param application: WSGI application to wrap
+    :type application: callable object
+    :param sample_rate: the ratio of requests to trace, from 0 to 1
+    :type sample_rate: :class:`float`
+    :param directory: the directory to save trace files into
+    :type directory: :class:`basestring`
+    :param min_duration: requests faster than this seconds aren't saved
+    :type min_duration: :class:`float`
+
+    .. seealso:: Module :mod:`langdev.web.tracing`
+
+    """
+
+    __slots__ = 'application', 'sample_rate', 'directory', 'min_duration'
+
+    def __init__(self, application, sample_rate, directory, min_duration=0):
+        if not callable(application):
+            raise TypeError('application must be callable, but {0!r} is not '
+                            'callable'.format(application))
+        self.application = application
+        self.sample_rate = sample_rate
+        self.directory = directory
+        self.min_duration = min_duration
+
+    def __call__(self, environ, start_response):
+        if random.random() >= self.sample_rate:
+            return self.application(environ, start_response)
+        status = []
+        def start_traced_response(status_, headers, exc_info=None):
+            status.append(status_)
+            return start_response(status_, headers, exc_info)
+        trace = tracing.begin('{0} {1}'.format(environ['REQUEST_METHOD'],
+                                               environ.get('PATH_INFO', '')))
+        trace.metadata.update(method=environ['REQUEST_METHOD'],
+                              path=environ.get('PATH_INFO', ''),
+                              query=environ.get('QUERY_STRING', ''))
+        try:
+            with tracing.span('wsgi', 'wsgi'):
+                return self.application(environ, start_traced_response)
+        finally:
+            tracing.end()
+            if status:
+                trace.metadata['status'] = status[0]
+            if trace.duration >= self.min_duration:
+                trace.save(self.directory)
+
+
+class ProfilerMiddleware(object):
+    """A WSGI middleware that profiles requests on demand. Administrators
+    arm it to run the next ``count`` requests of an endpoint under
+    :mod:`cProfile`, and each of them is saved into the ``directory`` as
+    a :file:`.pstats` file::
+
+        $ curl -X POST -H 'X-Profile-Secret: ...' \\
+               'http://langdev.org/_profile/arm?endpoint=forum.posts&count=5'
+
+    The armed state is kept in the ``directory``, so every worker process
+    sharing it profiles requests until ``count`` requests in total have
+    been profiled.
+
+    It can also take :mod:`tracemalloc` snapshots of the worker process
+    that answers ``POST /_profile/snapshot``, if the :mod:`tracemalloc`
+    module is available and ``trace_memory`` is set. Compare two snapshots
+    to find out what has grown between them.
+
+    Requests to :file:`/_profile/` without the right secret in the
+    :mailheader:`X-Profile-Secret` header are answered with 404.
+
+    :param application: Flask application to wrap
+    :type application: :class:`flask.Flask`
+    :param secret: the secret that administrators know. if not present,
+                   ``PROFILE_SECRET`` configuration is used
+    :type secret: :class:`basestring`
+    :param directory: the directory to save profiles into. if not present,
+                      ``PROFILE_DIR`` configuration or
+                      :data:`default_profile_dir` is used
+    :type directory: :class:`basestring`
+    :param trace_memory: whether to start :mod:`tracemalloc`. if not
+                         present, ``PROFILE_TRACEMALLOC`` configuration is
+                         used
+    :type trace_memory: :class:`bool`
+
+    .. seealso:: :program:`manage_langdev.py profiles` and
+                 :program:`manage_langdev.py profile-diff`
+
+    """
+
+    #: The path prefix of control requests.
+    control_prefix = '/_profile/'
+
+    #: The name of the file that stores armed endpoints in the directory.
+    armed_filename = 'armed.json'
+
+    #: The interval in seconds to check the armed state.
+    check_interval = 1
+
+    def __init__(self, application, secret=None, directory=None,
+                 trace_memory=None):
+        if not isinstance(application, flask.Flask):
+            raise TypeError('application must be a flask.Flask instance, '
+                            'not ' + repr(application))
+        config = application.config
+        self.application = application.wsgi_app
+        self.url_map = application.url_map
+        self.secret = secret or config['PROFILE_SECRET']
+        self.directory = directory or \
+                         config.get('PROFILE_DIR', default_profile_dir)
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        if trace_memory is None:
+            trace_memory = config.get('PROFILE_TRACEMALLOC', False)
+        if trace_memory and tracemalloc is not None and \
+           not tracemalloc.is_tracing():
+            tracemalloc.start(config.get('PROFILE_TRACEMALLOC_FRAMES', 1))
+        self.armed = {}
+        self.checked_at = 0
+        self.serial = itertools.count()
+
+    @property
+    def armed_path(self):
+        return os.path.join(self.directory, self.armed_filename)
+
+    def update_armed(self, function):
+        """Updates the armed state while the file is locked.
+
+        :param function: a function that takes the :class:`dict` of armed
+                         endpoints and returns a value to return
+        :type function: callable object
+
+        """
+        with open(self.armed_path, 'a+') as f:
+            # without fcntl e.g. on Windows, processes may race on the file
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                try:
+                    armed = json.load(f)
+                except ValueError:
+                    armed = {}
+                result = function(armed)
+                f.seek(0)
+                f.truncate()
+                json.dump(armed, f)
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+        self.armed = armed
+        return result
+
+    def load_armed(self):
+        """Reads the armed state if :attr:`check_interval` seconds have
+        passed since the last time.
+
+        :returns: the :class:`dict` of armed endpoints to their remaining
+                  counts
+
+        """
+        now = time.time()
+        if now - self.checked_at >= self.check_interval:
+            self.checked_at = now
+            try:
+                with open(self.armed_path) as f:
+                    self.armed = json.load(f)
+            except (IOError, ValueError):
+                self.armed = {}
+        return self.armed
+
+    def claim(self, endpoint):
+        """Takes one of the armed requests of the ``endpoint``.
+
+        :returns: whether it has been claimed
+        :rtype: :class:`bool`
+
+        """
+        def take(armed):
+            remaining = armed.get(endpoint, 0)
+            if remaining <= 0:
+                return False
+            if remaining > 1:
+                armed[endpoint] = remaining - 1
+            else:
+                del armed[endpoint]
+            return True
+        return self.update_armed(take)
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        if path.startswith(self.control_prefix):
+            return self.control(environ, start_response)
+        armed = self.load_armed()
+        # nearly all requests come while nothing is armed; don't match them
+        if not any(count > 0 for count in armed.itervalues()):
+            return self.application(environ, start_response)
+        try:
+            endpoint, _ = self.url_map.bind_to_environ(environ).match()
+        except werkzeug.exceptions.HTTPException:
+            return self.application(environ, start_response)
+        if not (armed.get(endpoint, 0) > 0 and self.claim(endpoint)):
+            return self.application(environ, start_response)
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(self.application, environ, start_response)
+        finally:
+            filename = '{0}-{1}-{2}-{3}.pstats'.format(
+                endpoint,
+                time.strftime('%Y%m%d%H%M%S'),
+                os.getpid(),
+                next(self.serial)
+            )
+            profile.dump_stats(os.path.join(self.directory, filename))
+
+    def control(self, environ, start_response):
+        request = flask.Request(environ)
+        secret = request.headers.get('X-Profile-Secret', '')
+        if request.method != 'POST' or \
+           not hmac.compare_digest(str(secret), str(self.secret)):
+            return werkzeug.exceptions.NotFound()(environ, start_response)
+        command = request.path[len(self.control_prefix):]
+        if command == 'arm':
+            endpoint = request.values.get('endpoint')
+            if endpoint not in self.url_map._rules_by_endpoint:
+                response = werkzeug.exceptions.BadRequest('no such endpoint')
+                return response(environ, start_response)
+            count = request.values.get('count', 1, type=int)
+            def arm(armed):
+                armed[endpoint] = count
+            self.update_armed(arm)
+            message = 'next {0} requests of {1} will be profiled'.format(
+                count, endpoint
+            )
+        elif command == 'snapshot':
+            if tracemalloc is None or not tracemalloc.is_tracing():
+                response = werkzeug.exceptions.BadRequest(
+                    'tracemalloc is not tracing'
+                )
+                return response(environ, start_response)
+            filename = 'snapshot-{0}-{1}.tracemalloc'.format(
+                time.strftime('%Y%m%d%H%M%S'), os.getpid()
+            )
+            tracemalloc.take_snapshot().dump(
+                os.path.join(self.directory, filename)
+            )
+            message = filename
+        else:
+            return werkzeug.exceptions.NotFound()(environ, start_response)
+        response = flask.Response(message + '\n', mimetype='text/plain')
+        return response(environ, start_response)
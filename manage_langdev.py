@@ -4,7 +4,10 @@
 
 """
 import sys
+import json
+import time
 import os.path
+import pstats
 import hashlib
 import datetime
 import flask
@@ -12,9 +15,16 @@ from flaskext.script import *
 import langdev.orm
 import langdev.web
 import langdev.user
+import langdev.mail
+import langdev.job
+import langdev.backup
+import langdev.web.wsgi
 
 
-model_modules = ['langdev.user', 'langdev.forum', 'langdev.thirdparty']
+model_modules = ['langdev.user', 'langdev.forum', 'langdev.thirdparty',
+                 'langdev.mail', 'langdev.job']
+
+job_modules = ['langdev.purge']
 
 
 def create_app(config_filename):
@@ -66,6 +76,529 @@ def initdb():
     langdev.orm.Base.metadata.create_all(engine)
 
 
+@manager.option('-l', '--loop', dest='loop', action='store_true',
+                help='Keep sending mails until interrupted')
+@manager.option('-i', '--interval', dest='interval', type=float, default=5,
+                help='Seconds to wait when the queue is empty')
+@manager.option('-b', '--batch', dest='batch', type=int, default=100,
+                help='The maximum number of mails to send per connection')
+def mailer(loop=False, interval=5, batch=100):
+    """Sends queued mails."""
+    app = flask.current_app
+    engine = langdev.web.get_database_engine(app.config)
+    session = langdev.orm.Session(bind=engine)
+    while True:
+        sent = langdev.mail.send_queued(session, app.mail, limit=batch)
+        if sent:
+            print '{0} mails have sent'.format(sent)
+        elif not loop:
+            break
+        else:
+            time.sleep(interval)
+        session.expunge_all()
+
+
+@manager.option('-H', '--host', dest='host', default='127.0.0.1')
+@manager.option('-p', '--port', dest='port', type=int, default=1025)
+def smtpsink(host='127.0.0.1', port=1025):
+    """Runs a local SMTP server that prints mails instead of delivering
+    them. Set ``MAIL_SERVER`` and ``MAIL_PORT`` to use it.
+
+    """
+    import smtpd
+    import asyncore
+    smtpd.DebuggingServer((host, port), None)
+    print 'SMTP sink is listening on {0}:{1}'.format(host, port)
+    try:
+        asyncore.loop()
+    except KeyboardInterrupt:
+        pass
+
+
+def import_job_modules():
+    """Imports modules that define jobs, so that they are registered."""
+    modules = model_modules + job_modules
+    modules.extend(flask.current_app.config.get('JOB_MODULES', []))
+    for module in modules:
+        __import__(module)
+
+
+@manager.option('-t', '--threads', dest='threads', type=int, default=1,
+                help='The number of worker threads per process')
+@manager.option('-p', '--processes', dest='processes', type=int, default=1,
+                help='The number of worker processes')
+@manager.option('-i', '--interval', dest='interval', type=float, default=1,
+                help='Seconds to wait when there are no jobs')
+@manager.option('-s', '--stale-timeout', dest='stale_timeout', type=int,
+                default=3600, help='Seconds after which running jobs are '
+                                   'considered as dead and queued again')
+@manager.option('-k', '--keep-done', dest='keep_done', type=int,
+                default=604800, help='Seconds to keep finished jobs for')
+def worker(threads=1, processes=1, interval=1, stale_timeout=3600,
+           keep_done=604800):
+    """Runs queued background jobs."""
+    import multiprocessing
+    import_job_modules()
+    app = flask.current_app._get_current_object()
+    engine = langdev.web.get_database_engine(app.config)
+    def serve():
+        # connections must not be shared between forked processes
+        engine.dispose()
+        worker = langdev.job.Worker(engine, threads=threads,
+                                    poll_interval=interval,
+                                    context=app.test_request_context,
+                                    stale_timeout=stale_timeout,
+                                    keep_done=keep_done)
+        worker.run()
+    if processes < 2:
+        serve()
+        return
+    procs = [multiprocessing.Process(target=serve) for i in xrange(processes)]
+    for proc in procs:
+        proc.start()
+    while any(proc.is_alive() for proc in procs):
+        try:
+            for proc in procs:
+                proc.join()
+        except KeyboardInterrupt:
+            # children receive the signal as well, and stop by themselves
+            pass
+
+
+@manager.command
+def jobstats():
+    """Prints the statistics of the background job queue."""
+    engine = langdev.web.get_database_engine(flask.current_app.config)
+    stats = langdev.job.stats(langdev.orm.Session(bind=engine))
+    print 'Queued:  {0}'.format(stats['queued'])
+    print 'Running: {0}'.format(stats['running'])
+    print 'Failed:  {0}'.format(stats['failed'])
+    print 'Oldest:  {0:.3f}s'.format(stats['oldest'])
+    print 'Latency: {0:.3f}s'.format(stats['latency'])
+
+
+@manager.command
+def upgradedb():
+    """Adds tables, columns and indexes that don't exist yet, and then
+    runs data migrations.
+
+    """
+    for module in model_modules:
+        __import__(module)
+    engine = langdev.web.get_database_engine(flask.current_app.config)
+    for change in langdev.orm.upgrade_schema(engine):
+        print change
+    archive = langdev.web.get_archive(flask.current_app.config)
+    if archive is not None:
+        for change in archive.upgrade():
+            print 'archive:', change
+    session = langdev.orm.Session(bind=engine)
+    for migrate in langdev.orm.migrations:
+        migrated = migrate(session)
+        if migrated:
+            print '{0}: {1} rows'.format(migrate.__name__, migrated)
+
+
+@manager.option('-d', '--days', dest='days', type=int, default=None,
+                help='Archive posts inactive for this many days. '
+                     'ARCHIVE_AFTER_DAYS (365) by default')
+@manager.option('-b', '--batch-size', dest='batch_size', type=int,
+                default=100, help='The number of posts to move per '
+                                  'transaction')
+def archive(days=None, batch_size=100):
+    """Moves posts that have been neither modified nor commented on for
+    ``ARCHIVE_AFTER_DAYS`` days to the archive configured by
+    ``ARCHIVE_DATABASE``, with their comments. Run it periodically.
+
+    """
+    for module in model_modules:
+        __import__(module)
+    config = flask.current_app.config
+    archive = langdev.web.get_archive(config)
+    if archive is None:
+        print>>sys.stderr, 'ARCHIVE_DATABASE is not configured'
+        raise SystemExit(1)
+    for change in archive.upgrade():
+        print 'archive:', change
+    if days is None:
+        days = config.get('ARCHIVE_AFTER_DAYS', 365)
+    before = datetime.datetime.utcnow() - datetime.timedelta(days=days)
+    started_at = time.time()
+    moved = archive.move(before, batch_size)
+    print '{0} posts have been archived in {1:.1f}s'.format(
+        moved, time.time() - started_at
+    )
+
+
+def key_queries(session):
+    """Makes the queries that hot pages run, for :class:`IndexAdvisor`.
+
+    :returns: the list of pairs of a description and a query
+    :rtype: :class:`list`
+
+    """
+    from langdev.user import User
+    from langdev.forum import Post, Comment, path_segment
+    post = session.query(Post).first() or Post(id=1, author_id=1)
+    comment = session.query(Comment).first() or \
+              Comment(id=1, post_id=1, path=path_segment(1))
+    now = datetime.datetime.utcnow()
+    visible_posts = session.query(Post).filter(Post.hidden == False)
+    return [
+        ('user by login',
+         session.query(User).filter_by(login=u'login', hidden=False)),
+        ('post listing',
+         visible_posts.order_by(Post.sticky.desc(), Post.created_at.desc())
+                      .limit(20)),
+        ('atom feed',
+         visible_posts.order_by(Post.created_at.desc()).limit(20)),
+        ('recently modified posts',
+         session.query(Post).filter(Post.modified_at > now)
+                            .order_by(Post.modified_at)),
+        ('posts of a user',
+         visible_posts.filter(Post.author_id == post.author_id)
+                      .order_by(Post.created_at.desc()).limit(30)),
+        ('top-level comments',
+         session.query(Comment).filter(Comment.post_id == post.id)
+                               .filter(Comment.parent_id == None)
+                               .filter(Comment.hidden == False)
+                               .order_by(Comment.created_at, Comment.id)
+                               .limit(50)),
+        ('replies on a comment',
+         session.query(Comment).filter(Comment.post_id == comment.post_id)
+                               .filter(Comment.parent_id == comment.id)
+                               .filter(Comment.hidden == False)
+                               .order_by(Comment.created_at)),
+        ('comment subtree',
+         session.query(Comment).filter(Comment.post_id == comment.post_id)
+                               .filter(Comment.path > comment.path)
+                               .filter(Comment.path < comment.path + 'g')
+                               .order_by(Comment.path)),
+    ]
+
+
+class IndexAdvisor(Command):
+    """Explains the queries that hot pages run, and reports full table
+    scans and sorts in temporary storage. Indexes declared in models but
+    missing in the database are listed as well, and created with
+    ``--create``.
+
+    """
+
+    option_list = (
+        Option('--create', dest='create', action='store_true',
+               help='Create missing indexes'),
+    )
+
+    def run(self, create=False):
+        for module in model_modules:
+            __import__(module)
+        engine = langdev.web.get_database_engine(flask.current_app.config)
+        session = langdev.orm.Session(bind=engine)
+        warned = 0
+        for description, query in key_queries(session):
+            print description
+            plan = langdev.orm.explain(engine, query)
+            for line in plan:
+                print '   ', line
+            for warning in langdev.orm.plan_warnings(plan):
+                print '  !', warning
+                warned += 1
+        missing = langdev.orm.missing_indexes(engine)
+        if missing:
+            print 'Missing indexes'
+            for index in missing:
+                columns = ', '.join(column.name for column in index.columns)
+                print '   ', '{0} ON {1} ({2})'.format(index.name,
+                                                       index.table.name,
+                                                       columns)
+                if create:
+                    langdev.orm.create_index(engine, index)
+                    print '    ...created'
+        print '{0} warnings, {1} missing indexes'.format(warned, len(missing))
+
+
+manager.add_command('index-advisor', IndexAdvisor())
+
+
+def profile_dir():
+    return flask.current_app.config.get('PROFILE_DIR',
+                                        langdev.web.wsgi.default_profile_dir)
+
+
+@manager.command
+def profiles():
+    """Lists profiles and memory snapshots that the profiler middleware
+    has captured, from the oldest.
+
+    """
+    directory = profile_dir()
+    if not os.path.isdir(directory):
+        print 'No profiles in {0}'.format(directory)
+        return
+    filenames = [f for f in os.listdir(directory)
+                   if f.endswith(('.pstats', '.tracemalloc'))]
+    filenames.sort(key=lambda f: os.path.getmtime(os.path.join(directory, f)))
+    for filename in filenames:
+        path = os.path.join(directory, filename)
+        captured_at = datetime.datetime.fromtimestamp(os.path.getmtime(path))
+        if filename.endswith('.pstats'):
+            stats = pstats.Stats(path)
+            summary = '{0:.3f}s, {1} calls'.format(stats.total_tt,
+                                                    stats.total_calls)
+        else:
+            summary = '{0} bytes'.format(os.path.getsize(path))
+        print '{0:%Y-%m-%d %H:%M:%S}  {1}  ({2})'.format(captured_at,
+                                                         filename, summary)
+    print '{0} files in {1}'.format(len(filenames), directory)
+
+
+class ProfileDiff(Command):
+    """Compares two profiles, or two memory snapshots, that
+    :program:`manage_langdev.py profiles` lists. Functions whose
+    cumulative time changed, or lines whose allocated memory changed,
+    the most are printed first.
+
+    """
+
+    option_list = (
+        Option('old', help='The older profile or snapshot'),
+        Option('new', help='The newer profile or snapshot'),
+        Option('-n', '--limit', dest='limit', type=int, default=20,
+               help='The number of differences to print'),
+    )
+
+    def run(self, old, new, limit=20):
+        directory = profile_dir()
+        old, new = [path if os.path.exists(path)
+                    else os.path.join(directory, path) for path in (old, new)]
+        if old.endswith('.tracemalloc') and new.endswith('.tracemalloc'):
+            self.diff_snapshots(old, new, limit)
+        elif old.endswith('.pstats') and new.endswith('.pstats'):
+            self.diff_stats(old, new, limit)
+        else:
+            print>>sys.stderr, 'Both have to be .pstats or .tracemalloc files'
+            raise SystemExit(1)
+
+    def diff_stats(self, old, new, limit):
+        old_stats = pstats.Stats(old).stats
+        new_stats = pstats.Stats(new).stats
+        functions = set(old_stats).union(new_stats)
+        # the cumulative time is the fourth item of pstats values
+        rows = [(old_stats.get(f, (0, 0, 0, 0))[3],
+                 new_stats.get(f, (0, 0, 0, 0))[3],
+                 f) for f in functions]
+        rows.sort(key=lambda row: abs(row[1] - row[0]), reverse=True)
+        print '{0:>9} {1:>9} {2:>9}  function'.format('old', 'new', 'delta')
+        for old_time, new_time, function in rows[:limit]:
+            print '{0:9.4f} {1:9.4f} {2:+9.4f}  {3}'.format(
+                old_time, new_time, new_time - old_time,
+                pstats.func_std_string(function)
+            )
+
+    def diff_snapshots(self, old, new, limit):
+        tracemalloc = langdev.web.wsgi.tracemalloc
+        if tracemalloc is None:
+            print>>sys.stderr, 'tracemalloc is not available'
+            raise SystemExit(1)
+        old_snapshot = tracemalloc.Snapshot.load(old)
+        new_snapshot = tracemalloc.Snapshot.load(new)
+        for stat in new_snapshot.compare_to(old_snapshot, 'lineno')[:limit]:
+            print stat
+
+
+manager.add_command('profile-diff', ProfileDiff())
+
+
+class Replay(Command):
+    """Replays an access log in the combined format against this instance
+    with the original relative timing, and reports latency per endpoint
+    and the slowest URLs. Point ``DATABASE_URL`` to a seeded database
+    (see :file:`benchmarks/seed.py`) rather than the production one.
+
+    """
+
+    option_list = (
+        Option('log', help='The access log file. - for the standard input'),
+        Option('-s', '--speed', dest='speed', type=float, default=1,
+               help='How many times faster than the original timing. '
+                    '0 to send requests as fast as possible'),
+        Option('-c', '--concurrency', dest='concurrency', type=int,
+               default=8, help='The number of concurrent requests'),
+        Option('--url', dest='url',
+               help='The base URL of a running server to replay against, '
+                    'instead of the application in this process'),
+        Option('--methods', dest='methods', default='GET,HEAD',
+               help='Comma-separated methods to replay'),
+        Option('-n', '--limit', dest='limit', type=int,
+               help='The number of log entries to replay'),
+        Option('--slowest', dest='slowest', type=int, default=10,
+               help='The number of the slowest URLs to print'),
+    )
+
+    def run(self, log, speed=1, concurrency=8, url=None, methods='GET,HEAD',
+            limit=None, slowest=10):
+        import gzip
+        import itertools
+        from langdev.web import replay
+        app = flask.current_app._get_current_object()
+        if log == '-':
+            lines = sys.stdin
+        elif log.endswith('.gz'):
+            lines = gzip.open(log)
+        else:
+            lines = open(log)
+        methods = frozenset(m.strip().upper() for m in methods.split(','))
+        entries = (entry for entry in replay.parse_log(lines)
+                   if entry.method in methods)
+        if limit:
+            entries = itertools.islice(entries, limit)
+        if url:
+            make_client = replay.http_client(url)
+        else:
+            make_client = replay.in_process_client(app)
+        replayer = replay.Replayer(make_client, concurrency=concurrency,
+                                   speed=speed)
+        started_at = time.time()
+        results = replayer.run(entries)
+        elapsed = time.time() - started_at
+        if not results:
+            print>>sys.stderr, 'No requests to replay'
+            raise SystemExit(1)
+        endpoint_of = replay.url_map_endpoint(app.url_map)
+        for line in replay.report(results, endpoint_of, elapsed, slowest):
+            print line
+
+
+manager.add_command('replay', Replay())
+
+
+class Import(Command):
+    """Imports users, applications, posts and comments from JSON Lines
+    files in bulk, preserving their ids and times. Files compressed by
+    gzip are decompressed. See :mod:`langdev.backup` for the format.
+
+    """
+
+    option_list = (
+        Option('paths', nargs='+', metavar='path',
+               help='JSON Lines files to import. - for the standard input'),
+        Option('--batch-size', dest='batch_size', type=int,
+               default=langdev.backup.BATCH_SIZE,
+               help='The number of rows to insert per transaction'),
+        Option('--replace', dest='replace', action='store_true',
+               help='Update rows that already exist. Needed to apply '
+                    'incremental exports'),
+    )
+
+    def run(self, paths, batch_size=langdev.backup.BATCH_SIZE,
+            replace=False):
+        import gzip
+        engine = langdev.web.get_database_engine(flask.current_app.config)
+        importer = langdev.backup.Importer(engine, batch_size=batch_size,
+                                           replace=replace)
+        started_at = time.time()
+        for path in paths:
+            if path == '-':
+                lines = sys.stdin
+            elif path.endswith('.gz'):
+                lines = gzip.open(path)
+            else:
+                lines = open(path)
+            for number, line in enumerate(lines, 1):
+                if not line.strip():
+                    continue
+                try:
+                    importer.feed(json.loads(line))
+                except ValueError as e:
+                    print>>sys.stderr, '{0}:{1}: {2}'.format(path, number, e)
+                    raise SystemExit(1)
+        try:
+            counts = importer.finish()
+        except ValueError as e:
+            print>>sys.stderr, e
+            raise SystemExit(1)
+        elapsed = time.time() - started_at
+        total = sum(counts.itervalues())
+        for type_, cls in langdev.backup.TYPES:
+            print '{0:<12} {1:>10} rows'.format(type_, counts[type_])
+        print '{0} rows in {1:.1f}s ({2:.0f} rows/s)'.format(
+            total, elapsed, total / elapsed if elapsed else 0
+        )
+
+
+manager.add_command('import', Import())
+
+
+class Export(Command):
+    """Exports users, applications, posts and comments to a JSON Lines
+    file from a consistent snapshot, in constant memory. It's compressed
+    by gzip if the path ends with :file:`.gz`. The output can be imported
+    by :program:`manage_langdev.py import`. Archived posts and comments
+    are exported as well, and imported into the database.
+
+    With ``--watermark``, only rows created or modified since the previous
+    export are exported, and the file is updated after the export::
+
+        $ manage_langdev.py export -c prod.cfg --watermark wm full.jsonl.gz
+        $ manage_langdev.py export -c prod.cfg --watermark wm inc1.jsonl.gz
+        $ manage_langdev.py import -c restore.cfg full.jsonl.gz
+        $ manage_langdev.py import -c restore.cfg --replace inc1.jsonl.gz
+
+    """
+
+    option_list = (
+        Option('path', help='The file to export to. - for the standard '
+                            'output'),
+        Option('--since', dest='since',
+               help='Export only rows changed since this time (ISO 8601 '
+                    'in UTC)'),
+        Option('--watermark', dest='watermark',
+               help='The file that keeps the time of the last export. '
+                    'Export only rows changed since then if it exists'),
+    )
+
+    def run(self, path, since=None, watermark=None):
+        import gzip
+        engine = langdev.web.get_database_engine(flask.current_app.config)
+        archive = langdev.web.get_archive(flask.current_app.config)
+        if since is None and watermark and os.path.isfile(watermark):
+            with open(watermark) as f:
+                since = f.read().strip()
+        if since is not None:
+            since = langdev.backup.parse_datetime(since)
+        if path == '-':
+            output = sys.stdout
+        elif path.endswith('.gz'):
+            output = gzip.open(path + '.part', 'wb', 6)
+        else:
+            output = open(path + '.part', 'wb')
+        counts = dict((type_, 0) for type_, cls in langdev.backup.TYPES)
+        started_at = time.time()
+        with langdev.backup.snapshot(engine, archive) as (connection,
+                                                          next_since):
+            for record in langdev.backup.export(connection, since, archive):
+                print>>output, langdev.backup.dump_record(record)
+                counts[record['type']] += 1
+        if path != '-':
+            output.close()
+            os.rename(path + '.part', path)
+        if watermark:
+            with open(watermark, 'w') as f:
+                print>>f, next_since.isoformat()
+        elapsed = time.time() - started_at
+        total = sum(counts.itervalues())
+        for type_, cls in langdev.backup.TYPES:
+            print>>sys.stderr, '{0:<12} {1:>10} rows'.format(type_,
+                                                             counts[type_])
+        print>>sys.stderr, '{0} rows in {1:.1f}s ({2:.0f} rows/s)'.format(
+            total, elapsed, total / elapsed if elapsed else 0
+        )
+
+
+manager.add_command('export', Export())
+
+
 @manager.shell
 def make_shell_context():
     engine = langdev.web.get_database_engine(flask.current_app.config)